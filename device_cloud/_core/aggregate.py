@@ -0,0 +1,261 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the on-device telemetry aggregation stage. Samples are
+collected in per-key time windows and only statistics of each window are
+published.
+"""
+
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from device_cloud._core import constants
+
+
+# Statistics that can be computed for a window
+STATISTICS = [
+    "min",
+    "max",
+    "mean",
+    "count",
+    "sum",
+    "last"
+]
+
+# Windows with fewer samples than this are computed in pure Python, as NumPy
+# only pays off for larger arrays
+NUMPY_THRESHOLD = 64
+
+
+def compute(values, stats):
+    """
+    Compute the requested statistics for an array('d') of values. Returns a
+    dict of statistic name to value.
+    """
+
+    count = len(values)
+    if numpy is not None and count >= NUMPY_THRESHOLD:
+        data = numpy.frombuffer(values, dtype=numpy.float64)
+        total = float(data.sum())
+        minimum = float(data.min()) if "min" in stats else None
+        maximum = float(data.max()) if "max" in stats else None
+    else:
+        total = math.fsum(values)
+        minimum = min(values) if "min" in stats else None
+        maximum = max(values) if "max" in stats else None
+
+    results = {}
+    for stat in stats:
+        if stat == "min":
+            results[stat] = minimum
+        elif stat == "max":
+            results[stat] = maximum
+        elif stat == "mean":
+            results[stat] = total / count
+        elif stat == "count":
+            results[stat] = count
+        elif stat == "sum":
+            results[stat] = total
+        elif stat == "last":
+            results[stat] = values[-1]
+    return results
+
+
+class Window(object):
+    """
+    Samples of a single key. Windows are length seconds long and one ends
+    every slide seconds, aligned to the epoch. If slide is the same as length
+    (the default) the windows are tumbling, otherwise they are sliding and
+    overlap.
+    """
+
+    def __init__(self, length, slide=None, stats=None):
+        self.length = float(length)
+        self.slide = float(slide or length)
+        if self.length <= 0 or self.slide <= 0 or self.slide > self.length:
+            raise ValueError("Aggregation window must be positive and no "
+                             "shorter than its slide")
+        self.stats = stats or constants.DEFAULT_AGGREGATE_STATS
+        for stat in self.stats:
+            if stat not in STATISTICS:
+                raise ValueError("Unknown aggregation statistic \"{}\". "
+                                 "Supported statistics are {}".format(
+                                     stat, "/".join(STATISTICS)))
+        self.times = array("d")
+        self.values = array("d")
+        # End of the next window to be closed
+        self.end = None
+
+    def add(self, value, now):
+        """
+        Add a sample, returning the results of any windows it closes
+        """
+
+        if self.times and now < self.times[-1]:
+            # Clock went backwards, keep the samples ordered
+            now = self.times[-1]
+        results = self.expire(now)
+        if self.end is None:
+            self.end = (math.floor(now / self.slide) + 1) * self.slide
+        self.times.append(now)
+        self.values.append(value)
+        return results
+
+    def expire(self, now):
+        """
+        Close every window that ended before now. Returns a list of
+        (end time, statistics) for windows that had samples.
+        """
+
+        results = []
+        while self.end is not None and now >= self.end:
+            first = bisect_left(self.times, self.end - self.length)
+            if first < len(self.values):
+                results.append((self.end,
+                                compute(self.values[first:], self.stats)))
+
+            # Samples are always older than self.end, so drop those that are
+            # not part of the next window
+            keep = bisect_left(self.times, self.end + self.slide - self.length)
+            del self.times[:keep]
+            del self.values[:keep]
+            if self.times:
+                self.end += self.slide
+            else:
+                self.end = None
+        return results
+
+    def flush(self, now):
+        """
+        Close the current window early (eg. on disconnect) and drop all samples
+        """
+
+        results = []
+        if self.times:
+            first = bisect_left(self.times, self.end - self.length)
+            results.append((now, compute(self.values[first:], self.stats)))
+        self.times = array("d")
+        self.values = array("d")
+        self.end = None
+        return results
+
+
+class Aggregator(object):
+    """
+    Per-key windowed aggregation of telemetry. Windows are configured for all
+    keys by window/slide/stats, and can be overridden per key in keys (a dict of
+    key to a dict with any of window, slide and stats). Results are returned as
+    (key_stat, value, timestamp) where timestamp is the end of the window in
+    seconds since the epoch.
+    """
+
+    def __init__(self, window=None, slide=None, stats=None, keys=None):
+        self.window = window or constants.DEFAULT_AGGREGATE_WINDOW
+        self.slide = slide
+        self.stats = stats
+        self.keys = keys or {}
+        self.windows = {}
+        self.lock = threading.Lock()
+
+        # Validate settings now rather than on the first sample
+        Window(self.window, self.slide, self.stats)
+        for key in self.keys:
+            self._new_window(key)
+
+    def _new_window(self, key):
+        settings = self.keys.get(key) or {}
+        return Window(settings.get("window") or self.window,
+                      settings.get("slide") or self.slide,
+                      settings.get("stats") or self.stats)
+
+    @staticmethod
+    def _publishes(key, results):
+        pubs = []
+        for end, stats in results:
+            for stat, value in sorted(stats.items()):
+                pubs.append(("{}_{}".format(key, stat), value, end))
+        return pubs
+
+    def add(self, key, value, now=None):
+        """
+        Add a sample for key. Returns the results of any windows it closes.
+        """
+
+        value = float(value)
+        if now is None:
+            now = time()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = self._new_window(key)
+            return self._publishes(key, window.add(value, now))
+
+    def add_many(self, key, values, times=None):
+        """
+        Add a block of samples for key, with a sequence of epoch times or all
+        at the current time. Returns the results of any windows they close.
+        """
+
+        if times is None:
+            times = [time()] * len(values)
+        pubs = []
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = self._new_window(key)
+            for value, now in zip(values, times):
+                pubs += self._publishes(key, window.add(float(value), now))
+        return pubs
+
+    def expire(self, now=None):
+        """
+        Return the results of every window that has ended, including keys that
+        have stopped receiving samples
+        """
+
+        if now is None:
+            now = time()
+        pubs = []
+        with self.lock:
+            for key, window in self.windows.items():
+                pubs += self._publishes(key, window.expire(now))
+        return pubs
+
+    def flush(self, now=None):
+        """
+        Return results for all windows, closing them early
+        """
+
+        if now is None:
+            now = time()
+        pubs = []
+        with self.lock:
+            for key, window in self.windows.items():
+                pubs += self._publishes(key, window.flush(now))
+        return pubs
+
+    def is_aggregated(self, key):
+        """
+        Check if a key is always aggregated through its own configuration
+        """
+
+        return key in self.keys
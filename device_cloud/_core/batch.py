@@ -0,0 +1,291 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the batch builder that turns pending publishes into size
+limited TR50 requests
+"""
+
+from datetime import datetime
+
+from device_cloud._core import codec
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core import tr50
+from device_cloud._core.cache import is_older
+
+
+def _alarm_batch(thing_key, timestamp):
+    command = tr50.create_alarm_publish(thing_key, "alarm_batch",
+                                        "Alarm Batch", timestamp=timestamp,
+                                        republish=False, batch=True)
+    command["params"]["state"] = 0
+    return command, "Alarm Publish alarm_batch : \"Alarm Batch\""
+
+def _alarm_item(pub):
+    return tr50.create_alarm_batch_item(pub.name, pub.state, pub.timestamp,
+                                        pub.message, pub.republish)
+
+def _attribute_batch(thing_key, timestamp):
+    command = tr50.create_attribute_publish(thing_key, "attribute_batch",
+                                            "Attribute Batch",
+                                            timestamp=timestamp, batch=True)
+    return command, "Attribute Publish attribute_batch : \"Attribute Batch\""
+
+def _attribute_item(pub):
+    return tr50.create_attribute_batch_item(pub.name, pub.value, pub.timestamp)
+
+def _location_batch(thing_key, timestamp):
+    command = tr50.create_location_publish(thing_key, "location_batch",
+                                           "Location Batch",
+                                           timestamp=timestamp, batch=True)
+    return command, "Location Publish location_batch : \"Location Batch\""
+
+def _location_item(pub):
+    return tr50.create_location_batch_item(pub.latitude, pub.longitude,
+                                           pub.heading, pub.altitude,
+                                           pub.speed, pub.accuracy,
+                                           pub.fix_type, pub.timestamp)
+
+def _property_batch(thing_key, timestamp):
+    command = tr50.create_property_publish(thing_key, "property_batch",
+                                           "Property Batch", corr_id=timestamp,
+                                           timestamp=timestamp, batch=True)
+    return command, "Property Publish property_batch : \"Property Batch\""
+
+def _property_item(pub):
+    return tr50.create_property_batch_item(pub.name, pub.value, pub.timestamp,
+                                           corr_id=pub.corr_id)
+
+
+# Functions to create the batch command and batch items for each publish type
+BATCH_TYPES = {
+    "PublishAlarm":(_alarm_batch, _alarm_item),
+    "PublishAttribute":(_attribute_batch, _attribute_item),
+    "PublishLocation":(_location_batch, _location_item),
+    "PublishTelemetry":(_property_batch, _property_item)
+}
+
+
+# Bytes of a request around its commands ({})
+REQUEST_OVERHEAD = 2
+# Bytes added to a request for each command ("N": and separators)
+COMMAND_OVERHEAD = 8
+
+
+def _epoch(pub):
+    """
+    Seconds since the epoch of a publish, or None if its time was given as a
+    string
+    """
+
+    return pub.epoch if pub.formatted is None else None
+
+def _is_older(epoch, timestamp, than):
+    """
+    Check if a sample is older than the (epoch, timestamp) of another. Epochs
+    are compared when both are known, to avoid parsing timestamp strings.
+    """
+
+    if epoch is not None and than[0] is not None:
+        return epoch < than[0]
+    return is_older(timestamp, than[1])
+
+def _size(obj):
+    """
+    Size in bytes of obj once serialized in a TR50 request
+    """
+
+    return len(codec.dumpb(obj))
+
+def _encode_batch(command, items):
+    """
+    Encode a batch command whose params hold every item but data, adding the
+    already encoded items as params["data"]
+    """
+
+    params = command["params"]
+    head = codec.dumpb(dict((key, value) for key, value in command.items()
+                            if key != "params"))
+    body = codec.dumpb(dict((key, value) for key, value in params.items()
+                            if key != "data"))
+    data = b"\"data\":[" + b",".join(items) + b"]"
+    body = body[:-1] + (b"," if len(body) > 2 else b"") + data + b"}"
+    return head[:-1] + b",\"params\":" + body + b"}"
+
+
+class BatchBuilder(object):
+    """
+    Packs publishes into *.batch commands, several commands per request. A
+    command is closed when it reaches max_items items, and a request is sent
+    (through send, which takes a list of OutMessages) as soon as adding
+    another item would take it over max_bytes. Only one request is held in
+    memory at a time. Each item is encoded once, when it is added, and the
+    request is sent as those bytes. If cache_values is True, each command
+    remembers the newest telemetry and attribute value of each key it carries.
+    """
+
+    def __init__(self, thing_key, send, max_bytes=None, max_items=None,
+                 cache_values=False):
+        self.thing_key = thing_key
+        self.cache_values = cache_values
+        self.send_function = send
+        self.max_bytes = max_bytes or constants.DEFAULT_MAX_PAYLOAD_BYTES
+        self.max_items = max_items or constants.DEFAULT_MAX_BATCH_ITEMS
+        self.status = constants.STATUS_SUCCESS
+
+        # Commands ready to be sent in the current request
+        self.messages = []
+        self.size = REQUEST_OVERHEAD
+        # Batch commands still accepting items, their encoded items and the
+        # (epoch, timestamp) of each value they cache, by publish type
+        self.open = {}
+        self.items = {}
+        self.latest = {}
+
+    def add(self, pub):
+        """
+        Add a publish to the current request
+        """
+
+        if pub.type == "PublishLog":
+            command = tr50.create_log_publish(self.thing_key, pub.message,
+                                              timestamp=pub.timestamp)
+            encoded = codec.dumpb(command)
+            size = len(encoded) + COMMAND_OVERHEAD
+            if self._over(size):
+                self.flush()
+            message = defs.OutMessage(command, "Log Publish {}",
+                                      description_args=(pub.message,),
+                                      future=pub.future)
+            message.encoded = encoded
+            if pub.journal_id is not None:
+                message.journal_ids.append(pub.journal_id)
+            self.messages.append(message)
+            self.size += size
+            return
+
+        if pub.type == "PublishTelemetryBlock":
+            # Blocks go straight into property batch items
+            for name, value, epoch, timestamp in pub.samples():
+                self._add_item("PublishTelemetry",
+                               tr50.create_property_batch_item(name, value,
+                                                               timestamp),
+                               journal_id=pub.journal_id,
+                               cached=("property", name, value, epoch,
+                                       timestamp))
+            return
+
+        cached = None
+        if pub.type == "PublishTelemetry":
+            cached = ("property", pub.name, pub.value, _epoch(pub),
+                      pub.timestamp)
+        elif pub.type == "PublishAttribute":
+            cached = ("attribute", pub.name, pub.value, _epoch(pub),
+                      pub.timestamp)
+        self._add_item(pub.type, BATCH_TYPES[pub.type][1](pub), pub.future,
+                       pub.journal_id, cached)
+
+    def _add_item(self, pub_type, item, future=None, journal_id=None,
+                  cached=None):
+        """
+        Add an item to the open batch command for its publish type. future is
+        resolved with the reply to that command. journal_id is the journal
+        record of the publish the item came from. cached is the (kind, key,
+        value, epoch, timestamp) the item publishes, for the value cache.
+        """
+
+        encoded = codec.dumpb(item)
+        item_size = len(encoded) + 1
+
+        batch = self.open.get(pub_type)
+        if batch is not None and self._over(item_size):
+            self.flush()
+            batch = None
+        if batch is None:
+            timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
+            command, description = BATCH_TYPES[pub_type][0](self.thing_key,
+                                                            timestamp)
+            command["params"]["data"] = []
+            overhead = _size(command) + COMMAND_OVERHEAD
+            if self._over(overhead + item_size):
+                self.flush()
+            batch = self.open[pub_type] = defs.OutMessage(command, description)
+            self.items[pub_type] = []
+            self.latest[pub_type] = {}
+            self.size += overhead
+
+        batch.command["params"]["data"].append(item)
+        self.items[pub_type].append(encoded)
+        if future:
+            batch.futures.append(future)
+        # The items of a block are added one after another
+        if journal_id is not None and batch.journal_ids[-1:] != [journal_id]:
+            batch.journal_ids.append(journal_id)
+        if cached and self.cache_values:
+            if batch.cache_values is None:
+                batch.cache_values = {}
+            kind, key, value, epoch, timestamp = cached
+            latest = self.latest[pub_type]
+            if (kind, key) not in latest or \
+                    not _is_older(epoch, timestamp, latest[(kind, key)]):
+                latest[(kind, key)] = (epoch, timestamp)
+                batch.cache_values[(kind, key)] = (value, timestamp)
+        self.size += item_size
+        if len(batch.command["params"]["data"]) >= self.max_items:
+            self._close(pub_type)
+
+    def _close(self, pub_type):
+        """
+        Close an open batch command, moving it to the current request
+        """
+
+        batch = self.open.pop(pub_type)
+        batch.encoded = _encode_batch(batch.command, self.items.pop(pub_type))
+        del self.latest[pub_type]
+        batch.description_format += " ({} items)"
+        batch.description_args = (len(batch.command["params"]["data"]),)
+        self.messages.append(batch)
+
+    def _over(self, size):
+        """
+        Check if adding size bytes would take a non-empty request over
+        max_bytes. A single command larger than max_bytes is still sent on its
+        own.
+        """
+
+        return bool(self.messages or self.open) and \
+            self.size + size > self.max_bytes
+
+    def finish(self):
+        """
+        Send anything left. Returns the status of the last failed send, or
+        STATUS_SUCCESS.
+        """
+
+        self.flush()
+        return self.status
+
+    def flush(self):
+        """
+        Close all open batches and send the current request
+        """
+
+        for pub_type in list(self.open):
+            self._close(pub_type)
+        if self.messages:
+            status = self.send_function(self.messages)
+            if status != constants.STATUS_SUCCESS:
+                self.status = status
+        self.messages = []
+        self.size = REQUEST_OVERHEAD
@@ -0,0 +1,113 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the cache of the last known telemetry and attribute values
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from device_cloud._core import constants
+from device_cloud._core.defs import monotonic
+
+
+def _parse_timestamp(timestamp):
+    """
+    Parse a Cloud timestamp, with or without fractional seconds. Returns None
+    if it is not one.
+    """
+
+    for time_format in (constants.TIME_FORMAT, "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(timestamp, time_format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def is_older(timestamp, than):
+    """
+    Check if timestamp is before than. Timestamps that cannot be compared are
+    not older.
+    """
+
+    first = _parse_timestamp(timestamp)
+    second = _parse_timestamp(than)
+    return first is not None and second is not None and first < second
+
+
+class ValueCache(object):
+    """
+    Thread safe cache of the last value and timestamp of each telemetry or
+    attribute key. Entries are fresh for ttl seconds after they were stored,
+    and the least recently used entry is evicted once there are more than
+    max_keys. A value older than the cached one is ignored.
+    """
+
+    def __init__(self, ttl=None, max_keys=None):
+        if ttl is None:
+            ttl = constants.DEFAULT_VALUE_CACHE_TTL
+        self.ttl = ttl
+        self.max_keys = max_keys or constants.DEFAULT_VALUE_CACHE_MAX_KEYS
+        self.lock = threading.Lock()
+        # (kind, key) to (value, timestamp, time stored), least recently used
+        # first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, kind, key):
+        """
+        Return (value, timestamp) for a key if a fresh value is cached,
+        otherwise None
+        """
+
+        with self.lock:
+            # Stale entries are dropped as they are found
+            entry = self.entries.pop((kind, key), None)
+            if entry is None or monotonic() - entry[2] > self.ttl:
+                self.misses += 1
+                return None
+            # Most recently used goes last
+            self.entries[(kind, key)] = entry
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, kind, key, value, timestamp):
+        """
+        Store the latest value and timestamp of a key, unless the cached value
+        is newer
+        """
+
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is not None and is_older(timestamp, entry[1]):
+                return
+            self.entries.pop((kind, key), None)
+            self.entries[(kind, key)] = (value, timestamp, monotonic())
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Return the number of cached keys, hits and misses
+        """
+
+        with self.lock:
+            return {"keys":len(self.entries), "hits":self.hits,
+                    "misses":self.misses}
@@ -16,7 +16,6 @@ This module contains the Client class for user applications
 """
 
 import certifi
-import json
 import os
 import uuid
 
@@ -25,11 +24,18 @@ from device_cloud._core.constants import DEFAULT_CONFIG_FILE
 from device_cloud._core.constants import DEFAULT_KEEP_ALIVE
 from device_cloud._core.constants import DEFAULT_LOOP_TIME
 from device_cloud._core.constants import DEFAULT_THREAD_COUNT
+from device_cloud._core.constants import DEFAULT_API_BURST
+from device_cloud._core.constants import DEFAULT_API_RATE
+from device_cloud._core.constants import DEFAULT_CONTROL_BURST
+from device_cloud._core.constants import DEFAULT_CONTROL_RATE
+from device_cloud._core.constants import STATUS_BAD_PARAMETER
 from device_cloud._core.constants import STATUS_SUCCESS
-from device_cloud._core.constants import WORK_PUBLISH
 from device_cloud._core.constants import STATUS_NOT_FOUND
 from device_cloud._core.constants import TIME_FORMAT
+from device_cloud._core import codec
 from device_cloud._core import defs
+from device_cloud._core.deadband import FilterSettings
+from device_cloud._core.deadband import registry_from_config
 from device_cloud._core.handler import Handler
 from device_cloud.identity import Identity
 
@@ -90,12 +96,14 @@ class Client(object):
 
         self.database = None
 
-        # Add sleep for idle loop
-        # default is 0.1
-        self.idle_sleep = 0.1
+        # Minimum time between requests sent to the Cloud. Only used to derive
+        # the default api_rate when initialize() is called.
+        # default is 1 / DEFAULT_API_RATE
+        self.idle_sleep = 1.0 / DEFAULT_API_RATE
 
         # Client notification handler for reply errors
         # 3 parameters: error list, sent_message, reply
+        # sent_message is the OutMessage sent, its command the TR50 command
         self.error_handler = error_handler
 
     def initialize(self):
@@ -116,7 +124,7 @@ class Client(object):
         if os.path.exists(config_path):
             try:
                 with open(config_path, "r") as config_file:
-                    kwargs.update(json.load(config_file))
+                    kwargs.update(codec.load(config_file))
             except IOError as error:
                 print("Error parsing JSON from "
                         "{}".format(self.config.config_file))
@@ -184,13 +192,21 @@ class Client(object):
             "keep_alive":DEFAULT_KEEP_ALIVE,
             "loop_time":DEFAULT_LOOP_TIME,
             "thread_count":DEFAULT_THREAD_COUNT,
-            "ca_bundle_file":certifi.where()
+            "ca_bundle_file":certifi.where(),
+            "api_rate":1.0 / self.idle_sleep if self.idle_sleep else 0,
+            "api_burst":DEFAULT_API_BURST,
+            "control_rate":DEFAULT_CONTROL_RATE,
+            "control_burst":DEFAULT_CONTROL_BURST
         }
         self.config.update(config_defaults, False)
 
         # Initialize handler
         self.handler = Handler(self.config, self)
 
+        # Per-key filters applied to telemetry before it is queued
+        self.telemetry_filters = registry_from_config(
+            self.config.telemetry_filters)
+
         # Access logger functions
         self.critical = self.handler.logger.critical
         self.debug = self.handler.logger.debug
@@ -263,7 +279,7 @@ class Client(object):
         return self.handler.action_deregister(action_name)
 
     def action_register_callback(self, action_name, callback_function,
-                                 user_data=None):
+                                 user_data=None, executor=None):
         """
         Associate a callback function with an action in the Cloud
 
@@ -272,20 +288,37 @@ class Client(object):
           callback_function     (func) Function to execute when triggered by
                                        action. Callback function must take
                                        parameters of the form (client,
-                                       parameters, user_data[, action_request])
-                                       where action_request is optional, but
-                                       contains the request_id for later use.
-                                       The callback function must also return
+                                       parameters, user_data[, action_request
+                                       [, cancel_token]]) where action_request
+                                       is optional, but contains the
+                                       request_id for later use. cancel_token
+                                       is cancelled if the action runs past
+                                       its action_limits timeout. The
+                                       callback function must also return
                                        status_code, or (status_code,
                                        status_message) in a tuple.
+          user_data                    Passed to the callback
+          executor            (string) "process" to run the callback in a
+                                       separate process, for CPU heavy
+                                       callbacks. The callback and user_data
+                                       must be picklable (eg. a module level
+                                       function), parameters and results are
+                                       pickled, and the callback gets None as
+                                       the client. A callback still running
+                                       at its timeout has its process
+                                       killed. (default: run on a worker
+                                       thread)
 
         Returns:
+          STATUS_BAD_PARAMETER         Unknown executor, or the callback
+                                       cannot be run in a process
           STATUS_EXISTS                Action with that name already exists
+          STATUS_NOT_SUPPORTED         Processes are not supported here
           STATUS_SUCCESS               Successfully registered callback
         """
         return self.handler.action_register_callback(action_name,
                                                      callback_function,
-                                                     user_data)
+                                                     user_data, executor)
 
     def action_register_command(self, action_name, command):
         """
@@ -313,14 +346,15 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Alarm has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
         """
 
         ret = None
         if not self.offline:
             alarm = defs.PublishAlarm(alarm_name, state, message, republish)
-            self.handler.queue_publish(alarm)
-            work = defs.Work(WORK_PUBLISH, None)
-            ret =  self.handler.queue_work(work)
+            # Alarms are sent without waiting for more publishes to batch
+            ret = self.handler.queue_publish(alarm, urgent=True)
         return ret
 
     def attribute_publish(self, attribute_name, value):
@@ -333,6 +367,8 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Attribute has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
         """
 
         attr = defs.PublishAttribute(attribute_name, value)
@@ -406,6 +442,8 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Event has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
         """
         ret = None
         if not self.offline:
@@ -526,6 +564,8 @@ class Client(object):
 
         Returns:
           STATUS_SUCCESS               Location has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
         """
 
         location = defs.PublishLocation(latitude, longitude, heading=heading,
@@ -533,6 +573,166 @@ class Client(object):
                                         accuracy=accuracy, fix_type=fix_type)
         return self.handler.queue_publish(location)
 
+    def notify_deregister_callback(self, notification, callback_function):
+        """
+        Remove a callback registered with notify_register_callback
+
+        Parameters:
+          notification        (string) Notification topic, without "notify/"
+          callback_function     (func) Callback to remove
+
+        Returns:
+          STATUS_NOT_FOUND             Callback not registered for notification
+          STATUS_SUCCESS               Callback removed
+        """
+
+        return self.handler.callback_deregister(self.handler.notify_handlers,
+                                                notification, callback_function)
+
+    def notify_register_callback(self, notification, callback_function,
+                                 user_data=None):
+        """
+        Associate a callback function with a notification from the Cloud
+
+        Parameters:
+          notification        (string) Notification topic, without "notify/"
+                                       (eg. "mailbox_activity")
+          callback_function     (func) Function to execute when the
+                                       notification is received. Callback
+                                       function must take parameters of the
+                                       form (client, message, user_data) where
+                                       message has the topic and the decoded
+                                       json of the notification.
+
+        Returns:
+          STATUS_SUCCESS               Successfully registered callback
+        """
+
+        return self.handler.callback_register(self.handler.notify_handlers,
+                                              notification, callback_function,
+                                              user_data)
+
+    def publish_stats(self):
+        """
+        Return counters describing the publish queue, useful for sizing the
+        publish_queue configuration
+
+        Returns:
+          dict                         queued: publishes waiting to be sent
+                                       bytes: approximate size of queued
+                                              publishes
+                                       dropped: publishes dropped because the
+                                                queue was full
+                                       coalesced: publishes replaced by a newer
+                                                  value for the same key
+                                       flushes: dict of flush counts by
+                                                trigger (full/linger/urgent)
+                                       suppressed: telemetry samples
+                                                   suppressed by filters
+                                       suppressed_keys: dict of suppressed
+                                                        sample counts by key
+                                       rate_limits: dict of rate, burst,
+                                                    waits and wait_time
+                                                    (seconds) of the api and
+                                                    control rate limiters
+        """
+
+        stats = self.handler.publish_stats()
+        stats.update(self.telemetry_filters.stats())
+        return stats
+
+    def reply_deregister_callback(self, command, callback_function):
+        """
+        Remove a callback registered with reply_register_callback
+
+        Parameters:
+          command             (string) TR50 command name
+          callback_function     (func) Callback to remove
+
+        Returns:
+          STATUS_NOT_FOUND             Callback not registered for command
+          STATUS_SUCCESS               Callback removed
+        """
+
+        return self.handler.callback_deregister(self.handler.reply_handlers,
+                                                command, callback_function)
+
+    def reply_register_callback(self, command, callback_function,
+                                user_data=None):
+        """
+        Associate a callback function with replies to a TR50 command. Callbacks
+        run after the Client has handled the reply itself.
+
+        Parameters:
+          command             (string) TR50 command name (eg. "diag.time")
+          callback_function     (func) Function to execute when a reply to
+                                       command is received. Callback function
+                                       must take parameters of the form
+                                       (client, sent_message, reply, user_data)
+                                       where sent_message is the OutMessage
+                                       that was sent and reply is a dict with
+                                       success, params and errorCodes. Unless
+                                       the command may be retransmitted,
+                                       sent_message.command only holds the
+                                       command name and key.
+
+        Returns:
+          STATUS_SUCCESS               Successfully registered callback
+        """
+
+        return self.handler.callback_register(self.handler.reply_handlers,
+                                              command, callback_function,
+                                              user_data)
+
+    def telemetry_filter_remove(self, telemetry_name):
+        """
+        Remove the filter set for a telemetry key with telemetry_filter_set.
+        The default filter from the configuration still applies.
+
+        Parameters:
+          telemetry_name      (string) Key of property
+
+        Returns:
+          STATUS_SUCCESS               Filter has been removed
+        """
+
+        self.telemetry_filters.remove_filter(telemetry_name)
+        return STATUS_SUCCESS
+
+    def telemetry_filter_set(self, telemetry_name, deadband=None,
+                             deadband_percent=None, min_interval=None,
+                             max_silence=None):
+        """
+        Only publish samples of a telemetry key that have changed enough since
+        the last published sample. Suppressed samples are counted in
+        publish_stats().
+
+        Parameters:
+          telemetry_name      (string) Key of property to filter
+          deadband            (number) Minimum absolute change to publish
+          deadband_percent    (number) Minimum change to publish as a percent
+                                       of the last published value
+          min_interval        (number) Minimum seconds between publishes
+          max_silence         (number) Publish the next sample regardless of
+                                       the deadband once this many seconds
+                                       have passed since the last publish.
+                                       Nothing is sent until that sample is
+                                       published, this is not a heartbeat
+
+        Returns:
+          STATUS_SUCCESS               Filter has been set
+          STATUS_BAD_PARAMETER         A threshold is negative
+        """
+
+        try:
+            settings = FilterSettings(deadband, deadband_percent,
+                                      min_interval, max_silence)
+        except ValueError as error:
+            self.error(str(error))
+            return STATUS_BAD_PARAMETER
+        self.telemetry_filters.set_filter(telemetry_name, settings)
+        return STATUS_SUCCESS
+
     def telemetry_publish(self, telemetry_name, value, cloud_response=False,
              timestamp=None, corr_id=None, aggregate=False):
         """
@@ -545,15 +745,129 @@ class Client(object):
                                      If true, the return status indicates if
                                      it was sent to the cloud. Otherwise,
                                      the return status is if it was queued.
+                                     Any number of threads can wait for
+                                     responses at the same time.
           timestamp           (string) Optional datetime format timestamp to
                                        override the timestamp applied by the API
+          aggregate             (bool) Add the value to an aggregation window
+                                       instead of publishing it. Only the
+                                       window statistics are published, as
+                                       {telemetry_name}_{stat}. Keys listed in
+                                       telemetry_aggregation.per_key are always
+                                       aggregated. cloud_response and timestamp
+                                       are ignored.
         Returns:
           STATUS_SUCCESS             Telemetry has been queued for publishing
+          STATUS_FULL                Publish queue is full, the publish
+                                     was dropped
+          STATUS_BAD_PARAMETER       Value to aggregate is not a number
+          STATUS_FAILURE             cloud_response is set and the Cloud
+                                     rejected the publish
+          STATUS_TIMED_OUT           cloud_response is set and there was no
+                                     response within 15 seconds
+
+        Samples suppressed by a telemetry filter (see telemetry_filter_set)
+        are not queued, and STATUS_SUCCESS is returned. Samples published
+        with cloud_response are never suppressed, so their status is always
+        the Cloud's reply.
         """
 
         telem = defs.PublishTelemetry(telemetry_name, value, timestamp, corr_id, aggregate)
+        if aggregate or self.handler.aggregator.is_aggregated(telemetry_name):
+            return self.handler.aggregate_publish(telem)
+        if not self.telemetry_filters.accept(telemetry_name, value,
+                                             force=cloud_response):
+            return STATUS_SUCCESS
         return self.handler.request_publish(telem, cloud_response)
 
+    def telemetry_publish_many(self, telemetry_name, values, timestamps=None,
+                               aggregate=False):
+        """
+        Publish a block of telemetry samples for one key to the Cloud. The
+        block is queued as a single publish and sent as property batch items.
+
+        Parameters:
+          telemetry_name      (string) Key of property to publish
+          values            (sequence) Numbers to publish. Can be a list,
+                                       array.array or NumPy array
+          timestamps        (sequence) Optional seconds since the epoch of each
+                                       value. If not given, all values are
+                                       timestamped with the current time
+          aggregate             (bool) Add the values to an aggregation window
+                                       instead of publishing them (see
+                                       telemetry_publish)
+
+        Returns:
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
+          STATUS_BAD_PARAMETER         Values are not numbers or there are not
+                                       the same number of values and timestamps
+
+        Samples suppressed by a telemetry filter (see telemetry_filter_set)
+        are left out of the block.
+        """
+
+        return self.telemetry_publish_table({telemetry_name:values},
+                                            timestamps, aggregate)
+
+    def telemetry_publish_table(self, columns, timestamps=None,
+                                aggregate=False):
+        """
+        Publish blocks of telemetry samples for several keys sharing the same
+        timestamps. The block is queued as a single publish and sent as
+        property batch items.
+
+        Parameters:
+          columns               (dict) Key of property to a sequence of numbers
+                                       to publish (list, array.array or NumPy
+                                       array). All must be the same length.
+          timestamps        (sequence) Optional seconds since the epoch of each
+                                       row. If not given, all values are
+                                       timestamped with the current time
+          aggregate             (bool) Add the values to aggregation windows
+                                       instead of publishing them (see
+                                       telemetry_publish)
+
+        Returns:
+          STATUS_SUCCESS               Telemetry has been queued for publishing
+          STATUS_FULL                  Publish queue is full, the publish
+                                       was dropped
+          STATUS_BAD_PARAMETER         Values are not numbers or columns and
+                                       timestamps are not all the same length
+
+        Samples suppressed by a telemetry filter (see telemetry_filter_set)
+        are left out. A column that loses samples is queued as a block of its
+        own.
+        """
+
+        try:
+            block = defs.PublishTelemetryBlock(columns, timestamps)
+        except (TypeError, ValueError) as error:
+            self.error("Bad telemetry block: %s", error)
+            return STATUS_BAD_PARAMETER
+
+        # Split off any columns that are aggregated
+        aggregated = []
+        published = []
+        for column in block.columns:
+            if aggregate or self.handler.aggregator.is_aggregated(column[0]):
+                aggregated.append(column)
+            else:
+                published.append(column)
+
+        status = STATUS_SUCCESS
+        if aggregated:
+            agg_block = defs.PublishTelemetryBlock(aggregated, block.timestamps)
+            status = self.handler.aggregate_publish(agg_block)
+        if published:
+            block.columns = published
+            for pub in self.telemetry_filters.filter_block(block):
+                result = self.handler.queue_publish(pub)
+                if result != STATUS_SUCCESS:
+                    status = result
+        return status
+
     def telemetry_read_last_sample(self, telemetry_name):
         """
         Read back last/current telemetry sample from the Cloud
@@ -562,13 +876,35 @@ class Client(object):
           telemetry_name      (string) Key of property to publish
 
         Returns:
-          STATUS_SUCCESS               Telemetry has been queued for publishing
+          STATUS_SUCCESS               Sample was read from the Cloud
+          STATUS_FAILURE               Cloud reported an error
+          STATUS_TIMED_OUT             No reply within 15 seconds
           value                        Value for last telemetry sample in cloud
           timestamp                    Timestamp for the sample
         """
 
         return self.handler.handle_telemetry_get(telemetry_name)
 
+    def telemetry_read_last_samples(self, telemetry_names):
+        """
+        Read back last/current telemetry samples of several keys from the
+        Cloud. All the reads are sent together in one request (or one per
+        max_batch_items keys) and waited for together.
+
+        Parameters
+          telemetry_names      (list) Keys of properties to read
+
+        Returns:
+          STATUS_SUCCESS               Every sample was read from the Cloud
+          (other)                      Status of the first key that could not
+                                       be read
+          results                      Dict of key to (status, value,
+                                       timestamp), as returned by
+                                       telemetry_read_last_sample
+        """
+
+        return self.handler.handle_telemetry_get_many(telemetry_names)
+
     def attribute_read_last_sample(self, attribute_name):
         """
         Read back last/current attribute sample from the Cloud
@@ -577,13 +913,35 @@ class Client(object):
           attribute_name      (string) Key of property to publish
 
         Returns:
-          STATUS_SUCCESS               Telemetry has been queued for publishing
+          STATUS_SUCCESS               Sample was read from the Cloud
+          STATUS_FAILURE               Cloud reported an error
+          STATUS_TIMED_OUT             No reply within 15 seconds
           value                        Value for last attribute sample in cloud
           timestamp                    Timestamp for the sample
         """
 
         return self.handler.handle_attribute_get(attribute_name)
 
+    def attribute_read_last_samples(self, attribute_names):
+        """
+        Read back last/current attribute samples of several keys from the
+        Cloud. All the reads are sent together in one request (or one per
+        max_batch_items keys) and waited for together.
+
+        Parameters
+          attribute_names      (list) Keys of attributes to read
+
+        Returns:
+          STATUS_SUCCESS               Every sample was read from the Cloud
+          (other)                      Status of the first key that could not
+                                       be read
+          results                      Dict of key to (status, value,
+                                       timestamp), as returned by
+                                       attribute_read_last_sample
+        """
+
+        return self.handler.handle_attribute_get_many(attribute_names)
+
     def update_thing_details(self, name=None, description=None,
                              iccid=None, esn=None, imei=None, meid=None,
                              imsi=None, unset_fields=[]):
@@ -607,3 +965,28 @@ class Client(object):
 
         return self.handler.handle_update_thing_details(name, description,
                                     iccid, esn, imei, meid, imsi, unset_fields)
+
+    def work_stats(self):
+        """
+        Return counters describing the work pools, useful for sizing the
+        work_pools configuration
+
+        Returns:
+          dict                         Counters of each pool (messages,
+                                       publish, actions and transfers):
+                                       threads: worker threads now
+                                       min_threads, max_threads: pool size
+                                       busy: workers handling work now
+                                       queued: work waiting for a worker
+                                       max_queued: deepest the queue has been
+                                       handled: work handled so far
+                                       grown, shrunk: threads added and
+                                                      retired
+                                       priorities: dict of queued, taken,
+                                                   wait_mean and wait_max
+                                                   (seconds) by priority
+                                                   (control/reply/publish/
+                                                   transfer)
+        """
+
+        return self.handler.work_stats()
@@ -0,0 +1,285 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the JSON codec used for TR50 messages and configuration
+files. The fastest installed library is used (orjson, ujson, simplejson, then
+the standard library), and anything a library cannot encode falls back to the
+standard library. Large objects can be decoded incrementally when ijson is
+installed.
+"""
+
+import io
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class Codec(object):
+    """
+    JSON encoding and decoding with one library. dumps returns compact str,
+    dumpb returns compact bytes (UTF-8) and loads accepts str or bytes.
+    """
+
+    def __init__(self, name, dumps, dumpb, loads):
+        self.name = name
+        self.dumps = dumps
+        self.dumpb = dumpb
+        self.loads = loads
+
+    def __str__(self):
+        return self.name
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+def _stdlib_dumpb(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _stdlib_loads(data):
+    if isinstance(data, bytes) and not isinstance(data, str):
+        # Python 3 before 3.6 only decodes str
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+STDLIB = Codec("json", _stdlib_dumps, _stdlib_dumpb, _stdlib_loads)
+
+
+def _orjson():
+    import orjson
+    return Codec("orjson", lambda obj: orjson.dumps(obj).decode("utf-8"),
+                 orjson.dumps, orjson.loads)
+
+def _ujson():
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False,
+                           ensure_ascii=False)
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+    return Codec("ujson", dumps, dumpb, ujson.loads)
+
+def _simplejson():
+    import simplejson
+    def dumps(obj):
+        return simplejson.dumps(obj, separators=(",", ":"))
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+    return Codec("simplejson", dumps, dumpb, simplejson.loads)
+
+
+# Supported codecs in order of preference
+CODECS = [
+    ("orjson", _orjson),
+    ("ujson", _ujson),
+    ("simplejson", _simplejson),
+    ("json", lambda: STDLIB)
+]
+
+# Errors that mean a library cannot handle a value the standard library can
+# (eg. integers over 64 bits or non-string keys)
+FALLBACK_ERRORS = (TypeError, ValueError, OverflowError)
+
+
+def available():
+    """
+    Names of the codecs that can be used on this system
+    """
+
+    names = []
+    for name, factory in CODECS:
+        try:
+            factory()
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+def get_codec(name=None):
+    """
+    Return the codec called name, or the fastest available codec if name is
+    None or "auto". Raises ValueError if name is not a supported codec and
+    ImportError if its library is not installed.
+    """
+
+    if name in (None, "auto"):
+        for _, factory in CODECS:
+            try:
+                return factory()
+            except ImportError:
+                pass
+    for codec_name, factory in CODECS:
+        if codec_name == name:
+            return factory()
+    raise ValueError("Unknown JSON codec \"{}\". Supported codecs are "
+                     "auto/{}".format(name, "/".join(x[0] for x in CODECS)))
+
+
+# Codec in use
+_codec = get_codec()
+
+def set_codec(name=None):
+    """
+    Select the codec used by dumps, dumpb and loads
+    """
+
+    global _codec
+    _codec = get_codec(name)
+    return _codec
+
+def codec_name():
+    return _codec.name
+
+
+def dumps(obj):
+    """
+    Encode obj as compact JSON str
+    """
+
+    try:
+        return _codec.dumps(obj)
+    except FALLBACK_ERRORS:
+        return STDLIB.dumps(obj)
+
+def dumpb(obj):
+    """
+    Encode obj as compact JSON bytes, ready to be sent over MQTT
+    """
+
+    try:
+        return _codec.dumpb(obj)
+    except FALLBACK_ERRORS:
+        return STDLIB.dumpb(obj)
+
+def loads(data):
+    """
+    Decode JSON from str or bytes
+    """
+
+    return _codec.loads(data)
+
+def load(file_obj):
+    """
+    Decode JSON from a file object
+    """
+
+    return loads(file_obj.read())
+
+def iter_items(data, stream_bytes=None, lazy_path=None):
+    """
+    Iterate over the (key, value) pairs of the JSON object in data. When ijson
+    is installed and data is longer than stream_bytes, each value is decoded
+    as it is reached instead of decoding the whole object first. lazy_path is
+    an optional function of a key returning the dotted path of a list in that
+    key's value (eg. "params.messages"), or None. That list is not built with
+    the value, it is replaced by a LazyList that decodes one item at a time.
+    """
+
+    if ijson and stream_bytes is not None and len(data) > stream_bytes:
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        if lazy_path is None:
+            return ijson.kvitems(io.BytesIO(data), "", use_float=True)
+        return _stream_items(data, lazy_path)
+    return iter(loads(data).items())
+
+def _stream_items(data, lazy_path):
+    """
+    Generate the (key, value) pairs of the JSON object in data from ijson
+    parse events, skipping the items of each value's lazy list
+    """
+
+    builder = None
+    skip = None
+    for prefix, event, value in ijson.parse(io.BytesIO(data), use_float=True):
+        if skip is not None:
+            # Items of a lazy list are decoded when the LazyList is iterated
+            if prefix != skip or event != "end_array":
+                continue
+            skip = None
+        elif builder is None:
+            if prefix == "" and event == "map_key":
+                key = value
+                builder = _ValueBuilder()
+                path = lazy_path(key)
+                lazy = "{}.{}".format(key, path) if path else None
+                streamed = False
+            continue
+        elif prefix == lazy and event == "start_array":
+            skip = lazy
+            streamed = True
+        builder.event(event, value)
+        if not builder.stack:
+            result = builder.value
+            if streamed:
+                parent = result
+                keys = path.split(".")
+                for name in keys[:-1]:
+                    parent = parent[name]
+                parent[keys[-1]] = LazyList(data, lazy + ".item")
+            yield key, result
+            builder = None
+
+
+class LazyList(object):
+    """
+    List in a JSON payload that is decoded one item at a time, each time it is
+    iterated
+    """
+
+    def __init__(self, data, prefix):
+        self.data = data
+        self.prefix = prefix
+
+    def __iter__(self):
+        return ijson.items(io.BytesIO(self.data), self.prefix, use_float=True)
+
+
+class _ValueBuilder(object):
+    """
+    Builds a value from ijson parse events. stack holds the maps and lists
+    that are still open.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.stack = []
+        self.key = None
+
+    def _add(self, value):
+        if not self.stack:
+            self.value = value
+        elif isinstance(self.stack[-1], list):
+            self.stack[-1].append(value)
+        else:
+            self.stack[-1][self.key] = value
+
+    def event(self, event, value):
+        if event == "map_key":
+            self.key = value
+        elif event == "start_map":
+            container = {}
+            self._add(container)
+            self.stack.append(container)
+        elif event == "start_array":
+            container = []
+            self._add(container)
+            self.stack.append(container)
+        elif event in ("end_map", "end_array"):
+            self.stack.pop()
+        else:
+            self._add(value)
@@ -27,8 +27,93 @@ DEFAULT_CONFIG_FILE = "{}-connect.cfg"
 DEFAULT_KEEP_ALIVE = 0
 # Default loop time for MQTT in seconds
 DEFAULT_LOOP_TIME = 1
-# Default number of worker threads
+# Default number of worker threads running actions
 DEFAULT_THREAD_COUNT = 3
+# Default handling of an action request when max_concurrent invocations of
+# the action are running: "queue" or "reject"
+DEFAULT_ACTION_WHEN_BUSY = "queue"
+# Default number of worker threads in the other work pools
+DEFAULT_WORK_POOL_THREADS = {"messages":1, "publish":1, "transfers":1}
+# Default maximum amount of work waiting in each work pool
+DEFAULT_WORK_QUEUE_SIZE = 10000
+# Default seconds waiting for a worker that raise work by one priority
+DEFAULT_WORK_AGING = 1.0
+# Default seconds the oldest work waits, with every worker busy, before a work
+# pool adds a worker
+DEFAULT_WORK_GROW_WAIT = 0.5
+# Default seconds a worker added to a work pool waits for work before exiting
+DEFAULT_WORK_IDLE_TIME = 30
+# Default maximum number of requests per second sent to the Cloud
+# 0 means no limit
+DEFAULT_API_RATE = 10
+# Default number of requests that can be sent back to back before the rate
+# limit applies
+DEFAULT_API_BURST = 10
+# Default requests per second for mailbox acknowledgements, updates and checks.
+# These use their own budget so they are never held up behind telemetry.
+# 0 means no limit
+DEFAULT_CONTROL_RATE = 5
+# Default burst size for mailbox acknowledgements, updates and checks
+DEFAULT_CONTROL_BURST = 5
+# Default publish journal sync policy (always/batch/off)
+DEFAULT_JOURNAL_SYNC = "batch"
+# Default number of journal records written per commit
+DEFAULT_JOURNAL_COMMIT_ITEMS = 1000
+# Default maximum seconds between journal commits
+DEFAULT_JOURNAL_COMMIT_INTERVAL = 1
+# Default maximum number of queued publishes
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_MAX_ITEMS = 0
+# Default maximum approximate bytes of queued publishes
+# 0 means no limit
+DEFAULT_PUBLISH_QUEUE_MAX_BYTES = 16 * 1024 * 1024
+# Default behaviour when the publish queue is full
+# (block/drop_newest/drop_oldest/coalesce)
+DEFAULT_PUBLISH_QUEUE_OVERFLOW = "drop_oldest"
+# Default seconds to wait for space with the block overflow policy
+DEFAULT_PUBLISH_QUEUE_BLOCK_TIMEOUT = 1
+# Default maximum size in bytes of a single publish request
+DEFAULT_MAX_PAYLOAD_BYTES = 128 * 1024
+# Default maximum number of items in a single *.batch command
+DEFAULT_MAX_BATCH_ITEMS = 500
+# Default milliseconds a publish can wait for others to batch with before it
+# is sent
+DEFAULT_LINGER_MS = 1000
+# Default number of pending publishes that triggers a send without waiting for
+# linger_ms
+DEFAULT_MAX_BATCH = 1000
+# Seconds before a flush that could not be queued is tried again
+FLUSH_RETRY_DELAY = 0.5
+# Default length in seconds of telemetry aggregation windows
+DEFAULT_AGGREGATE_WINDOW = 60
+# Default statistics published for each telemetry aggregation window
+DEFAULT_AGGREGATE_STATS = ["min", "max", "mean", "count"]
+# Seconds to wait for the Cloud to reply to a request a caller is waiting on
+DEFAULT_REPLY_TIMEOUT = 15
+# Default seconds a cached telemetry or attribute value is used for reads
+DEFAULT_VALUE_CACHE_TTL = 60
+# Default maximum number of keys in the value cache
+DEFAULT_VALUE_CACHE_MAX_KEYS = 1000
+# Default seconds a sent command is tracked before its reply is considered lost
+DEFAULT_REPLY_TRACKER_TIMEOUT = 60
+# Default maximum number of sent commands tracked while waiting for replies
+DEFAULT_REPLY_TRACKER_MAX_MESSAGES = 10000
+# Default commands that are safe to send again when their reply is lost
+DEFAULT_RETRANSMIT_COMMANDS = ["attribute.current", "diag.ping", "diag.time",
+                               "mailbox.check", "property.current"]
+# Default number of times a lost command is sent again
+DEFAULT_MAX_RETRANSMITS = 2
+# Start of the topic numbers of requests sent without reply tracking
+NO_REPLY_TOPIC_PREFIX = "n"
+# Received payloads larger than this many bytes are decoded one reply at a time
+# when ijson is installed
+STREAM_DECODE_BYTES = 65536
+# Default maximum number of log records buffered by the log_queue handler
+DEFAULT_LOG_QUEUE_MAX_RECORDS = 10000
+# Default number of buffered log records that triggers a write
+DEFAULT_LOG_QUEUE_BATCH_RECORDS = 100
+# Default maximum seconds a log record is buffered before it is written
+DEFAULT_LOG_QUEUE_FLUSH_INTERVAL = 0.5
 
 
 # PORTS THAT REQUIRE SSL CONNECTIONS
@@ -139,3 +224,34 @@ WORK_ACTION = 2
 WORK_DOWNLOAD = 3
 # Upload a file
 WORK_UPLOAD = 4
+
+# PRIORITIES OF WORK, lower is handled first
+
+# Notifications and actions requested by the Cloud
+PRIORITY_CONTROL = 0
+# Replies to sent commands
+PRIORITY_REPLY = 1
+# Sending queued publishes
+PRIORITY_PUBLISH = 2
+# File downloads and uploads
+PRIORITY_TRANSFER = 3
+# Names of the priorities, in order, for statistics
+PRIORITY_NAMES = ("control", "reply", "publish", "transfer")
+
+# Priority of each type of work
+WORK_PRIORITIES = {
+    WORK_MESSAGE:PRIORITY_REPLY,
+    WORK_PUBLISH:PRIORITY_PUBLISH,
+    WORK_ACTION:PRIORITY_CONTROL,
+    WORK_DOWNLOAD:PRIORITY_TRANSFER,
+    WORK_UPLOAD:PRIORITY_TRANSFER
+}
+
+# Work pool that handles each type of work
+WORK_POOLS = {
+    WORK_MESSAGE:"messages",
+    WORK_PUBLISH:"publish",
+    WORK_ACTION:"actions",
+    WORK_DOWNLOAD:"transfers",
+    WORK_UPLOAD:"transfers"
+}
@@ -0,0 +1,239 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the per-key filters that suppress telemetry samples which
+have not changed enough to be worth publishing
+"""
+
+import threading
+from array import array
+from time import time
+
+from device_cloud._core import defs
+from device_cloud._core.defs import monotonic
+
+
+class FilterSettings(object):
+    """
+    Thresholds shared by every key filtered the same way:
+      deadband          publish only if the value moved more than this from the
+                        last published value
+      deadband_percent  publish only if the value moved more than this percent
+                        of the last published value
+      min_interval      never publish more often than this many seconds
+      max_silence       publish the next sample regardless of the deadband once
+                        this many seconds have passed since the last publish.
+                        Nothing is published until that sample arrives, this
+                        is not a heartbeat.
+    """
+
+    __slots__ = ("deadband", "deadband_percent", "min_interval", "max_silence")
+
+    def __init__(self, deadband=None, deadband_percent=None, min_interval=None,
+                 max_silence=None):
+        for value in (deadband, deadband_percent, min_interval, max_silence):
+            if value is not None and value < 0:
+                raise ValueError("Telemetry filter thresholds cannot be "
+                                 "negative")
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.min_interval = min_interval
+        self.max_silence = max_silence
+
+    def accept(self, state, value, now):
+        """
+        Check if value should be published given the per-key state
+        """
+
+        if state.last_time is None:
+            return True
+        elapsed = now - state.last_time
+        if self.min_interval and elapsed < self.min_interval:
+            return False
+        if self.max_silence and elapsed >= self.max_silence:
+            return True
+        if self.deadband is None and self.deadband_percent is None:
+            return True
+
+        try:
+            change = abs(value - state.last_value)
+        except TypeError:
+            # Not a number, only publish changes
+            return value != state.last_value
+        if self.deadband is not None and change <= self.deadband:
+            return False
+        if (self.deadband_percent is not None and
+                change <= abs(state.last_value) * self.deadband_percent / 100.0):
+            return False
+        return True
+
+
+class FilterState(object):
+    """
+    Last published sample of a key and its count of suppressed samples
+    """
+
+    __slots__ = ("settings", "last_value", "last_time", "suppressed")
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.last_value = None
+        self.last_time = None
+        self.suppressed = 0
+
+
+class FilterRegistry(object):
+    """
+    Filters for telemetry keys. Keys registered with set_filter use their own
+    settings, and any other key uses the default settings if there are any.
+    Checking a sample is O(1) and keeps only the last published value and time
+    per key.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.settings = {}
+        self.states = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def _state(self, key):
+        """
+        Return the filter state of a key, or None if it is not filtered. Called
+        with the lock held.
+        """
+
+        state = self.states.get(key)
+        if state is None:
+            settings = self.settings.get(key, self.default)
+            if settings is None:
+                return None
+            state = self.states[key] = FilterState(settings)
+        return state
+
+    def _accept(self, state, value, now, force):
+        """
+        Check a sample against a key's state. Called with the lock held.
+        """
+
+        if force or state.settings.accept(state, value, now):
+            state.last_value = value
+            state.last_time = now
+            return True
+        state.suppressed += 1
+        self.suppressed += 1
+        return False
+
+    def accept(self, key, value, now=None, force=False):
+        """
+        Check if a sample should be published, recording it as published if so.
+        If force is True the sample is always published, and only recorded.
+        """
+
+        with self.lock:
+            state = self._state(key)
+            if state is None:
+                return True
+            if now is None:
+                now = monotonic()
+            return self._accept(state, value, now, force)
+
+    def filter_block(self, block):
+        """
+        Filter the samples of a PublishTelemetryBlock. Returns a list of blocks
+        to publish: block itself holding the columns that kept every sample,
+        and a block of its own for each column that lost some. Block
+        timestamps are moved onto the monotonic clock so that min_interval and
+        max_silence count sample time.
+        """
+
+        now = monotonic()
+        times = None
+        if block.timestamps is not None:
+            offset = now - time()
+            times = [epoch + offset for epoch in block.timestamps]
+
+        kept_columns = []
+        blocks = []
+        with self.lock:
+            for name, values in block.columns:
+                state = self._state(name)
+                if state is None:
+                    kept_columns.append((name, values))
+                    continue
+                kept = [index for index, value in enumerate(values)
+                        if self._accept(state, value,
+                                        now if times is None else times[index],
+                                        False)]
+                if len(kept) == len(values):
+                    kept_columns.append((name, values))
+                elif kept:
+                    timestamps = None
+                    if times is not None:
+                        timestamps = array("d", [block.timestamps[index]
+                                                 for index in kept])
+                    sub_block = defs.PublishTelemetryBlock(
+                        [(name, array("d", [values[index] for index in kept]))],
+                        timestamps)
+                    sub_block.epoch = block.epoch
+                    blocks.append(sub_block)
+
+        if kept_columns:
+            block.columns = kept_columns
+            blocks.insert(0, block)
+        return blocks
+
+    def remove_filter(self, key):
+        """
+        Stop filtering a key (other than through the default settings)
+        """
+
+        with self.lock:
+            self.settings.pop(key, None)
+            self.states.pop(key, None)
+
+    def set_filter(self, key, settings):
+        """
+        Filter a key with its own settings
+        """
+
+        with self.lock:
+            self.settings[key] = settings
+            self.states.pop(key, None)
+
+    def stats(self):
+        """
+        Return the total number of suppressed samples and the counts for each
+        key that had samples suppressed
+        """
+
+        with self.lock:
+            return {"suppressed":self.suppressed,
+                    "suppressed_keys":dict((key, state.suppressed) for
+                                           key, state in self.states.items()
+                                           if state.suppressed)}
+
+
+def registry_from_config(config):
+    """
+    Build a FilterRegistry from the telemetry_filters configuration
+    """
+
+    registry = FilterRegistry()
+    if config:
+        if config.default:
+            registry.default = FilterSettings(**config.default)
+        for key, settings in (config.per_key or {}).items():
+            registry.set_filter(key, FilterSettings(**settings))
+    return registry
@@ -17,55 +17,108 @@ This module defines several helper classes for use in the device_cloud handler
 
 import inspect
 import json
+import numbers
 import subprocess
+import sys
+import threading
+from array import array
+from collections import deque
 from datetime import datetime
-
+from datetime import timedelta
+from time import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library
+    from time import time as monotonic
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from device_cloud._core import codec
 from device_cloud._core import constants
 
+# Start of epoch timestamps, for converting UTC datetimes
+EPOCH = datetime(1970, 1, 1)
+
 class Action(object):
     """
-    Holds information associating an action and a callback
+    Holds information associating an action and a callback. executor is
+    "process" for callbacks run in the action process pool, otherwise they run
+    on the thread handling the action.
     """
 
-    def __init__(self, name, callback, client, user_data=None):
+    def __init__(self, name, callback, client, user_data=None, executor=None):
         self.name = name
         self.callback = callback
         self.client = client
         self.user_data = user_data
+        self.executor = executor
 
     def __str__(self):
         string = "Action {} --> Callback {}"
         return string.format(self.name, self.callback.__name__)
 
-    def execute(self, request):
+    def arg_count(self):
         """
-        Execute callback
+        Number of arguments the callback takes
         """
 
-        # Determine the callback prototype that we have
-        signature = inspect.getargspec(self.callback)
-        args = []
+        # Determine the callback prototype that we have. getargspec was
+        # removed in Python 3.11.
+        getargspec = (getattr(inspect, "getargspec", None) or
+                      inspect.getfullargspec)
+        signature = getargspec(self.callback)
         arglen = len(signature.args)
 
         # If there is a "self" parameter (ie. for class methods as a callback),
         # decrement the number of args so as to supply the correct amount
         if inspect.ismethod(self.callback):
             arglen -= 1
+        return arglen
+
+    def execute(self, request):
+        """
+        Execute callback
+        """
 
-        # Build the arguments to pass based on the protoype
-        if arglen >= 1:
-            args.append(self.client)
+        return call_action(self.callback, self.arg_count(), self.client,
+                           request, self.user_data)
 
-        if arglen >= 2:
-            args.append(request.params)
 
-        if arglen >= 3:
-            args.append(self.user_data)
+def call_action(callback, arglen, client, request, user_data):
+    """
+    Call an action callback with as many of (client, params, user_data,
+    request, cancel token) as it takes
+    """
+
+    args = []
+
+    # Build the arguments to pass based on the protoype
+    if arglen >= 1:
+        args.append(client)
+
+    if arglen >= 2:
+        args.append(request.params)
 
-        if arglen >= 4:
-            args.append(request)
+    if arglen >= 3:
+        args.append(user_data)
 
-        return self.callback(*args)
+    if arglen >= 4:
+        args.append(request)
+
+    if arglen >= 5:
+        args.append(request.cancel_token)
+
+    return callback(*args)
 
 
 class ActionCommand(Action):
@@ -104,6 +157,13 @@ class ActionCommand(Action):
         proc = subprocess.Popen(final_command, shell=False,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
+        def kill():
+            try:
+                proc.kill()
+            except OSError:
+                # Already exited
+                pass
+        request.cancel_token.add_callback(kill)
         outstr, errstr = proc.communicate()
         ret_code = proc.returncode
 
@@ -120,6 +180,10 @@ class ActionRequest(object):
         self.request_id = request_id
         self.name = name
         self.params = params
+        self.cancel_token = CancelToken()
+        # Set when the request waited for a concurrency slot, so that it
+        # keeps its place if another request takes the slot first
+        self.requeued = False
 
 
 class Callbacks(dict):
@@ -171,6 +235,51 @@ class Callbacks(dict):
             del self[action_name]
 
 
+class CancelToken(object):
+    """
+    Cooperative cancellation of a running action. Callbacks can check
+    cancelled, wait on the token, or add functions to call when it is
+    cancelled (eg. when the action times out).
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def add_callback(self, function):
+        """
+        Call function when the token is cancelled, or now if it already is
+        """
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(function)
+                return
+        function()
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for function in callbacks:
+            function()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the token is cancelled. Returns True if it was.
+        """
+
+        return self.event.wait(timeout)
+
+
 class Config(dict):
     """
     Holds all configuration information about the Client
@@ -218,6 +327,69 @@ class Config(dict):
                     self[key] = value
 
 
+class DispatchCallback(object):
+    """
+    Holds an application callback registered in a Dispatcher. When dispatched
+    it is called with the client, the dispatched arguments and the user data.
+    """
+
+    def __init__(self, callback, client, user_data=None):
+        self.callback = callback
+        self.client = client
+        self.user_data = user_data
+
+    def __call__(self, *args):
+        return self.callback(self.client, *(args + (self.user_data,)))
+
+
+class Dispatcher(dict):
+    """
+    Dict of names (TR50 command names or notification topics) to the list of
+    functions that handle them, called in the order they were added
+    """
+
+    def __init__(self):
+        super(Dispatcher, self).__init__()
+        self.lock = threading.Lock()
+
+    def add(self, name, function):
+        """
+        Add a function to handle name
+        """
+
+        with self.lock:
+            # Copy on write so dispatch never sees a list being changed
+            self[name] = self.get(name, []) + [function]
+
+    def dispatch(self, name, *args):
+        """
+        Call every function added for name with args. Returns the number of
+        functions called.
+        """
+
+        functions = self.get(name, ())
+        for function in functions:
+            function(*args)
+        return len(functions)
+
+    def remove(self, name, function):
+        """
+        Remove a function, or the application callback wrapping it, from name
+        """
+
+        with self.lock:
+            functions = [x for x in self.get(name, [])
+                         if x != function and
+                         getattr(x, "callback", None) != function]
+            if len(functions) == len(self.get(name, [])):
+                raise KeyError("\"{}\" has no handler {}".format(
+                    name, getattr(function, "__name__", function)))
+            if functions:
+                self[name] = functions
+            else:
+                del self[name]
+
+
 class FileTransfer(object):
     """
     Holds information about pending file transfers
@@ -231,11 +403,25 @@ class FileTransfer(object):
         self.callback = callback
         self.file_id = file_id
         self.file_checksum = file_checksum
+        # Set when the transfer has a status
+        self.done = threading.Event()
         self.status = None
         self.resume_download = False
         self.file_size = None
         self.download_temp_path = None
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        if status is None:
+            self.done.clear()
+        else:
+            self.done.set()
+
     def finish(self):
         """
         Run the completion callback associated with this file transfer
@@ -244,14 +430,54 @@ class FileTransfer(object):
             self.callback(self.client, self.file_name, self.status)
 
 
+class LazyDump(object):
+    """
+    JSON rendering of an object for log messages, only done if the message is
+    actually emitted. Pretty printed, or on a single line if compact is True.
+    """
+
+    __slots__ = ("obj", "compact")
+
+    def __init__(self, obj, compact=False):
+        self.obj = obj
+        self.compact = compact
+
+    def __str__(self):
+        if self.compact:
+            return codec.dumps(self.obj)
+        return json.dumps(self.obj, indent=2, sort_keys=True)
+
+
 class Message(object):
     """
-    Holds received messages in their json format
+    Holds received messages. A raw payload is only decoded from JSON when it
+    is first used, so that decoding happens on a worker thread instead of the
+    MQTT network thread.
     """
 
-    def __init__(self, topic, json_msg):
+    def __init__(self, topic, json_msg=None, payload=None):
         self.topic = topic
-        self.json = json_msg
+        self.payload = payload
+        self._json = json_msg
+
+    @property
+    def json(self):
+        if self._json is None and self.payload is not None:
+            self._json = codec.loads(self.payload)
+        return self._json
+
+    def items(self, lazy_path=None):
+        """
+        Iterate over the (command number, reply) pairs of a reply. Large raw
+        payloads are decoded one reply at a time when possible, and the list
+        at lazy_path(command number) in a reply one item at a time (see
+        codec.iter_items).
+        """
+
+        if self._json is not None or self.payload is None:
+            return iter((self._json or {}).items())
+        return codec.iter_items(self.payload,
+                                constants.STREAM_DECODE_BYTES, lazy_path)
 
     def __str__(self):
         return json.dumps(self.json, indent=2, sort_keys=True)
@@ -260,75 +486,225 @@ class Message(object):
 
 class OutMessage(object):
     """
-    Hold sent messages and their timestamps so that their replies can be handled
+    Hold sent messages and their timestamps so that their replies can be handled.
+    If description_args are given, description is a format string that is only
+    rendered when the description is first used (usually for logging).
     """
 
     def __init__(self, command, description, timestamp=None, data=None,
-                 out_id=None):
+                 out_id=None, description_args=None, future=None):
         self.command = command
-        self.description = description
+        self.description_format = description
+        self.description_args = description_args
         self.timestamp = timestamp
         self.data = data
         self.out_id = out_id
+        # ReplyFutures resolved when the reply to this command is received
+        self.futures = [future] if future else []
+        # Journal records of the publishes in this command, kept until the
+        # reply is received
+        self.journal_ids = []
+        # Number of times this command has been sent before
+        self.attempts = 0
+        # The command as JSON bytes, if it has already been encoded. The
+        # command must not be changed once this is set.
+        self.encoded = None
+        # Values published by this command, stored in the value cache once
+        # the Cloud accepts them: (kind, key) to (value, timestamp)
+        self.cache_values = None
+
+    @property
+    def description(self):
+        if self.description_args is not None:
+            self.description_format = self.description_format.format(
+                *self.description_args)
+            self.description_args = None
+        return self.description_format
+
+    @description.setter
+    def description(self, description):
+        self.description_format = description
+        self.description_args = None
 
     def __str__(self):
         return self.description
 
 
-class OutTracker(dict):
+class ReplyFuture(object):
     """
-    Holds all sent messages that are waiting for a reply
+    Reply to a command that a caller is waiting for. It is set once, by the
+    thread handling the reply, or cancelled if the reply can no longer
+    arrive.
     """
 
     def __init__(self):
-        super(OutTracker, self).__init__()
-        self.mid_tracker = {}
+        self.event = threading.Event()
+        self.success = False
+        self.params = None
+        self.errors = None
+        self.cancelled = False
+        self.timed_out = False
+        self.dropped = False
+
+    def cancel(self):
+        """
+        Wake waiters without a reply
+        """
+
+        if not self.event.is_set():
+            self.cancelled = True
+            self.event.set()
 
-    def add_message(self, message):
+    def expire(self):
         """
-        Add a message
+        Wake waiters because the reply did not arrive in time
         """
 
-        self[message.out_id] = message
+        if not self.event.is_set():
+            self.timed_out = True
+            self.event.set()
+
+    def done(self):
+        return self.event.is_set()
 
-    def add_mid(self, mid, topic):
+    def drop(self):
         """
-        Add an MID with the topic it will send on
+        Wake waiters because the publish was shed from a full publish queue
         """
 
-        self.mid_tracker[mid] = topic
+        if not self.event.is_set():
+            self.dropped = True
+            self.event.set()
 
-    def pop_message(self, topic_num, cmd_num):
+    def set(self, success, params=None, errors=None):
         """
-        Remove a single message
+        Store the reply and wake waiters
         """
 
-        out_id = "{}-{}".format(topic_num, cmd_num)
-        try:
-            message = self.pop(out_id)
-        except KeyError:
-            raise KeyError("Message {} not found. May be a duplicate "
-                           "reply".format(out_id))
-        return message
+        if not self.event.is_set():
+            self.success = bool(success)
+            self.params = params
+            self.errors = errors
+            self.event.set()
 
-    def pop_mid(self, mid):
+    def wait(self, timeout=None):
         """
-        Retrieve the topic an MID is sending on
+        Wait for the reply. Returns True if it was set or cancelled, False if
+        the timeout expired.
         """
-        try:
-            pop_id = self.mid_tracker.pop(mid)
-        except KeyError:
-            raise KeyError("Message {} not found.".format(mid))
-        return pop_id
+
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+
+class RequestSummary(object):
+    """
+    Single line description of the commands in a request for log messages,
+    only rendered if the message is actually emitted
+    """
+
+    __slots__ = ("messages",)
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __str__(self):
+        if len(self.messages) == 1:
+            return str(self.messages[0])
+        return "{} commands: {}".format(
+            len(self.messages), "; ".join(str(x) for x in self.messages))
+
 
 class Publish(object):
     """
-    Super Class for holding information about a pending publish
+    Super Class for holding information about a pending publish. Publishes use
+    __slots__ to keep queued samples small, and store the time they were made
+    as seconds since the epoch. The Cloud timestamp string is only formatted
+    when the publish is sent.
     """
 
+    __slots__ = ("epoch", "formatted", "future", "journal_id")
+
+    # Slots that are not stored in records
+    TRANSIENT = ("future", "journal_id")
+
     def __init__(self):
-        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
-        self.type = self.__class__.__name__
+        self.epoch = time()
+        # Timestamp string given by the application, if any
+        self.formatted = None
+        # ReplyFuture of a caller waiting for the Cloud to accept this publish
+        self.future = None
+        # Id of this publish's record in the publish journal, if any
+        self.journal_id = None
+
+    @property
+    def timestamp(self):
+        """
+        Timestamp in the format expected by the Cloud
+        """
+
+        if self.formatted is not None:
+            return self.formatted
+        return format_timestamp(self.epoch)
+
+    @property
+    def type(self):
+        return self.__class__.__name__
+
+    @classmethod
+    def fields(cls):
+        """
+        Names of all slots of this publish class
+        """
+
+        names = []
+        for klass in reversed(cls.__mro__):
+            names.extend(x for x in klass.__dict__.get("__slots__", ())
+                         if x not in Publish.TRANSIENT)
+        return names
+
+    def to_record(self):
+        """
+        Return a JSON serializable dict that can be turned back into this
+        publish with publish_from_record()
+        """
+
+        record = dict((name, getattr(self, name)) for name in self.fields())
+        record["type"] = self.type
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Recreate a publish from the dict produced by to_record()
+        """
+
+        pub = cls.__new__(cls)
+        pub.future = None
+        pub.journal_id = None
+        for name in cls.fields():
+            setattr(pub, name, record.get(name))
+        if "epoch" not in record:
+            # Record written before timestamps were stored as epochs
+            pub.set_timestamp(record.get("timestamp"))
+        return pub
+
+    def set_timestamp(self, timestamp):
+        """
+        Set the time of the publish from a datetime (UTC), seconds since the
+        epoch (any real number, including Python 2 long) or an already
+        formatted string. None leaves it unchanged.
+        """
+
+        if isinstance(timestamp, datetime):
+            if timestamp.utcoffset() is not None:
+                timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+            self.epoch = (timestamp - EPOCH).total_seconds()
+        elif (isinstance(timestamp, numbers.Real) and
+              not isinstance(timestamp, bool)):
+            self.epoch = float(timestamp)
+        elif timestamp is not None:
+            self.formatted = timestamp
 
 
 class PublishAlarm(Publish):
@@ -336,6 +712,8 @@ class PublishAlarm(Publish):
     Holds information about an alarm
     """
 
+    __slots__ = ("name", "state", "message", "republish")
+
     def __init__(self, name, state, message=None, republish=False):
         super(PublishAlarm, self).__init__()
         self.name = name
@@ -349,6 +727,8 @@ class PublishAttribute(Publish):
     Holds information about an attribute that is to be published
     """
 
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value):
         super(PublishAttribute, self).__init__()
         self.name = name
@@ -360,6 +740,9 @@ class PublishLocation(Publish):
     Holds location information
     """
 
+    __slots__ = ("latitude", "longitude", "heading", "altitude", "speed",
+                 "accuracy", "fix_type")
+
     def __init__(self, latitude, longitude, heading=None, altitude=None,
                  speed=None, accuracy=None, fix_type=None):
         super(PublishLocation, self).__init__()
@@ -392,6 +775,8 @@ class PublishLog(Publish):
     Holds a log message to be sent to the Cloud
     """
 
+    __slots__ = ("message",)
+
     def __init__(self, message):
         super(PublishLog, self).__init__()
         self.message = message
@@ -399,26 +784,279 @@ class PublishLog(Publish):
 
 class PublishTelemetry(Publish):
     """
-    Holds information about telemetry that is to be published
+    Holds information about telemetry that is to be published. timestamp can
+    be a datetime (UTC), seconds since the epoch or an already formatted
+    string.
     """
 
+    __slots__ = ("name", "value", "corr_id", "aggregate")
+
     def __init__(self, name, value, timestamp=None, corr_id=None, aggregate=None):
         super(PublishTelemetry, self).__init__()
-        if type(timestamp) is datetime:
-            self.timestamp = timestamp.strftime(constants.TIME_FORMAT)
+        self.set_timestamp(timestamp)
         self.name = name
         self.value = value
         self.corr_id = corr_id
         self.aggregate = aggregate
 
 
+class PublishTelemetryBlock(Publish):
+    """
+    Holds a block of telemetry samples for one or more keys. Each key's values
+    are stored as a column of doubles, sharing a column of epoch timestamps (or
+    the time of the block if there are none), so large buffers do not need a
+    Python object per sample.
+    """
+
+    __slots__ = ("columns", "timestamps")
+
+    def __init__(self, columns, timestamps=None):
+        super(PublishTelemetryBlock, self).__init__()
+        if isinstance(columns, dict):
+            columns = columns.items()
+        self.columns = [(name, to_float_array(values))
+                        for name, values in columns]
+        self.timestamps = None
+        if timestamps is not None:
+            self.timestamps = to_float_array(timestamps)
+
+        lengths = set(len(values) for _, values in self.columns)
+        if self.timestamps is not None:
+            lengths.add(len(self.timestamps))
+        if len(lengths) > 1:
+            raise ValueError("Telemetry values and timestamps must all be the "
+                             "same length")
+
+    def __len__(self):
+        return sum(len(values) for _, values in self.columns)
+
+    def items(self):
+        """
+        Generate (name, value, timestamp) for every sample in the block
+        """
+
+        for name, value, _, timestamp in self.samples():
+            yield name, value, timestamp
+
+    def samples(self):
+        """
+        Generate (name, value, epoch, timestamp) for every sample in the
+        block. epoch is None if the time of the block was given as a string.
+        """
+
+        for name, values in self.columns:
+            if self.timestamps is None:
+                timestamp = self.timestamp
+                epoch = self.epoch if self.formatted is None else None
+                for value in values:
+                    yield name, value, epoch, timestamp
+            else:
+                for value, epoch in zip(values, self.timestamps):
+                    yield name, value, epoch, format_timestamp(epoch)
+
+    def to_record(self):
+        record = super(PublishTelemetryBlock, self).to_record()
+        record["columns"] = [(name, values.tolist())
+                             for name, values in self.columns]
+        if self.timestamps is not None:
+            record["timestamps"] = self.timestamps.tolist()
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        pub = super(PublishTelemetryBlock, cls).from_record(record)
+        pub.columns = [(name, array("d", values))
+                       for name, values in pub.columns]
+        if pub.timestamps is not None:
+            pub.timestamps = array("d", pub.timestamps)
+        return pub
+
+
+# Publish classes by type name, for restoring publishes from records
+PUBLISH_TYPES = {
+    "PublishAlarm":PublishAlarm,
+    "PublishAttribute":PublishAttribute,
+    "PublishLocation":PublishLocation,
+    "PublishLog":PublishLog,
+    "PublishTelemetry":PublishTelemetry,
+    "PublishTelemetryBlock":PublishTelemetryBlock
+}
+
+# Most recently formatted second, as (second, "%Y-%m-%dT%H:%M:%S"). Samples
+# arrive in time order, so this saves a strftime for almost every timestamp.
+# Replaced as a whole so it is safe to share between threads.
+_last_second = (None, None)
+
+def format_timestamp(epoch):
+    """
+    Format seconds since the epoch as a Cloud timestamp (TIME_FORMAT)
+    """
+
+    global _last_second
+
+    second = int(epoch // 1)
+    micro = int((epoch - second) * 1000000 + 0.5)
+    if micro >= 1000000:
+        second += 1
+        micro -= 1000000
+
+    cached_second, prefix = _last_second
+    if cached_second != second:
+        prefix = (EPOCH + timedelta(seconds=second)).strftime(
+            "%Y-%m-%dT%H:%M:%S")
+        _last_second = (second, prefix)
+    return "%s.%06dZ" % (prefix, micro)
+
+def publish_from_record(record):
+    """
+    Recreate a publish from the dict produced by Publish.to_record()
+    """
+
+    return PUBLISH_TYPES[record["type"]].from_record(record)
+
+def to_float_array(values):
+    """
+    Copy a sequence, array.array or NumPy array of numbers into an array of
+    doubles. NumPy arrays are copied without creating a Python float per value.
+    """
+
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        data = numpy.ascontiguousarray(values, dtype=numpy.float64).tobytes()
+        result = array("d")
+        # Python 2 arrays have no frombytes
+        if hasattr(result, "frombytes"):
+            result.frombytes(data)
+        else:
+            result.fromstring(data)
+        return result
+    return array("d", values)
+
+
 class Work(object):
     """
     Holds information about work that needs to be completed
     """
 
-    def __init__(self, work_type, data):
+    def __init__(self, work_type, data, priority=None):
         self.type = work_type
         self.data = data
+        if priority is None:
+            priority = constants.WORK_PRIORITIES.get(work_type,
+                                                     constants.PRIORITY_CONTROL)
+        self.priority = priority
+
+
+class WorkQueue(queue.Queue):
+    """
+    Work queue that can be waited on until it is empty
+    """
+
+    def wait_empty(self, timeout=None):
+        """
+        Wait until every queued item has been taken by a worker. Returns
+        True if the queue is empty.
+        """
 
+        # Queue.get notifies not_full every time an item is taken
+        with self.not_full:
+            if timeout is None:
+                while self._qsize():
+                    self.not_full.wait()
+            else:
+                end_time = monotonic() + timeout
+                while self._qsize():
+                    remaining = end_time - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_full.wait(remaining)
+            return not self._qsize()
+
+
+class PriorityWorkQueue(WorkQueue):
+    """
+    Work queue that hands out work by priority (lower first), and first in
+    first out within a priority. Work gains one priority level for every
+    aging seconds it has waited, so lower priorities are never starved. The
+    time work waits for a worker is recorded for each priority.
+    """
+
+    def __init__(self, maxsize=0, aging=None):
+        if aging is None:
+            aging = constants.DEFAULT_WORK_AGING
+        self.aging = aging
+        # queue.Queue is an old style class on Python 2
+        WorkQueue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        # (time queued, work) for each priority
+        self.levels = [deque() for _ in constants.PRIORITY_NAMES]
+        self.count = 0
+        # Work taken, total and longest wait in seconds for each priority
+        self.taken = [0] * len(self.levels)
+        self.wait_total = [0.0] * len(self.levels)
+        self.wait_max = [0.0] * len(self.levels)
+
+    def _qsize(self):
+        return self.count
+
+    def _put(self, item):
+        priority = getattr(item, "priority", constants.PRIORITY_CONTROL)
+        priority = min(max(priority, 0), len(self.levels) - 1)
+        self.levels[priority].append((monotonic(), item))
+        self.count += 1
+
+    def _get(self):
+        now = monotonic()
+        best = None
+        best_key = None
+        for priority, level in enumerate(self.levels):
+            if not level:
+                continue
+            queued = level[0][0]
+            # Older work is picked first among equal effective priorities
+            effective = priority
+            if self.aging:
+                effective -= int((now - queued) / self.aging)
+            key = (effective, queued)
+            if best_key is None or key < best_key:
+                best = priority
+                best_key = key
+        queued, item = self.levels[best].popleft()
+        self.count -= 1
+
+        waited = now - queued
+        self.taken[best] += 1
+        self.wait_total[best] += waited
+        if waited > self.wait_max[best]:
+            self.wait_max[best] = waited
+        return item
+
+    def oldest_wait(self):
+        """
+        Return how many seconds the oldest queued work has waited, or None if
+        the queue is empty
+        """
+
+        with self.mutex:
+            queued = [level[0][0] for level in self.levels if level]
+        if not queued:
+            return None
+        return monotonic() - min(queued)
+
+    def stats(self):
+        """
+        Return the queued work, work taken and mean and longest wait in
+        seconds for each priority
+        """
 
+        with self.mutex:
+            stats = {}
+            for priority, name in enumerate(constants.PRIORITY_NAMES):
+                taken = self.taken[priority]
+                stats[name] = {
+                    "queued":len(self.levels[priority]),
+                    "taken":taken,
+                    "wait_mean":self.wait_total[priority] / taken if taken
+                                else 0.0,
+                    "wait_max":self.wait_max[priority]}
+            return stats
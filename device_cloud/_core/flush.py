@@ -0,0 +1,206 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the scheduler that decides when pending publishes are
+flushed to the Cloud
+"""
+
+import threading
+
+from device_cloud._core import constants
+from device_cloud._core.defs import monotonic
+
+
+class FlushScheduler(object):
+    """
+    Decides when the publish queue is flushed. A flush is started when
+    max_batch publishes are pending, when the oldest pending publish has waited
+    linger_ms, or straight away for urgent publishes (alarms). Only one flush
+    is in flight at a time; flush is called to start one and done() must be
+    called when it has finished. If flush does not return STATUS_SUCCESS (the
+    work queue was full) it is tried again after FLUSH_RETRY_DELAY seconds.
+    """
+
+    def __init__(self, publish_queue, flush, linger_ms=None, max_batch=None):
+        self.publish_queue = publish_queue
+        self.flush = flush
+        if linger_ms is None:
+            linger_ms = constants.DEFAULT_LINGER_MS
+        self.linger = linger_ms / 1000.0
+        self.max_batch = max_batch or constants.DEFAULT_MAX_BATCH
+
+        self.condition = threading.Condition()
+        self.in_flight = False
+        self.urgent = False
+        # When the oldest publish not yet covered by a flush was queued
+        self.first_pending = None
+        # Time before which a flush that could not be queued is not retried
+        self.retry_at = 0
+        self.running = False
+        self.thread = None
+
+        # Counters of flushes by what triggered them
+        self.flushes = {"full":0, "linger":0, "urgent":0}
+
+    def _dispatch(self, reason):
+        """
+        Start a flush. Must be called with the condition held.
+        """
+
+        self.in_flight = True
+        self.urgent = False
+        first_pending = self.first_pending
+        self.first_pending = None
+        if self.flush() != constants.STATUS_SUCCESS:
+            # Nothing will call done(), so the publishes stay pending
+            self.in_flight = False
+            self.first_pending = first_pending
+            self.retry_at = monotonic() + constants.FLUSH_RETRY_DELAY
+            return
+        self.retry_at = 0
+        self.flushes[reason] += 1
+
+    def _ready(self):
+        """
+        Reason a flush should start now, or None. Must be called with the
+        condition held.
+        """
+
+        if self.in_flight or self.first_pending is None:
+            return None
+        if monotonic() < self.retry_at:
+            return None
+        if self.urgent:
+            return "urgent"
+        if self.publish_queue.qsize() >= self.max_batch:
+            return "full"
+        if monotonic() >= self.first_pending + self.linger:
+            return "linger"
+        return None
+
+    def done(self):
+        """
+        Mark the flush in flight as finished, starting the next one if it is
+        already due
+        """
+
+        with self.condition:
+            self.in_flight = False
+            if self.first_pending is None and not self.publish_queue.empty():
+                # Publishes queued while the last flush was being dispatched
+                self.first_pending = monotonic()
+            reason = self._ready()
+            if reason:
+                self._dispatch(reason)
+            else:
+                self.condition.notify_all()
+
+    def notify(self, urgent=False):
+        """
+        Tell the scheduler a publish has been queued. Urgent publishes are
+        flushed as soon as no other flush is in flight.
+        """
+
+        with self.condition:
+            wake = self.first_pending is None
+            if wake:
+                self.first_pending = monotonic()
+            if urgent:
+                self.urgent = True
+            reason = self._ready()
+            if reason:
+                self._dispatch(reason)
+            elif wake:
+                # New linger deadline
+                self.condition.notify_all()
+
+    def run(self):
+        """
+        Start flushes when the linger deadline expires
+        """
+
+        with self.condition:
+            while self.running:
+                timeout = None
+                if not self.in_flight and self.first_pending is not None:
+                    timeout = max(self.first_pending + self.linger,
+                                  self.retry_at) - monotonic()
+                    if timeout <= 0:
+                        self._dispatch("linger")
+                        continue
+                self.condition.wait(timeout)
+
+    def start(self):
+        """
+        Start the scheduler thread
+        """
+
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stats(self):
+        """
+        Return counts of flushes by trigger
+        """
+
+        with self.condition:
+            return dict(self.flushes)
+
+    def wait_idle(self, timeout=None):
+        """
+        Flush everything pending straight away, and wait until no flush is in
+        flight and nothing is pending, or for at most timeout seconds (None
+        for no limit). Returns True if the scheduler is idle.
+        """
+
+        end_time = None
+        if timeout is not None:
+            end_time = monotonic() + timeout
+        with self.condition:
+            while self.in_flight or self.first_pending is not None:
+                if not self.in_flight:
+                    self.urgent = True
+                    reason = self._ready()
+                    if reason:
+                        self._dispatch(reason)
+                        continue
+                wait_time = None
+                if end_time is not None:
+                    wait_time = end_time - monotonic()
+                    if wait_time <= 0:
+                        return False
+                if not self.in_flight:
+                    # Wait for the flush to be retried
+                    retry = max(self.retry_at - monotonic(), 0)
+                    if wait_time is None or retry < wait_time:
+                        wait_time = retry
+                self.condition.wait(wait_time)
+            return True
+
+    def stop(self):
+        """
+        Stop the scheduler thread
+        """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -15,7 +15,7 @@
 This module handles all the underlying functionality of the Client
 """
 
-import json
+import itertools
 import logging
 import logging.handlers
 import os
@@ -33,9 +33,11 @@ import ssl
 import sys
 import threading
 from binascii import crc32
+from collections import OrderedDict
+from collections import deque
 from datetime import datetime
-from datetime import timedelta
 from time import sleep
+
 import requests
 
 # for debugging only, uncomment the following two lines
@@ -44,10 +46,25 @@ import requests
 
 import paho.mqtt.client as mqttlib
 
+from device_cloud._core import codec
 from device_cloud._core import constants
 from device_cloud._core import defs
+from device_cloud._core import procpool
 from device_cloud._core import tr50
+from device_cloud._core.aggregate import Aggregator
+from device_cloud._core.batch import BatchBuilder
+from device_cloud._core.cache import ValueCache
+from device_cloud._core.defs import monotonic
+from device_cloud._core.flush import FlushScheduler
+from device_cloud._core.journal import Journal
+from device_cloud._core.logqueue import QueuedLogHandler
+from device_cloud._core.procpool import ActionCrashed
+from device_cloud._core.procpool import ActionProcessPool
+from device_cloud._core.pubqueue import PublishQueue
+from device_cloud._core.ratelimit import TokenBucket
 from device_cloud._core.tr50 import TR50Command
+from device_cloud._core.tracker import ReplyTracker
+from device_cloud._core.workpool import WorkPool
 
 original_socket = socket.socket
 
@@ -56,6 +73,38 @@ if sys.version_info.major == 2:
 else:
     import queue
 
+# Command to read the current value of each kind of key, and its description
+CURRENT_VALUE_COMMANDS = {
+    "attribute":(tr50.create_attribute_current, "Reading current attribute {}"),
+    "property":(tr50.create_property_get_current, "Reading current property {}")
+}
+
+# Publish types that can be sent without reply tracking, by config name
+NO_REPLY_TYPES = {
+    "alarm":["PublishAlarm"],
+    "attribute":["PublishAttribute"],
+    "location":["PublishLocation"],
+    "log":["PublishLog"],
+    "telemetry":["PublishTelemetry", "PublishTelemetryBlock"]
+}
+
+# Lists in replies to each command that are decoded one item at a time when
+# the reply is large, so they are never built in full
+STREAMED_REPLY_LISTS = {
+    TR50Command.mailbox_check:"params.messages"
+}
+
+# Topic of replies to requests sent without reply tracking
+NO_REPLY_TOPIC = "reply/" + constants.NO_REPLY_TOPIC_PREFIX
+
+# Commands that answer or service Cloud requests. These are sent using the
+# control rate limit so they are not held up behind publishes.
+CONTROL_COMMANDS = [
+    TR50Command.mailbox_ack,
+    TR50Command.mailbox_check,
+    TR50Command.mailbox_update
+]
+
 def status_string(error_code):
     """
     Return a string describing the error code
@@ -63,6 +112,15 @@ def status_string(error_code):
 
     return constants.STATUS_STRINGS[error_code]
 
+def remaining(end_time):
+    """
+    Seconds left until a monotonic end time, or None if there is no end time
+    """
+
+    if end_time is None:
+        return None
+    return max(end_time - monotonic(), 0)
+
 def is_valid_status(error_code):
     """
     Check if passed object is a valid status code
@@ -92,6 +150,7 @@ class Handler(object):
             self.logger = logging.getLogger("APP NAME HERE")
         log_formatter = logging.Formatter(constants.LOG_FORMAT,
                                           datefmt=constants.LOG_TIME_FORMAT)
+        log_handlers = []
         if not self.config.quiet:
             if self.config.use_syslog:
                 print ("Logging to syslog...")
@@ -99,12 +158,27 @@ class Handler(object):
             else:
                 log_handler = logging.StreamHandler()
             log_handler.setFormatter(log_formatter)
-            self.logger.addHandler(log_handler)
+            log_handlers.append(log_handler)
 
         if self.config.log_file:
             log_file_handler = logging.FileHandler(self.config.log_file)
             log_file_handler.setFormatter(log_formatter)
-            self.logger.addHandler(log_file_handler)
+            log_handlers.append(log_file_handler)
+
+        # Optionally write log output from a separate thread so that slow
+        # consoles, files or syslog never hold up MQTT or the workers
+        self.log_queue = None
+        log_queue_config = self.config.log_queue
+        if log_queue_config and log_handlers:
+            if not isinstance(log_queue_config, dict):
+                log_queue_config = defs.Config()
+            self.log_queue = QueuedLogHandler(
+                log_handlers, max_records=log_queue_config.max_records,
+                batch_records=log_queue_config.batch_records,
+                flush_interval=log_queue_config.flush_interval)
+            log_handlers = [self.log_queue]
+        for log_handler in log_handlers:
+            self.logger.addHandler(log_handler)
 
         # Ensure we're not missing required configuration information
         if not self.config.key or not self.config.cloud.token:
@@ -115,6 +189,9 @@ class Handler(object):
         self.logger.setLevel(logging.DEBUG)
         self.qos_level(self.config.qos_level)
 
+        # Log a single line per request and reply instead of one per command
+        self.log_compact = bool(self.config.log_compact)
+
         # Print configuration
         self.logger.debug("CONFIG:\n%s", self.config)
 
@@ -171,44 +248,198 @@ class Handler(object):
         # data
         self.callbacks = defs.Callbacks()
 
-        # Connection state of the Client
+        # Processes for actions registered with executor="process"
+        self.action_processes = ActionProcessPool(self.config.action_processes)
+
+        # Number of running invocations of each action, and requests waiting
+        # for an action's max_concurrent limit
+        self.action_lock = threading.Lock()
+        self.action_running = {}
+        self.action_pending = {}
+
+        # Functions that handle replies, by the TR50 command they reply to,
+        # and notifications, by topic
+        self.reply_handlers = defs.Dispatcher()
+        for command, function in (
+                (TR50Command.attribute_batch, self.reply_cache_publish),
+                (TR50Command.attribute_current, self.reply_current_value),
+                (TR50Command.diag_ping, self.reply_diag),
+                (TR50Command.diag_time, self.reply_diag),
+                (TR50Command.file_get, self.reply_file_get),
+                (TR50Command.file_put, self.reply_file_put),
+                (TR50Command.mailbox_check, self.reply_mailbox_check),
+                (TR50Command.property_batch, self.reply_cache_publish),
+                (TR50Command.property_current, self.reply_current_value)):
+            self.reply_handlers.add(command, function)
+        self.notify_handlers = defs.Dispatcher()
+        self.notify_handlers.add("mailbox_activity",
+                                 self.notify_mailbox_activity)
+
+        # Connection state of the Client, and a condition notified whenever
+        # it changes
+        self.state_changed = threading.Condition()
         self.state = constants.STATE_DISCONNECTED
 
         # Track last time the app was connected so keep alive can time out
         self.last_connected = datetime.utcnow()
 
-        # Lock for thread safety
+        # Lock for thread safety, and a condition notified when the last
+        # outstanding reply has been received
         self.lock = threading.Lock()
+        self.replies_done = threading.Condition(self.lock)
 
-        # Queue for any pending publishes (number, string, location, etc.)
-        self.publish_queue = queue.Queue()
+        # JSON library for TR50 messages
+        if self.config.json_codec:
+            try:
+                codec.set_codec(self.config.json_codec)
+            except (ImportError, ValueError) as error:
+                self.logger.error("Cannot use JSON codec %s: %s",
+                                  self.config.json_codec, error)
+                raise
+        self.logger.debug("Using %s for JSON", codec.codec_name())
+
+        # Queue for any pending publishes (number, string, location, etc.).
+        # Optionally backed by an on-disk journal so that pending publishes
+        # survive a restart.
+        journal = None
+        journal_config = self.config.publish_journal
+        if journal_config and journal_config.path:
+            journal_path = journal_config.path
+            if not os.path.isabs(journal_path):
+                journal_path = os.path.join(self.config.config_dir or ".",
+                                            journal_path)
+            try:
+                journal = Journal(journal_path,
+                                  sync=journal_config.sync,
+                                  commit_items=journal_config.commit_items,
+                                  commit_interval=journal_config.commit_interval,
+                                  max_bytes=journal_config.max_bytes)
+            except Exception as error:
+                self.logger.error("Failed to open publish journal %s: %s",
+                                  journal_path, str(error))
+                raise
+        queue_config = self.config.publish_queue or defs.Config()
+        max_items = queue_config.max_items
+        if max_items is None:
+            max_items = constants.DEFAULT_PUBLISH_QUEUE_MAX_ITEMS
+        max_bytes = queue_config.max_bytes
+        if max_bytes is None:
+            max_bytes = constants.DEFAULT_PUBLISH_QUEUE_MAX_BYTES
+        self.publish_queue = PublishQueue(journal, max_items=max_items,
+                                          max_bytes=max_bytes,
+                                          overflow=queue_config.overflow,
+                                          block_timeout=queue_config.block_timeout)
+
+        # Windowed aggregation of telemetry
+        agg_config = self.config.telemetry_aggregation or defs.Config()
+        self.aggregator = Aggregator(window=agg_config.window,
+                                     slide=agg_config.slide,
+                                     stats=agg_config.stats,
+                                     keys=agg_config.per_key)
+
+        # Last known telemetry and attribute values, so that reads of fresh
+        # values do not need the Cloud
+        self.value_cache = None
+        cache_config = self.config.value_cache
+        if cache_config:
+            if not isinstance(cache_config, dict):
+                cache_config = defs.Config()
+            self.value_cache = ValueCache(ttl=cache_config.ttl,
+                                          max_keys=cache_config.max_keys)
+
+        # Decides when pending publishes are sent
+        self.flush_scheduler = FlushScheduler(self.publish_queue,
+                                              self.queue_flush,
+                                              linger_ms=self.config.linger_ms,
+                                              max_batch=self.config.max_batch)
 
         # Dicts to track which messages sent out have not received replies. Also
         # stores any actions to be taken when the reply is received.
-        self.reply_tracker = defs.OutTracker()
-        self.no_reply = []
+        tracker_config = self.config.reply_tracking or defs.Config()
+        self.reply_tracker = ReplyTracker(
+            timeout=tracker_config.timeout,
+            max_messages=tracker_config.max_messages,
+            retransmit=tracker_config.retransmit,
+            max_retransmits=tracker_config.max_retransmits)
+        # Publish types sent at QoS 0 without waiting for replies, and the
+        # counter for their topics
+        self.no_reply = set()
+        for name in self.config.no_reply or []:
+            if name not in NO_REPLY_TYPES:
+                self.logger.error("Unknown no_reply publish type \"%s\". "
+                                  "Supported types are %s", name,
+                                  "/".join(sorted(NO_REPLY_TYPES)))
+                raise KeyError("Unknown no_reply publish type "
+                               "\"{}\"".format(name))
+            self.no_reply.update(NO_REPLY_TYPES[name])
+        self.no_reply_counter = itertools.count(1)
 
         # Counter to allow every message to be sent on a unique topic
         self.topic_counter = 1
 
+        # Rate limiters to keep requests under the Cloud's API/s threshold.
+        # Control messages (mailbox acks, updates and checks) have their own
+        # budget so they are not delayed by a backlog of publishes.
+        self.api_limiter = TokenBucket(self.config.api_rate,
+                                       self.config.api_burst)
+        self.control_limiter = TokenBucket(self.config.control_rate,
+                                           self.config.control_burst)
+
         # Flag for notifying client to exit
         self.to_quit = True
 
-        # Telemetry Response Flag
-        self.pub_wait = self.pub_response = False
-        self.pub_topic = '0000'
+        # Futures of callers waiting for a reply, so they can be woken if
+        # the Client stops before the reply arrives
+        self.reply_waiters = set()
 
-        # Thread trackers. Main thread for handling MQTT loop, and worker
-        # threads for everything else.
+        # Main thread for handling MQTT loop
         self.main_thread = None
-        self.worker_threads = []
-
-        # Queue to track any pending work (parsing messages, actions,
-        # publishing, file transfer, etc.)
-        self.work_queue = queue.Queue()
 
-        # store any requested data here
-        self.response = {}
+        # Pools of worker threads for everything else, each with its own queue
+        # of pending work, so that slow actions or file transfers cannot hold
+        # up received messages or publishing. actions is sized by
+        # thread_count. A pool can be a fixed number of threads or a dict
+        # with min and max threads to grow and shrink with the load.
+        default_threads = dict(constants.DEFAULT_WORK_POOL_THREADS)
+        default_threads["actions"] = self.config.thread_count
+        if default_threads["actions"] is None:
+            default_threads["actions"] = constants.DEFAULT_THREAD_COUNT
+        pool_sizes = dict(default_threads)
+        if self.config.work_pools:
+            pool_sizes.update(self.config.work_pools)
+        # Work in each pool is handled by priority: Cloud notifications and
+        # actions first, then replies, publishes and file transfers
+        queue_config = self.config.work_queue or defs.Config()
+        self.pools = {}
+        for name in set(constants.WORK_POOLS.values()):
+            size = pool_sizes[name]
+            if not isinstance(size, dict):
+                size = defs.Config()
+                size.min = pool_sizes[name]
+            threads = size.min
+            if threads is None:
+                threads = default_threads[name]
+            if name == "messages":
+                # Replies must always be handled, whatever else is running
+                threads = max(1, threads)
+            self.pools[name] = WorkPool(name, self.handle_work, threads,
+                                        self.logger,
+                                        loop_time=self.config.loop_time,
+                                        max_queued=queue_config.max_items,
+                                        aging=queue_config.aging,
+                                        max_threads=size.max,
+                                        grow_wait=size.grow_wait,
+                                        idle_time=size.idle_time)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        with self.state_changed:
+            self._state = state
+            self.state_changed.notify_all()
 
     def action_deregister(self, action_name):
         """
@@ -231,10 +462,9 @@ class Handler(object):
         """
 
         cmd = tr50.create_mailbox_ack(request_id, error_code, error_message)
-        message = defs.OutMessage(cmd, "Action Acknowledge "
-                                       "{} {}: \"{}\"".format(request_id,
-                                                              error_code,
-                                                              error_message))
+        message = defs.OutMessage(cmd, "Action Acknowledge {} {}: \"{}\"",
+                                  description_args=(request_id, error_code,
+                                                    error_message))
         return self.send(message)
 
     def action_progress_update(self, request_id, message):
@@ -243,18 +473,35 @@ class Handler(object):
         """
 
         cmd = tr50.create_mailbox_update(request_id, message)
-        message = defs.OutMessage(cmd, "Update Action Progress "
-                                  "{} \"{}\"".format(request_id, message))
+        message = defs.OutMessage(cmd, "Update Action Progress {} \"{}\"",
+                                  description_args=(request_id, message))
         return self.send(message)
 
     def action_register_callback(self, action_name, callback_function,
-                                 user_data=None):
+                                 user_data=None, executor=None):
         """
         Associate a callback function with an action in the Cloud
         """
         status = constants.STATUS_SUCCESS
+        if executor not in (None, "thread", "process"):
+            self.logger.error("Unknown executor \"%s\" for action %s",
+                              executor, action_name)
+            return constants.STATUS_BAD_PARAMETER
+        if executor == "process":
+            if not procpool.available():
+                self.logger.error("Cannot run action %s in a process. "
+                                  "Requires concurrent.futures", action_name)
+                return constants.STATUS_NOT_SUPPORTED
+            try:
+                procpool.check_picklable((callback_function, user_data))
+            except Exception as error:
+                self.logger.error("Cannot run action %s in a process. "
+                                  "Callback and user data must be picklable: "
+                                  "%s", action_name, error)
+                return constants.STATUS_BAD_PARAMETER
+
         action = defs.Action(action_name, callback_function, self.client,
-                             user_data=user_data)
+                             user_data=user_data, executor=executor)
         try:
             self.callbacks.add_action(action)
             self.logger.info("Registered action \"%s\" with function \"%s\"",
@@ -282,6 +529,34 @@ class Handler(object):
 
         return status
 
+    def callback_deregister(self, dispatcher, name, callback_function):
+        """
+        Remove an application callback from the reply or notification
+        dispatcher
+        """
+
+        status = constants.STATUS_SUCCESS
+
+        try:
+            dispatcher.remove(name, callback_function)
+        except KeyError as error:
+            self.logger.error(str(error))
+            status = constants.STATUS_NOT_FOUND
+
+        return status
+
+    def callback_register(self, dispatcher, name, callback_function,
+                          user_data=None):
+        """
+        Add an application callback to the reply or notification dispatcher
+        """
+
+        dispatcher.add(name, defs.DispatchCallback(callback_function,
+                                                   self.client, user_data))
+        self.logger.info("Registered \"%s\" with function \"%s\"", name,
+                         callback_function.__name__)
+        return constants.STATUS_SUCCESS
+
     def connect(self, timeout=0):
         """
         Connect to MQTT and start main thread
@@ -297,8 +572,6 @@ class Handler(object):
             status = constants.STATUS_BAD_PARAMETER
 
         else:
-            current_time = datetime.utcnow()
-            end_time = current_time + timedelta(seconds=timeout)
             self.state = constants.STATE_CONNECTING
 
             # Add network check and poll here while it is not
@@ -359,10 +632,9 @@ class Handler(object):
             self.main_thread.start()
 
             # Wait for cloud connection
-            while ((timeout == 0 or current_time < end_time) and
-                   self.state == constants.STATE_CONNECTING):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            self.wait_for(self.state_changed,
+                          lambda: self.state != constants.STATE_CONNECTING,
+                          timeout or None)
 
             # Still connecting, timed out
             if self.state == constants.STATE_CONNECTING:
@@ -373,12 +645,28 @@ class Handler(object):
             # Connected Successfully
             status = constants.STATUS_SUCCESS
 
+            # Publish anything left in the journal by a previous session
+            restored = self.publish_queue.replay()
+            if restored:
+                self.logger.info("Restored %d pending publishes from journal",
+                                 restored)
+
             # Start worker threads if we have successfully connected
-            for _ in range(self.config.thread_count):
-                self.worker_threads.append(threading.Thread(
-                    target=self.handle_work_loop))
-            for thread in self.worker_threads:
-                thread.start()
+            for pool in self.pools.values():
+                pool.start()
+            self.flush_scheduler.start()
+            if restored:
+                self.flush_scheduler.notify()
+
+            # Fill the value cache. Replies are cached as they arrive.
+            if self.value_cache:
+                cache_config = self.config.value_cache
+                if isinstance(cache_config, dict):
+                    for kind, keys in (
+                            ("property", cache_config.prefetch_telemetry),
+                            ("attribute", cache_config.prefetch_attributes)):
+                        if keys:
+                            self.request_current_values(kind, list(keys))
 
         else:
             # Not connected. Stop main loop.
@@ -397,40 +685,102 @@ class Handler(object):
         Stop threads and shut down MQTT client
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
+        end_time = None
+        if timeout:
+            end_time = monotonic() + timeout
 
-        # Publish any data that was queued before disconnecting
-        if not self.publish_queue.empty():
-            self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+        # Publish any data that was queued before disconnecting, including
+        # partial aggregation windows. A flush already in flight is waited for,
+        # as well as the flush of anything queued while it was running.
+        worker = any(pool.is_worker() for pool in self.pools.values())
+        self.queue_aggregates(self.aggregator.flush())
+        if self.flush_scheduler.running and not worker:
+            self.flush_scheduler.wait_idle(remaining(end_time))
+        elif not self.publish_queue.empty():
+            self.flush_scheduler.notify(urgent=True)
 
         # Wait for pending work that has not been dealt with
         self.logger.info("Disconnecting...")
-        while ((timeout == 0 or current_time < end_time) and
-               not self.work_queue.empty()):
-            sleep(0.1)
-            current_time = datetime.utcnow()
+        for pool in self.pools.values():
+            pool.wait_empty(remaining(end_time))
+
+        # Requests still waiting for a concurrency slot will not run
+        with self.action_lock:
+            pending = [request for requests in self.action_pending.values()
+                       for request in requests]
+            self.action_pending.clear()
+        for action_request in pending:
+            self.reject_action(action_request, "ERROR: Client disconnecting")
 
         # Optionally wait for any outstanding replies.
         if wait_for_replies and self.is_connected():
             self.logger.info("Waiting for replies...")
-            while ((timeout == 0 or current_time < end_time) and
-                   len(self.reply_tracker) != 0):
-                sleep(0.1)
-                current_time = datetime.utcnow()
+            self.wait_for(self.replies_done,
+                          lambda: len(self.reply_tracker) == 0,
+                          remaining(end_time))
 
         self.to_quit = True
         #TODO: Kill any hanging threads
-        if threading.current_thread() not in self.worker_threads:
+        if not worker:
             if self.main_thread:
                 self.main_thread.join()
                 self.main_thread = None
 
+        # Write out buffered log output, even if the main loop never ran or
+        # is still stopping
+        if self.log_queue:
+            self.log_queue.flush()
+
         return constants.STATUS_SUCCESS
 
-    def handle_action(self, action_request):
+    def action_done(self, action_name):
         """
-        Handle action execution requests from Cloud
+        Release an action's concurrency slot, and queue the next request for
+        that action if any are waiting for a slot
+        """
+
+        action_request = None
+        with self.action_lock:
+            self.action_running[action_name] -= 1
+            pending = self.action_pending.get(action_name)
+            if pending:
+                action_request = pending.popleft()
+        if action_request is None:
+            return
+
+        action_request.requeued = True
+        status = self.queue_work(defs.Work(constants.WORK_ACTION,
+                                           action_request))
+        if status != constants.STATUS_SUCCESS:
+            self.reject_action(action_request, "ERROR: Work queue full")
+
+    def reject_action(self, action_request, error_message):
+        """
+        Tell the Cloud to try an action request again later
+        """
+
+        return self.ack_action(action_request, constants.STATUS_TRY_AGAIN,
+                               {"mail_id":action_request.request_id,
+                                "error_message":error_message})
+
+    def action_limit(self, action_name):
+        """
+        Return the limits (timeout, max_concurrent and when_busy) for an
+        action, from its entry in action_limits or the default entry
+        """
+
+        limits = defs.Config()
+        limits.when_busy = constants.DEFAULT_ACTION_WHEN_BUSY
+        if self.config.action_limits:
+            for name in ("default", action_name):
+                if isinstance(self.config.action_limits.get(name), dict):
+                    limits.update(self.config.action_limits[name])
+        return limits
+
+    def execute_action(self, action_request):
+        """
+        Run an action callback and return its result code and the arguments
+        of the mailbox acknowledgement
         """
 
         result_code = -1
@@ -440,7 +790,19 @@ class Handler(object):
 
         try:
             # Execute callback
-            action_result = self.callbacks.execute_action(action_request)
+            action = self.callbacks.get(action_request.name)
+            if action is not None and action.executor == "process":
+                action_result = self.action_processes.run(action,
+                                                          action_request)
+            else:
+                action_result = self.callbacks.execute_action(action_request)
+
+        except ActionCrashed as error:
+            # The callback's process died. The Client carries on.
+            action_failed = True
+            self.logger.error(str(error))
+            result_code = constants.STATUS_EXECUTION_ERROR
+            result_args["error_message"] = "ERROR: {}".format(str(error))
 
         except Exception as error:
             # Error with action execution. Might not have been registered.
@@ -474,6 +836,84 @@ class Handler(object):
                 result_code = constants.STATUS_BAD_PARAMETER
                 result_args["error_message"] = "ERROR: " + error_string
 
+        return result_code, result_args
+
+    def execute_action_timeout(self, action_request, timeout):
+        """
+        Run an action callback on its own thread, waiting at most timeout
+        seconds for it. On timeout the action's cancel token is cancelled and
+        the callback is left to finish on its own; its concurrency slot is
+        only released once it does.
+        """
+
+        result = []
+        done = threading.Event()
+        def run():
+            try:
+                result.append(self.execute_action(action_request))
+            finally:
+                self.action_done(action_request.name)
+                done.set()
+        thread = threading.Thread(target=run,
+                                  name="action-" + action_request.name)
+        thread.daemon = True
+        thread.start()
+
+        if done.wait(timeout) and result:
+            return result[0]
+
+        self.logger.error("Action %s timed out after %ss",
+                          action_request.name, timeout)
+        action_request.cancel_token.cancel()
+        error_message = "ERROR: Timed out after {}s".format(timeout)
+        return constants.STATUS_TIMED_OUT, {"mail_id":action_request.request_id,
+                                            "error_message":error_message}
+
+    def handle_action(self, action_request):
+        """
+        Handle action execution requests from Cloud
+        """
+
+        name = action_request.name
+        limits = self.action_limit(name)
+
+        # Wait for, or reject, requests beyond the action's concurrency limit
+        with self.action_lock:
+            running = self.action_running.get(name, 0)
+            if limits.max_concurrent and running >= limits.max_concurrent:
+                if limits.when_busy != "reject":
+                    self.logger.info("Action %s has %d running, queued "
+                                     "request", name, running)
+                    pending = self.action_pending.setdefault(name, deque())
+                    if action_request.requeued:
+                        # Lost its slot to a newer request, keep its place
+                        pending.appendleft(action_request)
+                    else:
+                        pending.append(action_request)
+                    return constants.STATUS_SUCCESS
+                running = None
+            else:
+                self.action_running[name] = running + 1
+
+        if running is None:
+            self.logger.error("Action %s has %d running, rejected request",
+                              name, limits.max_concurrent)
+            return self.reject_action(action_request, "ERROR: Too many running")
+        if limits.timeout:
+            result_code, result_args = self.execute_action_timeout(
+                action_request, limits.timeout)
+        else:
+            try:
+                result_code, result_args = self.execute_action(action_request)
+            finally:
+                self.action_done(name)
+        return self.ack_action(action_request, result_code, result_args)
+
+    def ack_action(self, action_request, result_code, result_args):
+        """
+        Send the result of an action request to the Cloud
+        """
+
         # Return status to Cloud
         # Check for invoked status.  If so, return mail box update not
         # ack.  Ack is the final notification.  This breaks triggers
@@ -498,32 +938,18 @@ class Handler(object):
         return status
 
     def handle_attribute_get(self, attribute_name ):
-        command = tr50.create_attribute_current(self.config.key, attribute_name)
-        message_desc = "Reading current attribute..."
-        message = defs.OutMessage(command, message_desc)
-
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
-
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'attribute_current_value' in self.response.keys():
-            value = self.response['attribute_current_value']
+        """
+        Read the current value of an attribute and wait for the Cloud to reply
+        """
+        results = self.handle_attribute_get_many([attribute_name])[1]
+        return results[attribute_name]
 
-        if 'attribute_current_timestamp' in self.response.keys():
-            timestamp = self.response['attribute_current_timestamp']
-        return ret, value, timestamp
+    def handle_attribute_get_many(self, attribute_names):
+        """
+        Read the current values of several attributes in as few requests as
+        possible
+        """
+        return self.read_current_values("attribute", attribute_names)
 
     def calc_file_checksum(self, file_name):
         """
@@ -796,40 +1222,71 @@ class Handler(object):
 
         status = constants.STATUS_NOT_SUPPORTED
 
-        msg_json = mqtt_message.json
-        if "notify/" in mqtt_message.topic:
+        # Only the size of raw payloads is logged. Decoding one here would
+        # build a large reply in full before it can be streamed.
+        if mqtt_message.payload is not None:
+            self.logger.debug("Received message on topic \"%s\" (%d bytes)",
+                              mqtt_message.topic, len(mqtt_message.payload))
+        elif self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Received message on topic \"%s\"\n%s",
+                              mqtt_message.topic,
+                              defs.LazyDump(mqtt_message.json,
+                                            self.log_compact))
+
+        if mqtt_message.topic.startswith("notify/"):
             # Received a notification
-            if mqtt_message.topic[len("notify/"):] == "mailbox_activity":
-                # Mailbox activity, send a request to check the mailbox
-                self.logger.info("Recevied notification of mailbox activity")
-                mailbox_check = tr50.create_mailbox_check(auto_complete=False)
-                to_send = defs.OutMessage(mailbox_check, "Mailbox Check")
-                self.send(to_send)
-                status = constants.STATUS_SUCCESS
+            name = mqtt_message.topic[len("notify/"):]
+            try:
+                if self.notify_handlers.dispatch(name, mqtt_message):
+                    status = constants.STATUS_SUCCESS
+            except Exception:
+                self.logger.exception("Failed to handle notification %s",
+                                      name)
+                status = constants.STATUS_FAILURE
 
-        elif "reply/" in mqtt_message.topic:
+        elif mqtt_message.topic.startswith("reply/"):
             # Received a reply to a previous message
             topic_num = mqtt_message.topic[len("reply/"):]
-            for command_num in msg_json:
-                reply = msg_json[command_num]
-
-                # Retrieve the sent message that this is a reply for, removing
-                # it from being tracked
-                self.lock.acquire()
-                try:
-                    sent_message = self.reply_tracker.pop_message(topic_num,
-                                                                  command_num)
-                except KeyError as error:
-                    self.logger.error(error.message)
-                    continue
-                finally:
-                    self.lock.release()
-                sent_command_type = sent_message.command.get("command")
+            def lazy_path(command_num):
+                sent_message = self.reply_tracker.get_message(topic_num,
+                                                              command_num)
+                if sent_message is not None:
+                    return STREAMED_REPLY_LISTS.get(sent_message.command_type)
+                return None
+            try:
+                received = list(mqtt_message.items(lazy_path))
+            except Exception as error:
+                self.logger.error("Failed to decode reply %s: %s", topic_num,
+                                  error)
+                return constants.STATUS_PARSE_ERROR
+
+            # Retrieve the sent messages that these are replies for, removing
+            # them from being tracked
+            replies = []
+            with self.lock:
+                for command_num, reply in received:
+                    try:
+                        sent_message = self.reply_tracker.pop_message(
+                            topic_num, command_num)
+                    except KeyError as error:
+                        self.logger.error(str(error))
+                        continue
+                    replies.append((command_num, sent_message, reply))
+                if len(self.reply_tracker) == 0:
+                    self.replies_done.notify_all()
+
+            succeeded = 0
+            for command_num, sent_message, reply in replies:
+                # Reply handlers and the error handler get the OutMessage
+                # that was sent, not the tracker's record of it
+                out_message = sent_message.to_message()
 
                 # Log success status of reply
                 if reply.get("success"):
-                    self.logger.info("Received success for %s-%s - %s",
-                                     topic_num, command_num, sent_message)
+                    succeeded += 1
+                    if not self.log_compact:
+                        self.logger.info("Received success for %s-%s - %s",
+                                         topic_num, command_num, sent_message)
                 else:
                     self.logger.error("Received failure for %s-%s - %s",
                                       topic_num, command_num, sent_message)
@@ -838,290 +1295,212 @@ class Handler(object):
                     if self.client.error_handler:
                         self.client.error_handler(
                         reply.get("errorCodes", []),
-                        sent_message,
+                        out_message,
                         str(reply))
 
-                # Return "success" status
-                if self.pub_wait:
-                    if self.pub_topic == topic_num:
-                        self.pub_response = reply.get("success")
-                        self.pub_wait = False
-                    else:
-                        self.pub_wait = self.pub_response = False
-
-                # Check what kind of message this is a reply to
-                if sent_command_type == TR50Command.file_get:
-                    # Recevied a reply for a file download request
-                    if reply.get("success"):
-                        file_id = reply["params"].get("fileId")
-                        file_checksum = reply["params"].get("crc32")
-                        file_size = reply["params"].get("fileSize")
-                        file_transfer = sent_message.data
-                        file_transfer.file_id = file_id
-                        file_transfer.file_checksum = file_checksum
-                        file_transfer.file_size = file_size
-                        work = defs.Work(constants.WORK_DOWNLOAD, file_transfer)
-                        self.queue_work(work)
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.file_put:
-                    # Received a reply for a file upload request
-                    if reply.get("success"):
-                        file_id = reply["params"].get("fileId")
-                        file_transfer = sent_message.data
-                        file_transfer.file_id = file_id
-                        work = defs.Work(constants.WORK_UPLOAD, file_transfer)
-                        self.queue_work(work)
-                    else:
-                        sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.mailbox_check:
-                    # Received a reply for a mailbox check
-                    if reply.get("success"):
-                        try:
-                            for mail in reply["params"]["messages"]:
-                                mail_command = mail.get("command")
-                                if mail_command == "method.exec":
-                                    # Action execute request in mailbox
-                                    mail_id = mail.get("id")
-                                    action_name = mail["params"].get("method")
-                                    action_params = mail["params"].get("params")
-                                    action_request = defs.ActionRequest(mail_id,
-                                                                        action_name,
-                                                                        action_params)
-                                    work = defs.Work(constants.WORK_ACTION,
-                                                     action_request)
-                                    self.queue_work(work)
-                        except:
-                            pass
-                elif sent_command_type == TR50Command.diag_time:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                        mill = reply["params"].get("time")
-                        print (datetime.fromtimestamp(mill/1000.0))
+                # Wake any callers waiting for this reply
+                for future in sent_message.futures:
+                    future.set(reply.get("success"), reply.get("params"),
+                               reply.get("errorCodes"))
+                self.release_journal(sent_message)
 
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        else:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.diag_ping:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       print ('*Connection Okay* \n')
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        else:
-                            sent_message.data.status = constants.STATUS_FAILURE
-
-                elif sent_command_type == TR50Command.property_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['telemetry_current_value'] = params.get("value")
-                       self.response['telemetry_current_timestamp'] = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
-                elif sent_command_type == TR50Command.attribute_current:
-                    # Recevied a reply for a ping request
-                    if reply.get("success"):
-                       params = reply.get("params")
-                       self.response['attribute_current_value']  = params.get("value")
-                       self.response['attribute_current_timestamp']  = params.get("ts")
-                    else:
-                        if -90008 in reply.get("errorCodes", []):
-                            sent_message.data.status = constants.STATUS_NOT_FOUND
-                        elif  sent_message.data != None:
-                            sent_message.data.status = constants.STATUS_FAILURE
+                # Handle the reply based on the command it is a reply to
+                try:
+                    self.reply_handlers.dispatch(sent_message.command_type,
+                                                 out_message, reply)
+                except Exception:
+                    self.logger.exception("Failed to handle reply for %s-%s",
+                                          topic_num, command_num)
+
+            if self.log_compact and succeeded:
+                self.logger.info("Received success for %s - %d commands",
+                                 topic_num, succeeded)
             status = constants.STATUS_SUCCESS
 
         return status
 
-    def handle_publish(self):
+    def notify_mailbox_activity(self, mqtt_message):
         """
-        Publish any pending publishes in the publish queue, or the cloud logger
+        Mailbox activity, send a request to check the mailbox
         """
 
-        status = constants.STATUS_SUCCESS
+        self.logger.info("Recevied notification of mailbox activity")
+        mailbox_check = tr50.create_mailbox_check(auto_complete=False)
+        to_send = defs.OutMessage(mailbox_check, "Mailbox Check")
+        self.send(to_send)
 
-        # Collect all pending publishes in publish queue
-        to_publish = []
-        while not self.publish_queue.empty():
-            try:
-                to_publish.append(self.publish_queue.get())
-            except queue.Empty:
-                break
+    def reply_current_value(self, sent_message, reply):
+        """
+        Received a current value, remember it
+        """
 
-        if to_publish:
-            # If pending publishes are found, parse into list for sending
-            messages = []
-            batch = {}
-            batch['PublishAlarm'] = []
-            batch['PublishAttribute'] = []
-            batch['PublishTelemetry'] = []
-            batch['PublishLocation'] = []
-            batch['PublishLog'] = []
-            for pub in to_publish:
-                message = None
-                # ------------------
-                # Alarms
-                # ------------------
-                if pub.type == "PublishAlarm":
-                    batch[pub.type].append(
-                        tr50.create_alarm_batch_item(
-                            pub.name,
-                            pub.state,
-                            pub.timestamp,
-                            pub.message,
-                            pub.republish))
-
-                # ------------------
-                # Attributes
-                # ------------------
-                elif pub.type == "PublishAttribute":
-                    batch[pub.type].append(
-                        tr50.create_attribute_batch_item(
-                            pub.name,
-                            pub.value,
-                            pub.timestamp))
-
-                elif pub.type == "PublishTelemetry":
-                    batch[pub.type].append(
-                        tr50.create_property_batch_item(
-                            pub.name,
-                            pub.value,
-                            pub.timestamp,
-                            corr_id=pub.corr_id))
-
-                # ------------------
-                # Location
-                # ------------------
-                elif pub.type == "PublishLocation":
-                    batch[pub.type].append(
-                        tr50.create_location_batch_item(
-                            pub.latitude,
-                            pub.longitude,
-                            pub.heading,
-                            pub.altitude,
-                            pub.speed,
-                            pub.accuracy,
-                            pub.fix_type,
-                            pub.timestamp))
-
-                # ------------------
-                # Event logs
-                # ------------------
-                elif pub.type == "PublishLog":
-                    command = tr50.create_log_publish(self.config.key,
-                                                      pub.message,
-                                                      timestamp=pub.timestamp)
-                    message_desc = "Log Publish {}".format(pub.message)
-                    message = defs.OutMessage(command, message_desc)
-
-                if message:
-                    messages.append(message)
-
-            # Send all publishes
-            if messages:
-                status = self.send(messages)
-
-            # send out batches
-            if batch['PublishAlarm']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_alarm_publish(self.config.key,
-                                                    "alarm_batch",
-                                                    "Alarm Batch",
-                                                    timestamp=timestamp,
-                                                    republish=False,
-                                                    batch=True)
-                message_desc = "Alarm Publish {}".format("alarm_batch")
-                message_desc += " : \"{}\"".format("Alarm Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['state'] = 0
-                batch_msg.command['params']['data'] = batch['PublishAlarm']
-                status = self.send(batch_msg)
-
-            if batch['PublishAttribute']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_attribute_publish(self.config.key,
-                                                        "attribute_batch",
-                                                        "Attribute Batch",
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Attribute Publish {}".format("attribute_batch")
-                message_desc += " : \"{}\"".format("Attribute Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['data'] = batch['PublishAttribute']
-                status = self.send(batch_msg)
-
-            if batch['PublishLocation']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_location_publish(self.config.key,
-                                                        "location_batch",
-                                                        "Location Batch",
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Location Publish {}".format("location_batch")
-                message_desc += " : \"{}\"".format("Location Batch")
-                batch_msg = defs.OutMessage(command, message_desc)
-                batch_msg.command['params']['data'] = batch['PublishLocation']
-                status = self.send(batch_msg)
-
-            if batch['PublishTelemetry']:
-                timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                command = tr50.create_property_publish(self.config.key,
-                                                        "property_batch",
-                                                        "Property Batch",
-                                                        corr_id=timestamp,
-                                                        timestamp=timestamp,
-                                                        batch=True)
-                message_desc = "Property Publish {}".format("property_batch")
-                message_desc += " : \"{}\"".format("Property Batch")
-                batch_msgs = defs.OutMessage(command, message_desc)
-                batch_msgs.command['params']['data'] =  batch['PublishTelemetry']
-                status = self.send(batch_msgs)
+        if reply.get("success") and self.value_cache:
+            kind = "attribute"
+            if sent_message.command["command"] == \
+                    TR50Command.property_current:
+                kind = "property"
+            params = reply.get("params") or {}
+            self.value_cache.put(kind, sent_message.command["params"]["key"],
+                                 params.get("value"), params.get("ts"))
 
-        return status
+    def reply_cache_publish(self, sent_message, reply):
+        """
+        The Cloud accepted published values, remember them
+        """
+
+        if reply.get("success"):
+            self.cache_values(sent_message)
 
-    def handle_work_loop(self):
+    def cache_values(self, message):
         """
-        Loop for worker threads to handle any items put on the work queue
+        Store the values published by a command in the value cache
         """
 
-        # Continuously loop while connected
-        while not self.to_quit:
-            work = None
+        if self.value_cache and message.cache_values:
+            for (kind, key), (value, timestamp) in \
+                    message.cache_values.items():
+                self.value_cache.put(kind, key, value, timestamp)
+
+    def reply_diag(self, sent_message, reply):
+        """
+        Received a reply for a ping or time request
+        """
+
+        if reply.get("success"):
+            if sent_message.command["command"] == TR50Command.diag_time:
+                mill = reply["params"].get("time")
+                print (datetime.fromtimestamp(mill/1000.0))
+            else:
+                print ('*Connection Okay* \n')
+        else:
+            if -90008 in reply.get("errorCodes", []):
+                sent_message.data.status = constants.STATUS_NOT_FOUND
+            else:
+                sent_message.data.status = constants.STATUS_FAILURE
+
+    def reply_file_get(self, sent_message, reply):
+        """
+        Recevied a reply for a file download request
+        """
+
+        if reply.get("success"):
+            file_id = reply["params"].get("fileId")
+            file_checksum = reply["params"].get("crc32")
+            file_size = reply["params"].get("fileSize")
+            file_transfer = sent_message.data
+            file_transfer.file_id = file_id
+            file_transfer.file_checksum = file_checksum
+            file_transfer.file_size = file_size
+            work = defs.Work(constants.WORK_DOWNLOAD, file_transfer)
+            self.queue_work(work)
+        else:
+            if -90008 in reply.get("errorCodes", []):
+                sent_message.data.status = constants.STATUS_NOT_FOUND
+            elif sent_message.data != None:
+                sent_message.data.status = constants.STATUS_FAILURE
+
+    def reply_file_put(self, sent_message, reply):
+        """
+        Received a reply for a file upload request
+        """
+
+        if reply.get("success"):
+            file_id = reply["params"].get("fileId")
+            file_transfer = sent_message.data
+            file_transfer.file_id = file_id
+            work = defs.Work(constants.WORK_UPLOAD, file_transfer)
+            self.queue_work(work)
+        else:
+            sent_message.data.status = constants.STATUS_FAILURE
+
+    def reply_mailbox_check(self, sent_message, reply):
+        """
+        Received a reply for a mailbox check
+        """
+
+        if reply.get("success"):
             try:
-                work = self.work_queue.get(timeout=self.config.loop_time)
-            except queue.Empty:
+                for mail in reply["params"]["messages"]:
+                    mail_command = mail.get("command")
+                    if mail_command == "method.exec":
+                        # Action execute request in mailbox
+                        mail_id = mail.get("id")
+                        action_name = mail["params"].get("method")
+                        action_params = mail["params"].get("params")
+                        action_request = defs.ActionRequest(mail_id,
+                                                            action_name,
+                                                            action_params)
+                        work = defs.Work(constants.WORK_ACTION,
+                                         action_request)
+                        self.queue_work(work)
+            except:
                 pass
-            # If work is retrieved from the queue, handle it based on type
-            if work:
+
+    def handle_publish(self):
+        """
+        Publish any pending publishes in the publish queue, or the cloud logger
+        """
+
+        # Only take what is queued now so that a steady stream of new publishes
+        # cannot keep this loop going forever. Requests are sent as they fill
+        # up, so the backlog is never built into one payload.
+        taken = []
+        try:
+            cache_values = self.value_cache is not None
+            builder = BatchBuilder(self.config.key, self.send,
+                                   max_bytes=self.config.max_payload_bytes,
+                                   max_items=self.config.max_batch_items,
+                                   cache_values=cache_values)
+            # Publishes that nobody waits for go without reply tracking if
+            # their type is configured for it
+            no_reply = None
+            if self.no_reply:
+                no_reply = BatchBuilder(self.config.key, self.send_no_reply,
+                                        max_bytes=self.config.max_payload_bytes,
+                                        max_items=self.config.max_batch_items,
+                                        cache_values=cache_values)
+            for _ in range(self.publish_queue.qsize()):
                 try:
-                    if work.type == constants.WORK_MESSAGE:
-                        self.handle_message(work.data)
-                    elif work.type == constants.WORK_PUBLISH:
-                        self.handle_publish()
-                    elif work.type == constants.WORK_ACTION:
-                        self.handle_action(work.data)
-                    elif work.type == constants.WORK_DOWNLOAD:
-                        self.handle_file_download(work.data)
-                    elif work.type == constants.WORK_UPLOAD:
-                        self.handle_file_upload(work.data)
-                except Exception:
-                    # Print traceback, but don't kill thread
-                    self.logger.exception("Exception:")
+                    pub = self.publish_queue.get_nowait()
+                except queue.Empty:
+                    break
+                # Keep the journal record until the requests carrying the
+                # publish have been sent, and then until they are answered
+                if pub.journal_id is not None:
+                    self.publish_queue.hold(pub.journal_id)
+                    taken.append(pub.journal_id)
+                if no_reply and pub.type in self.no_reply and not pub.future:
+                    no_reply.add(pub)
+                else:
+                    builder.add(pub)
+
+            status = builder.finish()
+            if no_reply:
+                no_reply_status = no_reply.finish()
+                if no_reply_status != constants.STATUS_SUCCESS:
+                    status = no_reply_status
+            return status
+        finally:
+            for row_id in taken:
+                self.publish_queue.release(row_id)
+            # Allow the next flush to start
+            self.flush_scheduler.done()
 
-        return constants.STATUS_SUCCESS
+    def handle_work(self, work):
+        """
+        Handle an item taken from a work queue based on its type
+        """
+
+        if work.type == constants.WORK_MESSAGE:
+            self.handle_message(work.data)
+        elif work.type == constants.WORK_PUBLISH:
+            self.handle_publish()
+        elif work.type == constants.WORK_ACTION:
+            self.handle_action(work.data)
+        elif work.type == constants.WORK_DOWNLOAD:
+            self.handle_file_download(work.data)
+        elif work.type == constants.WORK_UPLOAD:
+            self.handle_file_upload(work.data)
 
     def handle_ping(self):
         """
@@ -1176,36 +1555,160 @@ class Handler(object):
         status = self.send(message)
         return constants.STATUS_SUCCESS
 
-    def handle_telemetry_get(self, telem_name ):
+    def read_current_values(self, kind, keys):
+        """
+        Read the current values of "property" or "attribute" keys and wait for
+        all the replies. Fresh values in the value cache are used without
+        asking the Cloud. Returns a status and a dict of key to (status, value,
+        timestamp). The status is STATUS_SUCCESS if every key was read,
+        otherwise the status of the first key that was not.
+        """
+
+        results = {}
+        futures = OrderedDict()
+        for key in keys:
+            if key in results or key in futures:
+                continue
+            cached = None
+            if self.value_cache:
+                cached = self.value_cache.get(kind, key)
+            if cached:
+                results[key] = (constants.STATUS_SUCCESS,) + cached
+            else:
+                futures[key] = defs.ReplyFuture()
+
+        # Send every request before waiting for any replies
+        sent = self.request_current_values(kind, list(futures), futures)
+
+        # Wait for the replies against a single deadline
+        end_time = monotonic() + constants.DEFAULT_REPLY_TIMEOUT
+        for key, future in futures.items():
+            status = sent[key]
+            if status == constants.STATUS_SUCCESS:
+                status = self.wait_reply(future, remaining(end_time))
+            params = future.params or {}
+            results[key] = (status, params.get("value"), params.get("ts"))
+
+        overall = constants.STATUS_SUCCESS
+        for key in keys:
+            if results[key][0] != constants.STATUS_SUCCESS:
+                overall = results[key][0]
+                break
+        return overall, results
+
+    def request_current_values(self, kind, keys, futures=None):
         """
-        Add data to publish queue and wait for cloud response
+        Send one current value command per key, packed into as few requests
+        as max_batch_items allows. futures is an optional dict of key to the
+        ReplyFuture for its reply. Returns a dict of key to send status.
         """
-        command = tr50.create_property_get_current(self.config.key, telem_name)
-        message_desc = "Reading current property..."
-        message = defs.OutMessage(command, message_desc)
 
-        self.pub_wait = True
-        status = self.send(message)
-        value = None
-        timestamp = None
-
-        # Wait for response from sending to cloud
-        while self.pub_wait:
-            sleep(0.5)
-        # Convert to return codes
-        if self.pub_response:
-            ret = constants.STATUS_SUCCESS
-        else:
-            ret = constants.STATUS_FAILURE
+        create_command, description = CURRENT_VALUE_COMMANDS[kind]
+        messages = []
+        for key in keys:
+            command = create_command(self.config.key, key)
+            messages.append(defs.OutMessage(
+                command, description, description_args=(key,),
+                future=futures.get(key) if futures else None))
+
+        sent = {}
+        chunk = self.config.max_batch_items or constants.DEFAULT_MAX_BATCH_ITEMS
+        for start in range(0, len(messages), chunk):
+            status = self.send(messages[start:start + chunk])
+            for key in keys[start:start + chunk]:
+                sent[key] = status
+        return sent
+
+    def wait_transfer(self, transfer, timeout=0):
+        """
+        Wait for a file transfer to finish, for at most timeout seconds (0 for
+        no limit) or until the Client quits. Returns the status of the
+        transfer, or STATUS_TIMED_OUT if it has not finished.
+        """
 
-        # make sure the key exists or there will be a KeyError
-        # exception
-        if 'telemetry_current_value' in self.response.keys():
-            value = self.response['telemetry_current_value']
+        # Completion wakes this straight away. The slices are only so that
+        # quitting is noticed.
+        end_time = None
+        if timeout:
+            end_time = monotonic() + timeout
+        while not self.to_quit:
+            wait_time = remaining(end_time)
+            if wait_time == 0:
+                break
+            if wait_time is None:
+                wait_time = self.config.loop_time
+            if transfer.done.wait(min(wait_time, self.config.loop_time)):
+                break
 
-        if 'telemetry_current_timestamp' in self.response.keys():
-            timestamp = self.response['telemetry_current_timestamp']
-        return ret, value, timestamp
+        if transfer.status is None:
+            return constants.STATUS_TIMED_OUT
+        return transfer.status
+
+    def wait_for(self, condition, predicate, timeout=None):
+        """
+        Wait on condition until predicate is true, or for at most timeout
+        seconds (None for no limit). Returns the last value of predicate.
+        """
+
+        end_time = None
+        if timeout is not None:
+            end_time = monotonic() + timeout
+        with condition:
+            result = predicate()
+            while not result:
+                wait_time = remaining(end_time)
+                if wait_time == 0:
+                    break
+                condition.wait(wait_time)
+                result = predicate()
+            return result
+
+    def wait_reply(self, future, timeout=None):
+        """
+        Wait for the reply future was attached to. Returns STATUS_SUCCESS if
+        the Cloud reported success, STATUS_TIMED_OUT if there was no reply in
+        time (default: DEFAULT_REPLY_TIMEOUT seconds), STATUS_FULL if the
+        publish was shed from a full publish queue, otherwise STATUS_FAILURE.
+        """
+
+        if timeout is None:
+            timeout = constants.DEFAULT_REPLY_TIMEOUT
+
+        self.lock.acquire()
+        try:
+            if self.to_quit:
+                return constants.STATUS_FAILURE
+            self.reply_waiters.add(future)
+        finally:
+            self.lock.release()
+        try:
+            if not future.wait(timeout) or future.timed_out:
+                return constants.STATUS_TIMED_OUT
+        finally:
+            self.lock.acquire()
+            try:
+                self.reply_waiters.discard(future)
+            finally:
+                self.lock.release()
+        if future.dropped:
+            return constants.STATUS_FULL
+        if future.success:
+            return constants.STATUS_SUCCESS
+        return constants.STATUS_FAILURE
+
+    def handle_telemetry_get(self, telem_name ):
+        """
+        Read the current value of a property and wait for the Cloud to reply
+        """
+        results = self.handle_telemetry_get_many([telem_name])[1]
+        return results[telem_name]
+
+    def handle_telemetry_get_many(self, telem_names):
+        """
+        Read the current values of several properties in as few requests as
+        possible
+        """
+        return self.read_current_values("property", telem_names)
 
 
     def is_connected(self):
@@ -1277,9 +1780,14 @@ class Handler(object):
 
             self.mqtt.loop(timeout=self.config.loop_time)
 
-            # Make a work item to publish anything that's pending
-            if not self.publish_queue.empty():
-                self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+            # Publish aggregation windows that have ended
+            self.queue_aggregates(self.aggregator.expire())
+
+            # Commit the publish journal on its interval
+            self.publish_queue.sync()
+
+            # Retransmit or fail commands whose replies are overdue
+            self.check_replies()
 
         # One last loop to send out any pending messages
         self.mqtt.loop(timeout=0.1)
@@ -1287,20 +1795,98 @@ class Handler(object):
         # Disconnect MQTT
         self.mqtt.disconnect()
 
+        self.flush_scheduler.stop()
+
         # Wait for worker threads to finish.
-        for thread in self.worker_threads:
-            thread.join()
-        self.worker_threads = []
+        for pool in self.pools.values():
+            pool.stop()
+        self.action_processes.shutdown()
+
+        # Make sure the journal matches what is still queued
+        self.publish_queue.flush()
 
         # On disconnect, show all messages that never received replies
         if len(self.reply_tracker) > 0:
             self.logger.error("These messages never received a reply:")
-            for mid, message in self.reply_tracker.items():
-                self.logger.error(".... %s - %s", mid,
-                                  message.description)
+            for out_id, message in self.reply_tracker.items():
+                self.logger.error(".... %s - %s", out_id, message)
+                if message.data and getattr(message.data, "status", 0) is None:
+                    message.data.status = constants.STATUS_FAILURE
+            self.reply_tracker.clear()
+
+        # Wake callers still waiting for replies
+        self.lock.acquire()
+        try:
+            for future in self.reply_waiters:
+                future.cancel()
+            self.reply_waiters.clear()
+        finally:
+            self.lock.release()
+
+        # Write out any buffered log output
+        if self.log_queue:
+            self.log_queue.flush()
 
         return constants.STATUS_SUCCESS
 
+    def check_replies(self):
+        """
+        Send commands whose replies are overdue again if they can be, and fail
+        the rest
+        """
+
+        self.lock.acquire()
+        try:
+            retransmit, failed = self.reply_tracker.expire()
+            if len(self.reply_tracker) == 0 and (retransmit or failed):
+                self.replies_done.notify_all()
+        finally:
+            self.lock.release()
+
+        for message in failed:
+            self.reply_failed(message, "no reply")
+        if retransmit:
+            messages = []
+            for tracked in retransmit:
+                self.logger.warning("No reply for %s - %s, sending again",
+                                    tracked.out_id, tracked)
+                message = defs.OutMessage(
+                    tracked.command, tracked.description_format,
+                    data=tracked.data,
+                    description_args=tracked.description_args)
+                message.futures = tracked.futures
+                message.journal_ids = tracked.journal_ids
+                message.attempts = tracked.attempts + 1
+                messages.append(message)
+            self.send(messages)
+            for tracked in retransmit:
+                self.release_journal(tracked)
+
+    def reply_failed(self, message, reason):
+        """
+        Handle a tracked command that will never get a reply: wake anyone
+        waiting for it, fail its file transfer and call the error handler
+        """
+
+        self.logger.error("Giving up on %s - %s: %s", message.out_id, message,
+                          reason)
+        for future in message.futures:
+            future.expire()
+        self.release_journal(message)
+        if message.data and getattr(message.data, "status", 0) is None:
+            message.data.status = constants.STATUS_TIMED_OUT
+        if self.client and self.client.error_handler:
+            self.client.error_handler([], message.to_message(), reason)
+
+    def release_journal(self, message):
+        """
+        Release the journal records of the publishes in a sent command, now
+        that it has been answered or given up on
+        """
+
+        for row_id in message.journal_ids:
+            self.publish_queue.release(row_id)
+
     def num_unfinished(self):
         """
         Get number of unfulfilled requests
@@ -1339,21 +1925,26 @@ class Handler(object):
         Callback when MQTT Client receives a message
         """
 
-        message = defs.Message(msg.topic, json.loads(msg.payload.decode()))
-        self.logger.debug("Received message on topic \"%s\"\n%s", msg.topic,
-                          message)
+        # Replies to requests sent without reply tracking are dropped
+        # without decoding them
+        if msg.topic.startswith(NO_REPLY_TOPIC):
+            return
 
-        # Queue work to handle received message. Don't block main loop with this
-        # task.
-        work = defs.Work(constants.WORK_MESSAGE, message)
+        # Queue work to handle received message. Decoding is left to the
+        # workers so the network thread is never blocked by a large payload.
+        message = defs.Message(msg.topic, payload=msg.payload)
+        priority = None
+        if msg.topic.startswith("notify/"):
+            priority = constants.PRIORITY_CONTROL
+        work = defs.Work(constants.WORK_MESSAGE, message, priority=priority)
         self.queue_work(work)
 
     def on_publish(self, mqtt, userdata, mid):
         """
         Notify that a message has been published
         """
-        if self.reply_tracker != {}:
-            topic_num = self.reply_tracker.pop_mid(mid)
+        topic_num = self.reply_tracker.pop_mid(mid)
+        if topic_num:
             self.logger.debug("MQTT sent %s", topic_num)
 
     def qos_level(self, qos_level=None):
@@ -1368,48 +1959,106 @@ class Handler(object):
             self.logger.warning("qos_level invalid or not set, 1 used as default")
             self.qos_level = 1
 
-    def queue_publish(self, pub):
+    def aggregate_publish(self, pub):
         """
-        Place pub in the publish queue
+        Add a telemetry sample or block of samples to their aggregation windows
+        instead of publishing them. The statistics of any windows they close
+        are queued for publishing.
         """
 
-        self.publish_queue.put(pub)
-        return constants.STATUS_SUCCESS
+        try:
+            if pub.type == "PublishTelemetryBlock":
+                results = []
+                for name, values in pub.columns:
+                    results += self.aggregator.add_many(name, values,
+                                                        pub.timestamps)
+            else:
+                results = self.aggregator.add(pub.name, pub.value)
+        except (TypeError, ValueError):
+            self.logger.error("Cannot aggregate non-numeric telemetry")
+            return constants.STATUS_BAD_PARAMETER
+        return self.queue_aggregates(results)
+
+    def publish_stats(self):
+        """
+        Return counters describing the publish queue, flushes and rate
+        limiters
+        """
+
+        stats = self.publish_queue.stats()
+        stats["flushes"] = self.flush_scheduler.stats()
+        stats["rate_limits"] = {"api":self.api_limiter.stats(),
+                                "control":self.control_limiter.stats()}
+        return stats
+
+    def work_stats(self):
+        """
+        Return counters describing each work pool
+        """
+
+        return dict((name, pool.stats()) for name, pool in self.pools.items())
+
+    def queue_aggregates(self, results):
+        """
+        Place the results of closed aggregation windows in the publish queue
+        """
+
+        status = constants.STATUS_SUCCESS
+        for name, value, end in results:
+            pub = defs.PublishTelemetry(name, value, timestamp=end)
+            result = self.queue_publish(pub)
+            if result != constants.STATUS_SUCCESS:
+                status = result
+        return status
+
+    def queue_flush(self):
+        """
+        Place a work item to publish everything pending in the work queue
+        """
+
+        return self.queue_work(defs.Work(constants.WORK_PUBLISH, None))
+
+    def queue_publish(self, pub, urgent=False):
+        """
+        Place pub in the publish queue. Urgent publishes are flushed without
+        waiting for linger_ms. Returns STATUS_FULL if the queue was full and
+        pub was dropped.
+        """
+
+        status = self.publish_queue.put(pub)
+        if status == constants.STATUS_FULL:
+            self.logger.debug("Publish queue full (%s), dropped a publish",
+                              self.publish_queue.overflow)
+        self.flush_scheduler.notify(urgent)
+        return status
 
     def queue_work(self, work):
         """
-        Place work in the work queue
+        Place work in the queue of the pool that handles its type
         """
 
-        self.work_queue.put(work)
+        name = constants.WORK_POOLS[work.type]
+        try:
+            self.pools[name].put(work)
+        except queue.Full:
+            # Lost replies are retransmitted or failed by the reply tracker
+            self.logger.error("Work queue %s full, dropped work", name)
+            return constants.STATUS_FULL
         return constants.STATUS_SUCCESS
 
     def request_publish(self, data, cloud_response):
         """
-        Add data to publish queue and wait for cloud response
+        Add data to publish queue and optionally wait for cloud response.
+        Publishes waited on are sent without waiting for linger_ms.
         """
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=15)
-        timeout = False
 
-        self.pub_wait = cloud_response
-        status = self.queue_publish(data)
-        if cloud_response:
-            status = constants.STATUS_FAILURE
-            # Wait for response from sending to cloud
-            while self.pub_wait and not self.to_quit:
-                current_time = datetime.utcnow()
-                if (current_time > end_time):
-                    timeout = True
-                    break
-                else:
-                    sleep(0.5)
+        if not cloud_response:
+            return self.queue_publish(data)
 
-            # Convert to return codes
-            if self.pub_response:
-                status = constants.STATUS_SUCCESS
-            elif timeout:
-                status = constants.STATUS_TIMED_OUT
+        future = data.future = defs.ReplyFuture()
+        status = self.queue_publish(data, urgent=True)
+        if status == constants.STATUS_SUCCESS:
+            status = self.wait_reply(future)
         return status
 
     def request_download(self, file_name, file_dest, blocking=False,
@@ -1418,9 +2067,6 @@ class Handler(object):
         Request a C2D file transfer
         """
 
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
-
         self.logger.info("Request download of %s", file_name)
 
         # is file_dest the full path or the parent directory?
@@ -1439,15 +2085,7 @@ class Handler(object):
 
         # If blocking is set, wait for result of file transfer
         if status == constants.STATUS_SUCCESS and blocking:
-            while ((timeout == 0 or current_time < end_time) and
-                   transfer.status is None):
-                sleep(0.1)
-                current_time = datetime.utcnow()
-
-            if transfer.status is None:
-                status = constants.STATUS_TIMED_OUT
-            else:
-                status = transfer.status
+            status = self.wait_transfer(transfer, timeout)
 
         return status
 
@@ -1458,8 +2096,6 @@ class Handler(object):
         """
 
         status = constants.STATUS_SUCCESS
-        current_time = datetime.utcnow()
-        end_time = current_time + timedelta(seconds=timeout)
         transfer = None
 
         self.logger.info("Request upload of %s", file_path)
@@ -1506,18 +2142,51 @@ class Handler(object):
 
                 # If blocking is set, wait for result of file transfer
                 if status == constants.STATUS_SUCCESS and blocking:
-                    while ((timeout == 0 or current_time < end_time) and
-                           not self.to_quit and transfer.status is None):
-                        sleep(0.1)
-                        current_time = datetime.utcnow()
-
-                    if transfer.status is None:
-                        status = constants.STATUS_TIMED_OUT
-                    else:
-                        status = transfer.status
+                    status = self.wait_transfer(transfer, timeout)
 
         return status
 
+    def rate_limit(self, message_list):
+        """
+        Wait until the rate limiter for a request allows it to be sent
+        """
+
+        limiter = self.control_limiter
+        for msg in message_list:
+            if msg.command.get("command") not in CONTROL_COMMANDS:
+                limiter = self.api_limiter
+                break
+        waited = limiter.consume()
+        if waited:
+            self.logger.debug("Rate limit delayed request by %.3fs", waited)
+
+    def send_no_reply(self, message_list):
+        """
+        Send commands to the Cloud at QoS 0 without tracking them. The request
+        topic starts with NO_REPLY_TOPIC_PREFIX so that on_message can drop
+        the reply without decoding it. There is no reply to wait for, so
+        published values are cached once MQTT has queued them.
+        """
+
+        payload = tr50.generate_request_messages(message_list)
+        self.rate_limit(message_list)
+
+        topic_num = "{}{:0>4}".format(constants.NO_REPLY_TOPIC_PREFIX,
+                                      next(self.no_reply_counter))
+        result = self.mqtt.publish("api/{}".format(topic_num), payload,
+                                   qos=0)[0]
+        if result != 0:
+            self.logger.error("MQTT failed to queue %s (%s)", topic_num,
+                              result)
+            return constants.STATUS_FAILURE
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("MQTT queued %s without reply - %s", topic_num,
+                              defs.RequestSummary(message_list))
+        for message in message_list:
+            self.cache_values(message)
+        return constants.STATUS_SUCCESS
+
     def send(self, messages):
         """
         Send commands to the Cloud, and track them to wait for replies
@@ -1529,7 +2198,16 @@ class Handler(object):
             message_list = [messages]
 
         # Generate final request string
-        payload = tr50.generate_request([x.command for x in message_list])
+        payload = tr50.generate_request_messages(message_list)
+
+        # Wait for the rate limiter before taking the lock so that replies can
+        # still be handled while this request is held back
+        self.rate_limit(message_list)
+
+        # Publishes stay in the journal until the reply to their command
+        for msg in message_list:
+            for row_id in msg.journal_ids:
+                self.publish_queue.hold(row_id)
 
         # Lock to ensure all outgoing messages are tracked before handling
         # received messages
@@ -1541,13 +2219,8 @@ class Handler(object):
                 self.topic_counter += 1
                 if topic_num not in self.reply_tracker:
                     break
-            self.pub_topic = topic_num
-            # -----------------------------------------------------
+
             # Send payload over MQTT
-            # Add small delay here so that we don't cross the API/s
-            # threshold
-            # -----------------------------------------------------
-            sleep(self.client.idle_sleep)
             result, mid = self.mqtt.publish("api/{}".format(topic_num),
                                             payload, qos = self.qos_level)
 
@@ -1558,19 +2231,36 @@ class Handler(object):
             current_time = datetime.utcnow()
 
             # Track each message
+            dropped = []
             for num, msg in enumerate(message_list):
                 # Add timestamps and ids
                 msg.timestamp = current_time
                 msg.out_id = "{}-{}".format(topic_num, num+1)
 
-                self.reply_tracker.add_message(msg)
-                self.logger.info("MQTT queued %s-%d - %s\n%s", topic_num, num+1,
-                                 msg, json.dumps(msg.command, indent=2,
-                                                 sort_keys=True))
+                dropped.extend(self.reply_tracker.add_message(msg))
             status = constants.STATUS_SUCCESS
 
         finally:
             self.lock.release()
 
+        for msg in dropped:
+            self.reply_failed(msg, "dropped, too many commands waiting for "
+                              "replies")
+
+        # Log outside the lock. Descriptions and payloads are only rendered if
+        # the record is emitted, and payloads only at DEBUG.
+        if self.logger.isEnabledFor(logging.INFO):
+            if self.log_compact:
+                self.logger.info("MQTT queued %s - %s", topic_num,
+                                 defs.RequestSummary(message_list))
+            else:
+                for num, msg in enumerate(message_list):
+                    self.logger.info("MQTT queued %s-%d - %s", topic_num,
+                                     num+1, msg)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for num, msg in enumerate(message_list):
+                self.logger.debug("MQTT payload %s-%d\n%s", topic_num, num+1,
+                                  defs.LazyDump(msg.command, self.log_compact))
+
         return status
 
@@ -0,0 +1,200 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the on-disk journal used to keep pending publishes across
+restarts and connection outages
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from device_cloud._core import codec
+from device_cloud._core import constants
+from device_cloud._core.defs import monotonic
+
+
+# SQLite synchronous setting for each sync policy
+SYNC_MODES = {
+    "always":"FULL",
+    "batch":"FULL",
+    "off":"OFF"
+}
+
+
+class Journal(object):
+    """
+    Append-only store of pending publishes in an SQLite database (WAL mode).
+    Appends and removals are buffered in memory and written in a single
+    transaction (group commit) once commit_items records are pending or
+    commit_interval seconds have passed. With sync set to "always" every append
+    is committed immediately.
+    """
+
+    def __init__(self, path, sync=None, commit_items=None, commit_interval=None,
+                 max_bytes=None):
+        self.path = path
+        self.sync = sync or constants.DEFAULT_JOURNAL_SYNC
+        if self.sync not in SYNC_MODES:
+            raise ValueError("Invalid journal sync policy \"{}\". Supported "
+                             "policies are {}".format(self.sync,
+                                                      "/".join(SYNC_MODES)))
+        self.commit_items = commit_items or constants.DEFAULT_JOURNAL_COMMIT_ITEMS
+        if commit_interval is None:
+            commit_interval = constants.DEFAULT_JOURNAL_COMMIT_INTERVAL
+        self.commit_interval = commit_interval
+        self.max_bytes = max_bytes or 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous={}".format(SYNC_MODES[self.sync]))
+        self.db.execute("CREATE TABLE IF NOT EXISTS publish "
+                        "(id INTEGER PRIMARY KEY, data TEXT)")
+
+        # Size of every record on disk (or pending), oldest first, so the size
+        # cap can be enforced without querying the database
+        self.sizes = OrderedDict()
+        for row_id, size in self.db.execute("SELECT id, length(data) FROM "
+                                            "publish ORDER BY id"):
+            self.sizes[row_id] = size
+        self.size = sum(self.sizes.values())
+
+        # Records written before this session started are replayed once
+        self.next_id = (next(reversed(self.sizes)) + 1) if self.sizes else 1
+        self.session_start = self.next_id
+
+        self.pending_add = []
+        self.pending_remove = []
+        self.last_commit = monotonic()
+
+        # Number of records removed from disk to stay under max_bytes
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def append(self, record):
+        """
+        Add a record (a JSON serializable dict) and return its id
+        """
+
+        data = codec.dumps(record)
+        self.lock.acquire()
+        try:
+            row_id = self.next_id
+            self.next_id += 1
+            self.pending_add.append((row_id, data))
+            self.sizes[row_id] = len(data)
+            self.size += len(data)
+
+            # Enforce size cap by forgetting the oldest records
+            while self.max_bytes and self.size > self.max_bytes and \
+                    len(self.sizes) > 1:
+                old_id, old_size = self.sizes.popitem(last=False)
+                self.size -= old_size
+                self.pending_remove.append(old_id)
+                self.dropped += 1
+
+            if (self.sync == "always" or
+                    len(self.pending_add) >= self.commit_items):
+                self._commit()
+        finally:
+            self.lock.release()
+        return row_id
+
+    def close(self):
+        """
+        Commit anything pending and close the database
+        """
+
+        self.lock.acquire()
+        try:
+            self._commit()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+    def commit(self):
+        """
+        Write all pending appends and removals to disk
+        """
+
+        self.lock.acquire()
+        try:
+            self._commit()
+        finally:
+            self.lock.release()
+
+    def _commit(self):
+        """
+        Write all pending appends and removals in one transaction. Must be
+        called with the lock held.
+        """
+
+        self.last_commit = monotonic()
+        if not self.pending_add and not self.pending_remove:
+            return
+        self.db.execute("BEGIN")
+        try:
+            if self.pending_add:
+                self.db.executemany("INSERT INTO publish (id, data) "
+                                    "VALUES (?, ?)", self.pending_add)
+            if self.pending_remove:
+                self.db.executemany("DELETE FROM publish WHERE id = ?",
+                                    [(x,) for x in self.pending_remove])
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.pending_add = []
+        self.pending_remove = []
+
+    def load_previous(self):
+        """
+        Return (id, record) for every record left over from a previous session,
+        oldest first
+        """
+
+        self.lock.acquire()
+        try:
+            self._commit()
+            rows = self.db.execute("SELECT id, data FROM publish WHERE id < ? "
+                                   "ORDER BY id", (self.session_start,))
+            return [(row_id, codec.loads(data)) for row_id, data in rows]
+        finally:
+            self.lock.release()
+
+    def remove(self, row_id):
+        """
+        Forget a record once it has been handed off for publishing
+        """
+
+        self.lock.acquire()
+        try:
+            size = self.sizes.pop(row_id, None)
+            if size is not None:
+                self.size -= size
+                self.pending_remove.append(row_id)
+        finally:
+            self.lock.release()
+
+    def tick(self):
+        """
+        Commit pending changes if the commit interval has elapsed
+        """
+
+        if monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
@@ -0,0 +1,208 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the log handler that moves log output (console, file and
+syslog) off the MQTT and worker threads
+"""
+
+import logging
+import threading
+from collections import deque
+
+from device_cloud._core import constants
+
+
+class QueuedLogHandler(logging.Handler):
+    """
+    Log handler that places records in a bounded buffer and writes them to the
+    target handlers from its own thread, so logging never blocks on a slow
+    console, SD card or syslog socket. When the buffer is full new records are
+    dropped and counted, and a warning with the count is written once there is
+    room again. Messages are merged with their arguments when they are logged,
+    as logging.handlers.QueueHandler does, so the writer thread never reads
+    objects the caller may since have changed. The lines are formatted on the
+    writer thread, and stream and file targets receive each batch as a single
+    write. The handler is flushed and closed by logging.shutdown at exit.
+    """
+
+    def __init__(self, targets, max_records=None, batch_records=None,
+                 flush_interval=None):
+        logging.Handler.__init__(self)
+        self.targets = list(targets)
+        self.max_records = max_records or constants.DEFAULT_LOG_QUEUE_MAX_RECORDS
+        self.batch_records = (batch_records or
+                              constants.DEFAULT_LOG_QUEUE_BATCH_RECORDS)
+        if flush_interval is None:
+            flush_interval = constants.DEFAULT_LOG_QUEUE_FLUSH_INTERVAL
+        self.flush_interval = flush_interval
+
+        self.records = deque()
+        self.condition = threading.Condition()
+        # Records dropped since the last drop warning, and in total
+        self.dropped = 0
+        self.dropped_total = 0
+        # Number of records taken off the buffer but not yet written
+        self.writing = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        """
+        Merge the message with its arguments and render any exception, so the
+        record holds no references to the caller's objects
+        """
+
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.condition:
+            if len(self.records) >= self.max_records:
+                self.dropped += 1
+                self.dropped_total += 1
+                return
+            self.records.append(record)
+            if len(self.records) >= self.batch_records:
+                self.condition.notify_all()
+
+    def _take(self):
+        """
+        Remove and return every buffered record, adding a warning about
+        dropped records. Must be called with the condition held.
+        """
+
+        batch = list(self.records)
+        self.records.clear()
+        if self.dropped:
+            warning = logging.LogRecord(
+                batch[-1].name if batch else "logqueue", logging.WARNING,
+                __file__, 0, "Log buffer full, dropped %d log messages",
+                (self.dropped,), None)
+            batch.append(warning)
+            self.dropped = 0
+        self.writing = len(batch)
+        return batch
+
+    def _write(self, batch):
+        """
+        Write a batch of records to every target
+        """
+
+        for target in self.targets:
+            if isinstance(target, logging.StreamHandler):
+                self._write_stream(target, batch)
+            else:
+                for record in batch:
+                    if record.levelno >= target.level:
+                        target.handle(record)
+
+    def _write_stream(self, target, batch):
+        """
+        Write a batch of records to a stream or file handler with a single
+        write and flush
+        """
+
+        # Python 2 handlers have no terminator attribute
+        terminator = getattr(target, "terminator", "\n")
+        lines = []
+        for record in batch:
+            if record.levelno < target.level or not target.filter(record):
+                continue
+            try:
+                lines.append(target.format(record) + terminator)
+            except Exception:
+                target.handleError(record)
+        if not lines:
+            return
+        target.acquire()
+        try:
+            if target.stream is None and hasattr(target, "_open"):
+                # FileHandler opened with delay=True
+                target.stream = target._open()
+            target.stream.write("".join(lines))
+            target.flush()
+        except Exception:
+            target.handleError(batch[-1])
+        finally:
+            target.release()
+
+    def run(self):
+        """
+        Write buffered records in batches until the handler is closed
+        """
+
+        while True:
+            with self.condition:
+                if self.running and len(self.records) < self.batch_records:
+                    self.condition.wait(self.flush_interval)
+                if not self.records and not self.dropped:
+                    if not self.running:
+                        return
+                    continue
+                batch = self._take()
+            try:
+                self._write(batch)
+            finally:
+                with self.condition:
+                    self.writing = 0
+                    self.condition.notify_all()
+
+    def flush(self):
+        """
+        Wait until every record buffered so far has been written
+        """
+
+        with self.condition:
+            self.condition.notify_all()
+            while ((self.records or self.writing) and
+                   self.thread.is_alive()):
+                self.condition.wait(self.flush_interval)
+
+    def stats(self):
+        """
+        Return the number of buffered and dropped records
+        """
+
+        with self.condition:
+            return {"queued":len(self.records),
+                    "dropped":self.dropped_total}
+
+    def close(self):
+        """
+        Write everything still buffered, stop the writer thread and close the
+        target handlers
+        """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        for target in self.targets:
+            target.close()
+        logging.Handler.close(self)
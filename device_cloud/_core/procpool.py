@@ -0,0 +1,196 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the pool of processes that runs CPU heavy action
+callbacks outside the Client's process
+"""
+
+import multiprocessing
+import pickle
+import sys
+import threading
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import wait as wait_futures
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    # Python 2 without the futures package
+    ProcessPoolExecutor = None
+    BrokenProcessPool = None
+
+from device_cloud._core import defs
+
+
+class ActionCrashed(Exception):
+    """
+    The process running an action callback exited before it returned
+    """
+
+
+def available():
+    """
+    Check if process pools are supported on this system
+    """
+
+    return ProcessPoolExecutor is not None
+
+def check_picklable(callback):
+    """
+    Raise an error if callback cannot be sent to another process (eg. it is a
+    lambda, a nested function or a bound method of an unpicklable object)
+    """
+
+    pickle.dumps(callback)
+
+def _context():
+    """
+    Start pool processes with forkserver, or spawn where that does not exist.
+    A forked process would copy the Client's threads' locks, possibly while
+    they are held. Returns None where only fork is supported (Python 2).
+    """
+
+    if sys.version_info < (3, 7):
+        # ProcessPoolExecutor has no mp_context
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    for method in ("forkserver", "spawn"):
+        if method in methods:
+            return multiprocessing.get_context(method)
+    return None
+
+def _run(callback, arglen, params, user_data, request_id, name):
+    """
+    Run an action callback in a pool process. The client cannot be sent to
+    another process, so callbacks get None instead, and a cancel token that
+    is never cancelled.
+    """
+
+    request = defs.ActionRequest(request_id, name, params)
+    return defs.call_action(callback, arglen, None, request, user_data)
+
+
+class ActionProcessPool(object):
+    """
+    Runs action callbacks in a pool of processes, so that CPU heavy callbacks
+    do not hold the GIL while the Client publishes. Parameters, user data and
+    results are pickled. The processes are started when the first action
+    runs. If a process dies the pool is replaced and the action raises
+    ActionCrashed. If an action is cancelled (eg. it timed out) while running,
+    new actions go to a new pool and the old pool's processes are killed once
+    its other actions finish.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+        # Futures submitted to each executor that have not finished
+        self.futures = {}
+
+    def _new_executor(self):
+        """
+        Create a pool, with forkserver or spawn processes where supported
+        """
+
+        context = _context()
+        if context is None:
+            return ProcessPoolExecutor(self.processes)
+        return ProcessPoolExecutor(self.processes, mp_context=context)
+
+    def _finished(self, executor, future):
+        with self.lock:
+            futures = self.futures.get(executor)
+            if futures is not None:
+                futures.discard(future)
+
+    def _abandon(self, executor, future):
+        """
+        Stop waiting for a cancelled action. If it is already running, its
+        process can only be freed by killing it, so the pool is replaced and
+        killed once every other action in it finishes.
+        """
+
+        if future.cancel() or future.done():
+            return
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+            others = self.futures.pop(executor, set())
+            others.discard(future)
+        executor.shutdown(wait=False)
+        thread = threading.Thread(target=self._kill,
+                                  args=(executor, others),
+                                  name="action-pool-reaper")
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _kill(executor, others):
+        """
+        Kill an abandoned pool's processes after its other actions finish
+        """
+
+        if others:
+            wait_futures(others)
+        # ProcessPoolExecutor has no public way to stop a running call
+        processes = getattr(executor, "_processes", None) or {}
+        for process in list(processes.values()):
+            if process.is_alive():
+                process.terminate()
+
+    def run(self, action, request):
+        """
+        Run an action's callback in a pool process and return its result
+        """
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = self._new_executor()
+                self.futures[self.executor] = set()
+            executor = self.executor
+
+        try:
+            future = executor.submit(_run, action.callback, action.arg_count(),
+                                     request.params, action.user_data,
+                                     request.request_id, request.name)
+            with self.lock:
+                self.futures.setdefault(executor, set()).add(future)
+            future.add_done_callback(
+                lambda done: self._finished(executor, done))
+            cancel_token = getattr(request, "cancel_token", None)
+            if cancel_token is not None:
+                cancel_token.add_callback(
+                    lambda: self._abandon(executor, future))
+            return future.result()
+        except BrokenProcessPool as error:
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+                self.futures.pop(executor, None)
+            executor.shutdown(wait=False)
+            raise ActionCrashed("Process running action {} exited: {}".format(
+                request.name, error))
+
+    def shutdown(self):
+        """
+        Stop the pool processes once they finish any running callbacks
+        """
+
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+            self.futures.clear()
+        if executor:
+            executor.shutdown(wait=False)
@@ -0,0 +1,339 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the queue that holds pending publishes until they are sent
+to the Cloud
+"""
+
+import sys
+from collections import deque
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.defs import monotonic
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+# Supported behaviours when the queue is full
+OVERFLOW_POLICIES = [
+    "block",
+    "drop_newest",
+    "drop_oldest",
+    "coalesce"
+]
+
+# Rough per-publish overhead in bytes (object, queue entry and TR50 framing)
+PUBLISH_OVERHEAD = 200
+# Rough bytes per sample of a telemetry block (value, timestamp and framing)
+BLOCK_SAMPLE_SIZE = 60
+
+
+def approx_size(pub):
+    """
+    Rough number of bytes a publish takes up while queued
+    """
+
+    size = PUBLISH_OVERHEAD
+    if pub.type == "PublishTelemetryBlock":
+        for name, values in pub.columns:
+            size += (len(name) + BLOCK_SAMPLE_SIZE) * len(values)
+        return size
+    for attr in ("name", "value", "message"):
+        value = getattr(pub, attr, None)
+        if value is not None:
+            size += len(str(value))
+    return size
+
+def coalesce_key(pub):
+    """
+    Key identifying publishes that can replace one another when coalescing.
+    Alarms and logs are never coalesced.
+    """
+
+    if pub.type in ("PublishTelemetry", "PublishAttribute"):
+        return (pub.type, pub.name)
+    elif pub.type == "PublishLocation":
+        return (pub.type,)
+    return None
+
+def shed(pub):
+    """
+    Complete the reply future of a publish that will never be sent, if anything
+    is waiting on it
+    """
+
+    future = getattr(pub, "future", None)
+    if future is not None:
+        future.drop()
+
+
+class PublishQueue(queue.Queue):
+    """
+    FIFO queue of pending publishes, bounded by item count and approximate
+    bytes (0 is unbounded). What happens when it is full is decided by the
+    overflow policy:
+      block        wait up to block_timeout seconds for space, then drop the
+                   new publish
+      drop_newest  drop the new publish
+      drop_oldest  drop the oldest queued publishes to make space
+      coalesce     replace the queued publish with the same key (telemetry or
+                   attribute name) with the new one, otherwise drop the oldest
+
+    Anything waiting for the reply to a shed publish is woken straight away.
+
+    If a journal is given, every publish is also written to it, so anything
+    still queued or waiting for its reply survives a restart and is replayed on
+    the next connect. Publishes taken off the queue keep their journal record
+    (journal_id) until it is released as many times as it was held, once the
+    Cloud has replied to every request carrying the publish.
+    """
+
+    def __init__(self, journal=None, max_items=0, max_bytes=0, overflow=None,
+                 block_timeout=None):
+        self.journal = journal
+        self.replayed = False
+        self.max_items = max_items or 0
+        self.max_bytes = max_bytes or 0
+        self.overflow = overflow or constants.DEFAULT_PUBLISH_QUEUE_OVERFLOW
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Invalid publish queue overflow policy \"{}\". "
+                             "Supported policies are {}".format(
+                                 self.overflow, "/".join(OVERFLOW_POLICIES)))
+        if block_timeout is None:
+            block_timeout = constants.DEFAULT_PUBLISH_QUEUE_BLOCK_TIMEOUT
+        self.block_timeout = block_timeout
+
+        # Number of holds on the journal records of publishes taken off the
+        # queue, by record id
+        self.holds = {}
+
+        # Counters of shed publishes
+        self.dropped = 0
+        self.coalesced = 0
+
+        # Queue.Queue is an old style class on Python 2, so no super()
+        queue.Queue.__init__(self)
+
+    def _init(self, maxsize):
+        # Items are stored as [journal id, publish, size]
+        self.queue = deque()
+        self.bytes = 0
+        # Latest queued entry for each coalesce key
+        self.latest = {}
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item, size=None):
+        row_id = None
+        if self.journal is not None:
+            row_id = self.journal.append(item.to_record())
+        if size is None:
+            size = approx_size(item)
+        item.journal_id = row_id
+        entry = [row_id, item, size]
+        self.queue.append(entry)
+        self.bytes += size
+        if self.overflow == "coalesce":
+            key = coalesce_key(item)
+            if key:
+                self.latest[key] = entry
+
+    def _get(self):
+        # The journal record is kept until the publish has been answered
+        return self._remove_oldest(forget=False)
+
+    def _is_full(self, size):
+        """
+        Check if adding a publish of the given size would exceed the bounds
+        """
+
+        return ((self.max_items and len(self.queue) >= self.max_items) or
+                (self.max_bytes and self.queue and
+                 self.bytes + size > self.max_bytes))
+
+    def _remove_oldest(self, forget=True):
+        """
+        Take the oldest entry off the queue and return its publish. Its
+        journal record is removed if forget is True.
+        """
+
+        row_id, item, size = self.queue.popleft()
+        self.bytes -= size
+        if row_id is not None and forget:
+            self.journal.remove(row_id)
+        if self.latest:
+            key = coalesce_key(item)
+            if key and key in self.latest and self.latest[key][1] is item:
+                del self.latest[key]
+        return item
+
+    def _coalesce(self, item, size):
+        """
+        Replace the queued publish with the same key as item. Returns False if
+        there is nothing to replace.
+        """
+
+        key = coalesce_key(item)
+        entry = self.latest.get(key) if key else None
+        if not entry:
+            return False
+        if entry[0] is not None:
+            self.journal.remove(entry[0])
+            entry[0] = item.journal_id = self.journal.append(item.to_record())
+        self.bytes += size - entry[2]
+        shed(entry[1])
+        entry[1] = item
+        entry[2] = size
+        return True
+
+    def flush(self):
+        """
+        Write any pending changes to the journal now
+        """
+
+        if self.journal is not None:
+            self.journal.commit()
+
+    def hold(self, row_id):
+        """
+        Keep the journal record of a publish taken off the queue until it is
+        released
+        """
+
+        self.mutex.acquire()
+        try:
+            self.holds[row_id] = self.holds.get(row_id, 0) + 1
+        finally:
+            self.mutex.release()
+
+    def release(self, row_id):
+        """
+        Release a hold on the journal record of a publish taken off the queue,
+        removing the record once nothing holds it
+        """
+
+        self.mutex.acquire()
+        try:
+            count = self.holds.pop(row_id, 0) - 1
+            if count > 0:
+                self.holds[row_id] = count
+                return
+        finally:
+            self.mutex.release()
+        self.journal.remove(row_id)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Add a publish to the queue, applying the overflow policy if the queue is
+        full. block and timeout are accepted for compatibility with Queue.put,
+        the block policy uses block_timeout. Returns STATUS_SUCCESS if item
+        was queued, even if older publishes were shed to make space, or
+        STATUS_FULL if item was dropped.
+        """
+
+        status = constants.STATUS_SUCCESS
+        size = approx_size(item)
+        self.not_full.acquire()
+        try:
+            if self._is_full(size):
+                status = constants.STATUS_FULL
+                if self.overflow == "block":
+                    end_time = monotonic() + self.block_timeout
+                    while self._is_full(size):
+                        remaining = end_time - monotonic()
+                        if remaining <= 0:
+                            break
+                        self.not_full.wait(remaining)
+                    if not self._is_full(size):
+                        status = constants.STATUS_SUCCESS
+                    else:
+                        self.dropped += 1
+                        shed(item)
+                        return status
+
+                elif self.overflow == "drop_newest":
+                    self.dropped += 1
+                    shed(item)
+                    return status
+
+                status = constants.STATUS_SUCCESS
+                if self.overflow == "coalesce" and self._coalesce(item, size):
+                    self.coalesced += 1
+                    return status
+
+                # drop_oldest, or nothing to coalesce with
+                while self.queue and self._is_full(size):
+                    shed(self._remove_oldest())
+                    self.unfinished_tasks -= 1
+                    self.dropped += 1
+
+            self._put(item, size)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+        return status
+
+    def replay(self):
+        """
+        Place publishes left in the journal by a previous session at the front
+        of the queue. Only done once. Returns the number of publishes restored.
+        """
+
+        count = 0
+        if self.journal is not None and not self.replayed:
+            records = self.journal.load_previous()
+            self.mutex.acquire()
+            try:
+                for row_id, record in reversed(records):
+                    item = defs.publish_from_record(record)
+                    item.journal_id = row_id
+                    size = approx_size(item)
+                    self.queue.appendleft([row_id, item, size])
+                    self.bytes += size
+                count = len(records)
+                self.unfinished_tasks += count
+                if count:
+                    self.not_empty.notify_all()
+            finally:
+                self.mutex.release()
+        self.replayed = True
+        return count
+
+    def stats(self):
+        """
+        Return a dict of queue depth and counters of shed publishes
+        """
+
+        self.mutex.acquire()
+        try:
+            return {"queued":len(self.queue),
+                    "bytes":self.bytes,
+                    "dropped":self.dropped,
+                    "coalesced":self.coalesced}
+        finally:
+            self.mutex.release()
+
+    def sync(self):
+        """
+        Give the journal a chance to commit on its interval
+        """
+
+        if self.journal is not None:
+            self.journal.tick()
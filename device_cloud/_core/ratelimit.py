@@ -0,0 +1,80 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the rate limiter used to keep outgoing requests under the
+Cloud's API/s threshold
+"""
+
+import threading
+from time import sleep
+
+from device_cloud._core.defs import monotonic
+
+
+class TokenBucket(object):
+    """
+    Token bucket that refills at a fixed rate (tokens per second) up to a
+    maximum burst size. A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate) if rate and rate > 0 else 0.0
+        self.burst = float(max(burst or 1, 1))
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+        # Statistics on how long callers have been held back
+        self.wait_count = 0
+        self.wait_time = 0.0
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket, sleeping until they are available. Tokens
+        are reserved under the bucket lock, but the sleep happens outside of it
+        so other callers are never blocked by a waiting caller. Returns the
+        number of seconds the caller waited.
+        """
+
+        if not self.rate:
+            return 0.0
+
+        self.lock.acquire()
+        try:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            delay = 0.0
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+                self.wait_count += 1
+                self.wait_time += delay
+        finally:
+            self.lock.release()
+
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    def stats(self):
+        """
+        Return a dict describing the limiter and how long callers have waited
+        """
+
+        return {"rate":self.rate,
+                "burst":self.burst,
+                "waits":self.wait_count,
+                "wait_time":self.wait_time}
@@ -16,8 +16,8 @@ This module contains functions for generating TR50 messages relevent to the
 Client application
 """
 
-import json
 
+from device_cloud._core import codec
 from device_cloud._core import constants
 
 
@@ -422,9 +422,10 @@ def create_thing_update(key, name, description, iccid, esn, imei,
     cmd["params"] = _generate_params(kwargs)
     return cmd
 
-def generate_request(commands):
+def generate_request(commands, binary=False):
     """
-    Generate a final TR50 request string out of multiple commands
+    Generate a final TR50 request string out of multiple commands. If binary
+    is True the request is returned as UTF-8 bytes, ready to be published.
     """
 
     request = {}
@@ -438,7 +439,24 @@ def generate_request(commands):
     for num, val in enumerate(command_list):
         request[str(num+1)] = val
 
-    return json.dumps(request, separators=(",", ":"))
+    if binary:
+        return codec.dumpb(request)
+    return codec.dumps(request)
+
+def generate_request_messages(messages):
+    """
+    Generate a final TR50 request, as UTF-8 bytes, out of OutMessages.
+    Commands that were already encoded (OutMessage.encoded) are not encoded
+    again.
+    """
+
+    parts = []
+    for num, message in enumerate(messages):
+        encoded = message.encoded
+        if encoded is None:
+            encoded = codec.dumpb(message.command)
+        parts.append(codec.dumpb(str(num+1)) + b":" + encoded)
+    return b"{" + b",".join(parts) + b"}"
 
 def translate_error_code(error_code):
     """
@@ -0,0 +1,232 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the tracker of sent commands that are waiting for a reply
+"""
+
+import heapq
+from collections import OrderedDict
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.defs import monotonic
+
+
+class TrackedMessage(object):
+    """
+    Compact record of a sent command waiting for its reply. The command itself
+    is only kept if it will be retransmitted when its reply is lost.
+    """
+
+    __slots__ = ("out_id", "command_type", "key", "description_format",
+                 "description_args", "data", "futures", "journal_ids",
+                 "cache_values", "timestamp", "deadline", "attempts",
+                 "retransmit", "command")
+
+    def __init__(self, message, deadline, retransmit=False):
+        command = message.command
+        params = command.get("params") or {}
+        self.out_id = message.out_id
+        self.command_type = command.get("command")
+        self.key = params.get("key")
+        self.description_format = message.description_format
+        self.description_args = message.description_args
+        self.data = message.data
+        self.futures = message.futures
+        self.journal_ids = message.journal_ids
+        self.cache_values = message.cache_values
+        self.timestamp = message.timestamp
+        self.deadline = deadline
+        self.attempts = message.attempts
+        self.retransmit = retransmit
+        self.command = command if retransmit else None
+
+    @property
+    def description(self):
+        if self.description_args is not None:
+            return self.description_format.format(*self.description_args)
+        return self.description_format
+
+    def __str__(self):
+        return self.description
+
+    def to_message(self):
+        """
+        Rebuild the OutMessage that was sent, for reply callbacks and the
+        Client's error handler. If the command was not kept, it only holds the
+        command name and key.
+        """
+
+        command = self.command
+        if command is None:
+            command = {"command":self.command_type}
+            if self.key is not None:
+                command["params"] = {"key":self.key}
+        message = defs.OutMessage(command, self.description_format,
+                                  timestamp=self.timestamp, data=self.data,
+                                  out_id=self.out_id,
+                                  description_args=self.description_args)
+        message.futures = self.futures
+        message.journal_ids = self.journal_ids
+        message.cache_values = self.cache_values
+        message.attempts = self.attempts
+        return message
+
+
+class ReplyTracker(object):
+    """
+    Tracks sent commands until their reply arrives. Each command has a
+    deadline, kept in a heap so that expired commands are found without
+    scanning everything. Expired commands of the types in retransmit are
+    returned to be sent again, up to max_retransmits times; other expired
+    commands have failed. Once more than max_messages are tracked the oldest
+    are dropped and treated as failed.
+    """
+
+    def __init__(self, timeout=None, max_messages=None, retransmit=None,
+                 max_retransmits=None):
+        self.timeout = timeout or constants.DEFAULT_REPLY_TRACKER_TIMEOUT
+        self.max_messages = (max_messages or
+                             constants.DEFAULT_REPLY_TRACKER_MAX_MESSAGES)
+        if retransmit is None:
+            retransmit = constants.DEFAULT_RETRANSMIT_COMMANDS
+        self.retransmit = set(retransmit)
+        if max_retransmits is None:
+            max_retransmits = constants.DEFAULT_MAX_RETRANSMITS
+        self.max_retransmits = max_retransmits
+
+        # Tracked messages by out_id, oldest first
+        self.messages = OrderedDict()
+        # (deadline, out_id) of tracked messages. Entries for messages that
+        # have since been replied to are skipped when they reach the top.
+        self.deadlines = []
+        # Topic each MQTT message id is being sent on, oldest first
+        self.mid_tracker = OrderedDict()
+
+        self.expired = 0
+        self.retransmitted = 0
+        self.dropped = 0
+
+    def __contains__(self, out_id):
+        return out_id in self.messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add_message(self, message):
+        """
+        Track a sent message. Returns the list of messages dropped to stay
+        under max_messages.
+        """
+
+        deadline = monotonic() + self.timeout
+        retransmit = (message.command.get("command") in self.retransmit and
+                      message.attempts < self.max_retransmits)
+        self.messages[message.out_id] = TrackedMessage(message, deadline,
+                                                       retransmit=retransmit)
+        heapq.heappush(self.deadlines, (deadline, message.out_id))
+
+        dropped = []
+        while len(self.messages) > self.max_messages:
+            dropped.append(self.messages.popitem(last=False)[1])
+        self.dropped += len(dropped)
+        if len(self.deadlines) > 2 * self.max_messages:
+            self._compact()
+        return dropped
+
+    def add_mid(self, mid, topic):
+        """
+        Add an MID with the topic it will send on
+        """
+
+        self.mid_tracker[mid] = topic
+        while len(self.mid_tracker) > self.max_messages:
+            self.mid_tracker.popitem(last=False)
+
+    def _compact(self):
+        """
+        Rebuild the deadline heap without entries for finished messages
+        """
+
+        self.deadlines = [(x.deadline, x.out_id)
+                          for x in self.messages.values()]
+        heapq.heapify(self.deadlines)
+
+    def clear(self):
+        self.messages.clear()
+        self.deadlines = []
+        self.mid_tracker.clear()
+
+    def expire(self, now=None):
+        """
+        Remove messages whose deadline has passed. Returns a list of messages
+        to retransmit and a list of messages that have failed.
+        """
+
+        if now is None:
+            now = monotonic()
+        retransmit = []
+        failed = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, out_id = heapq.heappop(self.deadlines)
+            message = self.messages.get(out_id)
+            if message is None or message.deadline != deadline:
+                continue
+            del self.messages[out_id]
+            self.expired += 1
+            if message.retransmit:
+                self.retransmitted += 1
+                retransmit.append(message)
+            else:
+                failed.append(message)
+        return retransmit, failed
+
+    def get_message(self, topic_num, cmd_num):
+        """
+        Return a single message without removing it, or None if it is not
+        tracked
+        """
+
+        return self.messages.get("{}-{}".format(topic_num, cmd_num))
+
+    def items(self):
+        return self.messages.items()
+
+    def pop_message(self, topic_num, cmd_num):
+        """
+        Remove a single message
+        """
+
+        out_id = "{}-{}".format(topic_num, cmd_num)
+        try:
+            message = self.messages.pop(out_id)
+        except KeyError:
+            raise KeyError("Message {} not found. May be a duplicate reply or "
+                           "a reply after it expired".format(out_id))
+        return message
+
+    def pop_mid(self, mid):
+        """
+        Retrieve the topic an MID is sending on, or None if it is not tracked
+        """
+
+        return self.mid_tracker.pop(mid, None)
+
+    def stats(self):
+        """
+        Return counts of tracked, expired, retransmitted and dropped messages
+        """
+
+        return {"tracked":len(self.messages), "expired":self.expired,
+                "retransmitted":self.retransmitted, "dropped":self.dropped}
@@ -0,0 +1,267 @@
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+This module contains the pools of worker threads that handle queued work
+"""
+
+import itertools
+import sys
+import threading
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.defs import monotonic
+
+
+class WorkPool(object):
+    """
+    Work queue with its own worker threads. Each kind of work (received
+    messages, publishing, actions and file transfers) has a pool, so slow work
+    of one kind never holds up the others.
+
+    The pool runs between threads and max_threads workers. A worker is added
+    when the oldest queued work has waited more than grow_wait seconds with
+    every worker busy, and a worker beyond threads exits after idle_time
+    seconds without work. Pools that can grow have a monitor thread that
+    checks the wait while every worker is busy.
+    """
+
+    def __init__(self, name, handle, threads, logger, loop_time=None,
+                 max_queued=None, aging=None, max_threads=None,
+                 grow_wait=None, idle_time=None):
+        self.name = name
+        self.handle = handle
+        self.threads = threads
+        self.max_threads = max(threads, max_threads or 0)
+        self.logger = logger
+        self.loop_time = loop_time or constants.DEFAULT_LOOP_TIME
+        if grow_wait is None:
+            grow_wait = constants.DEFAULT_WORK_GROW_WAIT
+        self.grow_wait = grow_wait
+        if idle_time is None:
+            idle_time = constants.DEFAULT_WORK_IDLE_TIME
+        self.idle_time = idle_time
+        self.queue = defs.PriorityWorkQueue(
+            max_queued or constants.DEFAULT_WORK_QUEUE_SIZE, aging)
+        self.workers = []
+        self.running = False
+        self.names = itertools.count()
+        self.monitor = None
+        # Set when work is queued, to wake the monitor
+        self.queued = threading.Event()
+
+        self.lock = threading.Lock()
+        # Workers currently handling work, the deepest the queue has been, the
+        # amount of work handled and the number of workers added and retired
+        self.busy = 0
+        self.max_queued = 0
+        self.handled = 0
+        self.grown = 0
+        self.shrunk = 0
+
+    def _add_worker(self):
+        """
+        Start a worker thread. Must be called with the lock held.
+        """
+
+        thread = threading.Thread(target=self.run, name="{}-{}".format(
+            self.name, next(self.names)))
+        thread.daemon = True
+        self.workers.append(thread)
+        thread.start()
+
+    def _grow(self):
+        """
+        Add a worker if every worker is busy and the oldest queued work has
+        waited too long. Returns True if a worker was added.
+        """
+
+        if not self.running or len(self.workers) >= self.max_threads:
+            return False
+        waited = self.queue.oldest_wait()
+        if waited is None:
+            return False
+        with self.lock:
+            if (not self.running or len(self.workers) >= self.max_threads or
+                    (self.workers and (self.busy < len(self.workers) or
+                                       waited < self.grow_wait))):
+                return False
+            self._add_worker()
+            self.grown += 1
+            count = len(self.workers)
+        self.logger.info("Work pool %s grew to %d threads, oldest work waited "
+                         "%.3fs", self.name, count, waited)
+        return True
+
+    def _monitor(self):
+        """
+        Loop for the monitor thread. Work queued while every worker is busy
+        has nothing else to check its wait until a worker finishes, which can
+        take as long as the slowest work.
+        """
+
+        while self.running:
+            waited = self.queue.oldest_wait()
+            if waited is None:
+                # Nothing queued, wait for a put
+                self.queued.wait(self.loop_time)
+                self.queued.clear()
+                continue
+            if self._grow():
+                continue
+            timeout = self.grow_wait - waited
+            if timeout <= 0:
+                # A worker is about to take it, or the pool is at max_threads
+                timeout = self.grow_wait or self.loop_time
+            self.queued.wait(timeout)
+            self.queued.clear()
+
+    def _retire(self):
+        """
+        Remove the current worker if the pool has more than its minimum.
+        Returns True if the worker should exit.
+        """
+
+        with self.lock:
+            if not self.running or len(self.workers) <= self.threads:
+                return False
+            self.workers.remove(threading.current_thread())
+            self.shrunk += 1
+            count = len(self.workers)
+        self.logger.info("Work pool %s shrank to %d threads after %ss idle",
+                         self.name, count, self.idle_time)
+        return True
+
+    def is_worker(self, thread=None):
+        """
+        Check if a thread (by default the current one) is a worker of this pool
+        """
+
+        return (thread or threading.current_thread()) in self.workers
+
+    def put(self, work):
+        """
+        Queue work for the pool's workers. Raises queue.Full if the pool
+        already has max_queued items waiting.
+        """
+
+        self.queue.put_nowait(work)
+        depth = self.queue.qsize()
+        if depth > self.max_queued:
+            with self.lock:
+                self.max_queued = max(self.max_queued, depth)
+        if not self._grow() and self.monitor:
+            self.queued.set()
+
+    def run(self):
+        """
+        Loop for worker threads to handle any work put on the queue
+        """
+
+        timeout = self.loop_time
+        if self.idle_time:
+            timeout = min(timeout, self.idle_time)
+        idle_since = monotonic()
+        while self.running:
+            try:
+                work = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if (monotonic() - idle_since >= self.idle_time and
+                        self._retire()):
+                    return
+                continue
+            if work is None:
+                # Woken by stop
+                continue
+            with self.lock:
+                self.busy += 1
+            try:
+                self.handle(work)
+            except Exception:
+                # Print traceback, but don't kill thread
+                self.logger.exception("Exception:")
+            finally:
+                # Work may have backed up while this worker was busy
+                self._grow()
+                with self.lock:
+                    self.busy -= 1
+                    self.handled += 1
+            idle_since = monotonic()
+
+    def start(self):
+        """
+        Start the minimum number of worker threads
+        """
+
+        self.running = True
+        with self.lock:
+            for _ in range(self.threads):
+                self._add_worker()
+        if self.max_threads > self.threads:
+            self.monitor = threading.Thread(target=self._monitor,
+                                            name=self.name + "-monitor")
+            self.monitor.daemon = True
+            self.monitor.start()
+
+    def stats(self):
+        """
+        Return the number of threads, busy threads, queued work, deepest
+        queue, work handled, workers added and retired and the wait for a
+        worker at each priority
+        """
+
+        with self.lock:
+            return {"threads":len(self.workers), "min_threads":self.threads,
+                    "max_threads":self.max_threads, "busy":self.busy,
+                    "queued":self.queue.qsize(),
+                    "max_queued":self.max_queued, "handled":self.handled,
+                    "grown":self.grown, "shrunk":self.shrunk,
+                    "priorities":self.queue.stats()}
+
+    def stop(self):
+        """
+        Stop the worker threads once they finish their current work
+        """
+
+        self.running = False
+        if self.monitor:
+            self.queued.set()
+            self.monitor.join()
+            self.monitor = None
+        with self.lock:
+            workers = list(self.workers)
+        # Wake idle workers instead of waiting for their get to time out
+        for _ in workers:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                # Workers are busy and will stop after their current work
+                break
+        for thread in workers:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.workers = []
+
+    def wait_empty(self, timeout=None):
+        """
+        Wait until every queued item has been taken by a worker. Returns True
+        if the queue is empty.
+        """
+
+        return self.queue.wait_empty(timeout)
@@ -13,7 +13,9 @@
     OR CONDITIONS OF ANY KIND, either express or implied.
 '''
 
+import io
 import json
+import logging
 import os
 import unittest
 from binascii import crc32
@@ -21,9 +23,11 @@ import mock
 from mock import MagicMock
 import platform
 import re
+import shutil
 import socket
 import ssl
 import sys
+import tempfile
 
 # yocto supports websockets, not websocket, so check for that
 try:
@@ -264,8 +268,9 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.state == 4
         assert pub.message == "alarm message"
         assert pub.republish == False
-        work = self.client.handler.work_queue.get()
+        work = self.client.handler.pools["publish"].queue.get()
         assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        self.client.handler.flush_scheduler.done()
 
         # Queue alarm for publishing
         # do not specify republish, use default value
@@ -278,8 +283,9 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.state == 5
         assert pub.message == "alarm message"
         assert pub.republish == False
-        work = self.client.handler.work_queue.get()
+        work = self.client.handler.pools["publish"].queue.get()
         assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        self.client.handler.flush_scheduler.done()
 
         # Queue alarm for publishing
         # default republish=True
@@ -293,8 +299,9 @@ class ClientAlarmPublish(unittest.TestCase):
         assert pub.state == 6
         assert pub.message == "alarm message"
         assert pub.republish == True
-        work = self.client.handler.work_queue.get()
+        work = self.client.handler.pools["publish"].queue.get()
         assert work.type == device_cloud._core.constants.WORK_PUBLISH
+        self.client.handler.flush_scheduler.done()
 
     def setUp(self):
         # Configuration to be 'read' from config file
@@ -400,12 +407,18 @@ class ClientConnectSuccess(unittest.TestCase):
         self.client = device_cloud.Client("testing-client", kwargs)
         self.client.initialize()
 
+        # Publishes restored from the journal are flushed
+        handler = self.client.handler
+        handler.publish_queue.replay = mock.Mock(return_value=2)
+        handler.flush_scheduler.notify = mock.Mock()
+
         # Connect successfully
         mqtt = self.client.handler.mqtt
         assert self.client.connect(timeout=5) == device_cloud.STATUS_SUCCESS
         mqtt.connect.assert_called_once_with("api.notarealcloudhost.com",
                                              8883, 60)
         assert self.client.is_connected() is True
+        handler.flush_scheduler.notify.assert_called_once_with()
         assert self.client.disconnect() == device_cloud.STATUS_SUCCESS
         mqtt.disconnect.assert_called_once()
         assert self.client.is_connected() is False
@@ -912,6 +925,53 @@ class ClientTelemetryPublish(unittest.TestCase):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
 
+class ClientTelemetryPublishMany(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("time.sleep")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_sleep, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # A block of samples is queued as one publish
+        result = self.client.telemetry_publish_many("property_key",
+                                                    [1, 2, 3], [10, 11, 12])
+        assert result == device_cloud.STATUS_SUCCESS
+        pub = self.client.handler.publish_queue.get()
+        assert isinstance(pub, device_cloud._core.defs.PublishTelemetryBlock)
+        assert [x[:2] for x in pub.items()] == [("property_key", 1.0),
+                                                 ("property_key", 2.0),
+                                                 ("property_key", 3.0)]
+        assert self.client.handler.publish_queue.empty()
+
+        # Aggregated columns are split off the block
+        result = self.client.telemetry_publish_table({"a":[1, 2], "b":[3, 4]})
+        assert result == device_cloud.STATUS_SUCCESS
+        pub = self.client.handler.publish_queue.get()
+        assert [name for name, _ in pub.columns] == ["a", "b"]
+        result = self.client.telemetry_publish_many("c", [1, 2],
+                                                    aggregate=True)
+        assert result == device_cloud.STATUS_SUCCESS
+        assert self.client.handler.publish_queue.empty()
+
+        # Mismatched lengths
+        result = self.client.telemetry_publish_table({"a":[1, 2], "b":[3]})
+        assert result == device_cloud.STATUS_BAD_PARAMETER
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
 class ConfigMissingHost(unittest.TestCase):
     @mock.patch(builtin + ".open")
     @mock.patch("os.path.exists")
@@ -2623,3 +2683,1723 @@ class ClientThingUpdate(unittest.TestCase):
     def setUp(self):
         # Configuration to be 'read' from config file
         self.config_args = helpers.config_file_default()
+
+class RateLimiterTokenBucket(unittest.TestCase):
+    @mock.patch("device_cloud._core.ratelimit.sleep")
+    @mock.patch("device_cloud._core.ratelimit.monotonic")
+    def runTest(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        bucket = device_cloud._core.ratelimit.TokenBucket(10, 2)
+
+        # Burst is available immediately
+        assert bucket.consume() == 0.0
+        assert bucket.consume() == 0.0
+        mock_sleep.assert_not_called()
+
+        # Bucket is empty, next caller waits for one token
+        assert abs(bucket.consume() - 0.1) < 1e-9
+        mock_sleep.assert_called_once()
+
+        # Tokens refill over time, but never past the burst size
+        mock_monotonic.return_value = 200.0
+        assert bucket.consume() == 0.0
+        assert bucket.consume() == 0.0
+        assert bucket.consume() > 0.0
+        stats = bucket.stats()
+        assert stats["waits"] == 2
+
+        # A rate of 0 disables limiting
+        bucket = device_cloud._core.ratelimit.TokenBucket(0)
+        for _ in range(100):
+            assert bucket.consume() == 0.0
+
+class HandlerSendControlRateLimit(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+
+        # Default rate, reported with the publish counters
+        limits = self.client.publish_stats()["rate_limits"]
+        assert limits["api"]["rate"] == \
+            device_cloud._core.constants.DEFAULT_API_RATE
+        assert limits["control"]["waits"] == 0
+
+        handler.api_limiter = mock.Mock()
+        handler.api_limiter.consume.return_value = 0.0
+        handler.control_limiter = mock.Mock()
+        handler.control_limiter.consume.return_value = 0.0
+
+        # Mailbox acks use the control budget
+        assert self.client.action_acknowledge("mail", 0, "") == \
+            device_cloud.STATUS_SUCCESS
+        handler.control_limiter.consume.assert_called_once()
+        handler.api_limiter.consume.assert_not_called()
+
+        # Anything else uses the API budget
+        assert self.client.diag_ping() == device_cloud.STATUS_SUCCESS
+        handler.api_limiter.consume.assert_called_once()
+        handler.control_limiter.consume.assert_called_once()
+
+    def setUp(self):
+        self.config_args = helpers.config_file_default()
+
+class PublishJournalReplay(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        path = os.path.join(self.temp_dir, "journal.db")
+
+        # Queue a few publishes. One is taken off the queue and answered, one
+        # is taken off but still waiting for its reply.
+        journal = device_cloud._core.journal.Journal(path, commit_items=2)
+        pub_queue = device_cloud._core.pubqueue.PublishQueue(journal)
+        pub_queue.put(defs.PublishTelemetry("a", 1))
+        pub_queue.put(defs.PublishTelemetry("b", 2.5))
+        pub_queue.put(defs.PublishAttribute("c", "string"))
+        pub = pub_queue.get()
+        assert pub.name == "a"
+        pub_queue.hold(pub.journal_id)
+        pub_queue.hold(pub.journal_id)
+        pub_queue.release(pub.journal_id)
+        assert len(journal) == 3
+        pub_queue.release(pub.journal_id)
+        assert len(journal) == 2
+        pub = pub_queue.get()
+        pub_queue.hold(pub.journal_id)
+        pub_queue.flush()
+        journal.close()
+
+        # 'Restart' and replay what was left
+        journal = device_cloud._core.journal.Journal(path)
+        pub_queue = device_cloud._core.pubqueue.PublishQueue(journal)
+        pub_queue.put(defs.PublishTelemetry("d", 4))
+        assert pub_queue.replay() == 2
+        assert pub_queue.replay() == 0
+        pubs = [pub_queue.get() for _ in range(3)]
+        assert [pub.name for pub in pubs] == ["b", "c", "d"]
+        assert isinstance(pubs[1], defs.PublishAttribute)
+        assert pubs[0].value == 2.5
+        assert len(journal) == 3
+        for pub in pubs:
+            pub_queue.release(pub.journal_id)
+        pub_queue.flush()
+        assert len(journal) == 0
+        journal.close()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class PublishJournalUntilReply(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        defs = device_cloud._core.defs
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client with a journal
+        kwargs = {"loop_time":1, "thread_count":0, "max_batch_items":2,
+                  "publish_journal":{"path":os.path.join(self.temp_dir,
+                                                         "journal.db")}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.flush_scheduler.notify = mock.Mock()
+        journal = handler.publish_queue.journal
+
+        # A block split over two batch commands stays in the journal until
+        # both are answered
+        self.client.telemetry_publish_many("a", [1, 2, 3])
+        self.client.attribute_publish("fw", "1.2")
+        handler.handle_publish()
+        assert handler.publish_queue.empty()
+        assert len(journal) == 2
+        sent = dict(handler.reply_tracker.items())
+        assert sorted(sent) == ["0001-1", "0001-2", "0001-3"]
+        reply = defs.Message("reply/0001", {"1":{"success":True},
+                                            "3":{"success":True}})
+        handler.handle_message(reply)
+        assert len(journal) == 1
+
+        # Given up on without a reply
+        retransmit, failed = handler.reply_tracker.expire(now=float("inf"))
+        assert [x.out_id for x in failed] == ["0001-2"]
+        handler.reply_failed(failed[0], "no reply")
+        assert len(journal) == 0
+        assert handler.publish_queue.holds == {}
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+        self.client.handler.publish_queue.journal.close()
+        shutil.rmtree(self.temp_dir)
+
+class PublishJournalMaxBytes(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        path = os.path.join(self.temp_dir, "journal.db")
+        journal = device_cloud._core.journal.Journal(path, max_bytes=1000)
+        for i in range(100):
+            journal.append(defs.PublishTelemetry("key", i).to_record())
+        assert journal.size <= 1000
+        assert journal.dropped > 0
+        assert len(journal) == 100 - journal.dropped
+        journal.close()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class PublishQueueOverflow(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        PublishQueue = device_cloud._core.pubqueue.PublishQueue
+
+        # drop_newest keeps what is queued
+        pub_queue = PublishQueue(max_items=2, overflow="drop_newest")
+        assert pub_queue.put(defs.PublishTelemetry("a", 1)) == \
+            device_cloud.STATUS_SUCCESS
+        assert pub_queue.put(defs.PublishTelemetry("b", 2)) == \
+            device_cloud.STATUS_SUCCESS
+        pub = defs.PublishTelemetry("c", 3)
+        pub.future = defs.ReplyFuture()
+        assert pub_queue.put(pub) == device_cloud.STATUS_FULL
+        assert pub.future.dropped
+        assert [pub_queue.get().name for _ in range(2)] == ["a", "b"]
+        assert pub_queue.stats()["dropped"] == 1
+
+        # drop_oldest makes space
+        pub_queue = PublishQueue(max_items=2, overflow="drop_oldest")
+        pubs = [defs.PublishTelemetry(name, 1) for name in ("a", "b", "c")]
+        for pub in pubs:
+            pub.future = defs.ReplyFuture()
+            assert pub_queue.put(pub) == device_cloud.STATUS_SUCCESS
+        assert [pub.future.dropped for pub in pubs] == [True, False, False]
+        assert [pub_queue.get().name for _ in range(2)] == ["b", "c"]
+        assert pub_queue.empty()
+
+        # coalesce replaces the queued value for the same key
+        pub_queue = PublishQueue(max_items=2, overflow="coalesce")
+        replaced = defs.PublishTelemetry("a", 1)
+        replaced.future = defs.ReplyFuture()
+        pub_queue.put(replaced)
+        pub_queue.put(defs.PublishTelemetry("b", 2))
+        assert pub_queue.put(defs.PublishTelemetry("a", 10)) == \
+            device_cloud.STATUS_SUCCESS
+        assert replaced.future.dropped
+        pubs = [pub_queue.get() for _ in range(2)]
+        assert [(pub.name, pub.value) for pub in pubs] == [("a", 10), ("b", 2)]
+        stats = pub_queue.stats()
+        assert stats["coalesced"] == 1
+        assert stats["dropped"] == 0
+        assert stats["bytes"] == 0
+
+        # block gives up after block_timeout
+        pub_queue = PublishQueue(max_items=1, overflow="block",
+                                 block_timeout=0.01)
+        pub_queue.put(defs.PublishTelemetry("a", 1))
+        assert pub_queue.put(defs.PublishTelemetry("b", 2)) == \
+            device_cloud.STATUS_FULL
+        assert pub_queue.qsize() == 1
+
+        # byte bound
+        pub_queue = PublishQueue(max_bytes=1000)
+        for i in range(20):
+            pub_queue.put(defs.PublishTelemetry("key", i))
+        stats = pub_queue.stats()
+        assert stats["bytes"] <= 1000
+        assert stats["queued"] + stats["dropped"] == 20
+
+class PublishBatchSplit(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+        BatchBuilder = device_cloud._core.batch.BatchBuilder
+
+        requests = []
+        def send(messages):
+            requests.append(list(messages))
+            return device_cloud.STATUS_SUCCESS
+
+        builder = BatchBuilder("thing", send, max_bytes=2000, max_items=10)
+        codec = device_cloud._core.codec
+        with mock.patch.object(codec, "dumpb", wraps=codec.dumpb) as dumpb:
+            for i in range(100):
+                builder.add(defs.PublishTelemetry("property", float(i)))
+                builder.add(defs.PublishAttribute("attribute", str(i)))
+            builder.add(defs.PublishLog("log message"))
+            assert builder.finish() == device_cloud.STATUS_SUCCESS
+        # Items are encoded once, plus a few calls for each command
+        commands = sum(len(request) for request in requests)
+        assert dumpb.call_count <= 201 + 3 * commands
+
+        # Several requests, each under the size limit with several commands
+        assert len(requests) > 1
+        telemetry = []
+        attributes = []
+        for request in requests:
+            # Sent as the encoded items, which decode to the commands
+            payload = tr50.generate_request_messages(request)
+            assert len(payload) <= 2000
+            assert json.loads(payload.decode()) == json.loads(
+                tr50.generate_request([x.command for x in request]))
+            for message in request:
+                command = message.command
+                if command["command"] == "property.batch":
+                    assert len(command["params"]["data"]) <= 10
+                    telemetry += [x["value"] for x in command["params"]["data"]]
+                elif command["command"] == "attribute.batch":
+                    assert len(command["params"]["data"]) <= 10
+                    attributes += [x["value"] for x in command["params"]["data"]]
+        assert any(len(request) > 1 for request in requests)
+
+        # Nothing lost and order kept
+        assert telemetry == [float(i) for i in range(100)]
+        assert attributes == [str(i) for i in range(100)]
+        assert "log.publish" in [x.command["command"] for x in requests[-1]]
+
+        # Cached values keep the newest sample of each key, compared by epoch
+        # without parsing timestamps
+        del requests[:]
+        builder = BatchBuilder("thing", send, cache_values=True)
+        cache = device_cloud._core.cache
+        with mock.patch.object(cache, "_parse_timestamp") as parse:
+            builder.add(defs.PublishTelemetry("t", 2.0, timestamp=200))
+            builder.add(defs.PublishTelemetry("t", 1.0, timestamp=100))
+            builder.add(defs.PublishTelemetryBlock({"t":[3.0, 0.0]},
+                                                   [300, 50]))
+            builder.add(defs.PublishAttribute("fw", "1"))
+            assert builder.finish() == device_cloud.STATUS_SUCCESS
+        parse.assert_not_called()
+        cached = {}
+        for message in requests[0]:
+            cached.update(message.cache_values)
+        assert cached[("property", "t")][0] == 3.0
+        assert cached[("attribute", "fw")][0] == "1"
+
+        # Timestamps given as strings are still compared
+        del requests[:]
+        builder = BatchBuilder("thing", send, cache_values=True)
+        builder.add(defs.PublishTelemetry("t", 2.0,
+                                          timestamp="2020-01-01T00:00:00Z"))
+        builder.add(defs.PublishTelemetry("t", 1.0, timestamp=100))
+        builder.finish()
+        assert requests[0][0].cache_values[("property", "t")][0] == 2.0
+
+class PublishFlushScheduler(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        PublishQueue = device_cloud._core.pubqueue.PublishQueue
+        FlushScheduler = device_cloud._core.flush.FlushScheduler
+        import threading
+
+        flushes = []
+        results = []
+        def flush():
+            flushes.append(1)
+            if results:
+                return results.pop(0)
+            return device_cloud.STATUS_SUCCESS
+        pub_queue = PublishQueue()
+        scheduler = FlushScheduler(pub_queue, flush, linger_ms=50, max_batch=3)
+        scheduler.start()
+        try:
+            # Nothing is sent before the batch is full or linger expires
+            pub_queue.put(defs.PublishTelemetry("a", 1))
+            scheduler.notify()
+            pub_queue.put(defs.PublishTelemetry("a", 2))
+            scheduler.notify()
+            assert flushes == []
+
+            # Full batch flushes at once
+            pub_queue.put(defs.PublishTelemetry("a", 3))
+            scheduler.notify()
+            assert len(flushes) == 1
+
+            # Only one flush in flight, even for urgent publishes
+            pub_queue.put(defs.PublishAlarm("alarm", 1))
+            scheduler.notify(urgent=True)
+            assert len(flushes) == 1
+            while not pub_queue.empty():
+                pub_queue.get()
+            pub_queue.put(defs.PublishAlarm("alarm", 2))
+            scheduler.notify(urgent=True)
+            scheduler.done()
+            assert len(flushes) == 2
+
+            # Linger deadline
+            while not pub_queue.empty():
+                pub_queue.get()
+            scheduler.done()
+            pub_queue.put(defs.PublishTelemetry("a", 4))
+            scheduler.notify()
+            for _ in range(100):
+                if len(flushes) == 3:
+                    break
+                sleep(0.01)
+            assert len(flushes) == 3
+            assert scheduler.stats() == {"full":1, "linger":1, "urgent":1}
+
+            # A flush the work queue dropped is not left in flight
+            while not pub_queue.empty():
+                pub_queue.get()
+            scheduler.done()
+            results.append(device_cloud.STATUS_FULL)
+            pub_queue.put(defs.PublishAlarm("alarm", 3))
+            with mock.patch.object(device_cloud._core.constants,
+                                   "FLUSH_RETRY_DELAY", 0.05):
+                scheduler.notify(urgent=True)
+                assert len(flushes) == 4
+                assert not scheduler.in_flight
+                for _ in range(100):
+                    if len(flushes) == 5:
+                        break
+                    sleep(0.01)
+            assert len(flushes) == 5
+            assert scheduler.in_flight
+
+            # Waiting for the scheduler to be idle covers the flush in flight
+            # and a flush of what was queued while it ran
+            pub_queue.put(defs.PublishTelemetry("a", 5))
+            scheduler.notify()
+            assert not scheduler.wait_idle(0.05)
+            finished = threading.Event()
+            def worker():
+                while not finished.is_set():
+                    if scheduler.in_flight:
+                        while not pub_queue.empty():
+                            pub_queue.get()
+                        scheduler.done()
+                    sleep(0.01)
+            thread = threading.Thread(target=worker)
+            thread.start()
+            try:
+                assert scheduler.wait_idle(5)
+            finally:
+                finished.set()
+                thread.join()
+            assert len(flushes) == 6
+            assert pub_queue.empty()
+        finally:
+            scheduler.stop()
+
+class TelemetryAggregation(unittest.TestCase):
+    def runTest(self):
+        aggregate = device_cloud._core.aggregate
+
+        # Tumbling windows of 10 seconds
+        aggregator = aggregate.Aggregator(window=10,
+                                          stats=["min", "max", "mean",
+                                                 "count", "sum", "last"])
+        for i in range(10):
+            assert aggregator.add("vibration", i, now=100 + i) == []
+        pubs = aggregator.add("vibration", 50, now=110)
+        assert dict((name, value) for name, value, _ in pubs) == {
+            "vibration_min":0, "vibration_max":9, "vibration_mean":4.5,
+            "vibration_count":10, "vibration_sum":45, "vibration_last":9}
+        assert set(end for _, _, end in pubs) == set([110])
+
+        # Keys that stop receiving samples are closed by expire
+        assert aggregator.expire(now=115) == []
+        pubs = dict((name, value) for name, value, _ in
+                    aggregator.expire(now=120))
+        assert pubs["vibration_count"] == 1
+        assert pubs["vibration_last"] == 50
+        assert aggregator.expire(now=200) == []
+
+        # Sliding windows of 10 seconds, one every 5 seconds
+        aggregator = aggregate.Aggregator(window=10, slide=5, stats=["count"])
+        pubs = []
+        for i in range(20):
+            pubs += aggregator.add("key", 1, now=100 + i)
+        pubs += aggregator.expire(now=130)
+        assert [(value, end) for _, value, end in pubs] == \
+            [(5, 105), (10, 110), (10, 115), (10, 120), (5, 125)]
+
+        # Large windows use the same statistics with or without NumPy
+        values = [float(i % 17) for i in range(1000)]
+        stats = aggregate.compute(aggregate.array("d", values),
+                                  aggregate.STATISTICS)
+        assert stats["min"] == 0
+        assert stats["max"] == 16
+        assert stats["count"] == 1000
+        assert abs(stats["mean"] - sum(values) / 1000) < 1e-9
+
+        # Invalid settings
+        self.assertRaises(ValueError, aggregate.Aggregator, window=5, slide=10)
+        self.assertRaises(ValueError, aggregate.Aggregator, stats=["median"])
+        self.assertRaises(ValueError, aggregator.add, "key", "abc")
+
+class TelemetryDeadbandFilter(unittest.TestCase):
+    def runTest(self):
+        deadband = device_cloud._core.deadband
+
+        registry = deadband.FilterRegistry()
+        registry.set_filter("temp", deadband.FilterSettings(deadband=0.5,
+                                                            max_silence=60))
+        registry.set_filter("pressure", deadband.FilterSettings(
+            deadband_percent=10, min_interval=1))
+
+        # Unfiltered keys are always published
+        assert registry.accept("other", 1, now=0)
+        assert registry.accept("other", 1, now=0)
+
+        # Absolute deadband is measured from the last published value
+        assert registry.accept("temp", 20.0, now=0)
+        assert not registry.accept("temp", 20.3, now=1)
+        assert not registry.accept("temp", 20.5, now=2)
+        assert registry.accept("temp", 20.6, now=3)
+        assert not registry.accept("temp", 20.2, now=4)
+        # The next sample after max_silence is published
+        assert registry.accept("temp", 20.6, now=63)
+        # Forced samples are published and become the reference
+        assert registry.accept("temp", 20.7, now=64, force=True)
+        assert not registry.accept("temp", 21.0, now=65)
+
+        # Percent deadband and minimum interval
+        assert registry.accept("pressure", 100, now=0)
+        assert not registry.accept("pressure", 150, now=0.5)
+        assert not registry.accept("pressure", 105, now=2)
+        assert registry.accept("pressure", 111, now=3)
+
+        # Strings are published when they change
+        registry.default = deadband.FilterSettings(deadband=1)
+        assert registry.accept("state", "on", now=0)
+        assert not registry.accept("state", "on", now=1)
+        assert registry.accept("state", "off", now=2)
+
+        stats = registry.stats()
+        assert stats["suppressed"] == 7
+        assert stats["suppressed_keys"] == {"temp":4, "pressure":2, "state":1}
+
+        # Blocks keep unfiltered and untouched columns together, and split off
+        # columns that lost samples. Block timestamps are sample time.
+        from time import time
+        registry = deadband.FilterRegistry()
+        registry.set_filter("temp", deadband.FilterSettings(deadband=0.5))
+        registry.set_filter("pressure", deadband.FilterSettings(
+            min_interval=10))
+        now = time()
+        block = device_cloud._core.defs.PublishTelemetryBlock(
+            {"other":[1, 1, 1], "temp":[20, 20.1, 21], "pressure":[1, 2, 3]},
+            timestamps=[now - 20, now - 15, now - 5])
+        blocks = registry.filter_block(block)
+        assert blocks[0] is block
+        assert [name for name, _ in block.columns] == ["other"]
+        assert sorted((pub.columns[0][0], list(pub.columns[0][1]),
+                       list(pub.timestamps)) for pub in blocks[1:]) == [
+            ("pressure", [1, 3], [now - 20, now - 5]),
+            ("temp", [20, 21], [now - 20, now - 5])]
+        assert registry.stats()["suppressed"] == 2
+        block = device_cloud._core.defs.PublishTelemetryBlock({"temp":[21]})
+        assert registry.filter_block(block) == []
+
+        # Configuration
+        config = device_cloud._core.defs.Config()
+        config.update({"default":{"deadband":1},
+                       "per_key":{"temp":{"min_interval":5}}})
+        registry = deadband.registry_from_config(config)
+        assert registry.default.deadband == 1
+        assert registry.settings["temp"].min_interval == 5
+        self.assertRaises(ValueError, deadband.FilterSettings, deadband=-1)
+
+class PublishTelemetryBlock(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        BatchBuilder = device_cloud._core.batch.BatchBuilder
+        from array import array
+
+        block = defs.PublishTelemetryBlock(
+            [("x", array("d", [1.0, 2.0, 3.0])), ("y", [4, 5, 6])],
+            timestamps=[0, 1, 2.5])
+        assert len(block) == 6
+        items = list(block.items())
+        assert items[0] == ("x", 1.0, "1970-01-01T00:00:00.000000Z")
+        assert items[5] == ("y", 6.0, "1970-01-01T00:00:02.500000Z")
+
+        # Survives the journal
+        restored = defs.publish_from_record(
+            json.loads(json.dumps(block.to_record())))
+        assert list(restored.items()) == items
+
+        # Sent as property batch items
+        requests = []
+        def send(messages):
+            requests.append(messages)
+            return device_cloud.STATUS_SUCCESS
+        builder = BatchBuilder("thing", send, max_items=4)
+        builder.add(block)
+        builder.finish()
+        data = []
+        for message in requests[0]:
+            assert message.command["command"] == "property.batch"
+            data += message.command["params"]["data"]
+        assert [(x["key"], x["value"], x["ts"]) for x in data] == items
+
+        # Without timestamps all samples share the block's timestamp
+        block = defs.PublishTelemetryBlock({"z":[1, 2]})
+        assert [x[2] for x in block.items()] == [block.timestamp] * 2
+
+        self.assertRaises(ValueError, defs.PublishTelemetryBlock,
+                          {"x":[1, 2]}, [0])
+        self.assertRaises(TypeError, defs.PublishTelemetryBlock,
+                          {"x":["a"]})
+
+class PublishRecordTimestamp(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        from datetime import datetime
+
+        # Cached formatter matches strftime
+        for epoch in (0, 1.5, 1500000000.123456, 1500000000.9999999,
+                      1500000001.000001):
+            assert defs.format_timestamp(epoch) == \
+                datetime.utcfromtimestamp(epoch).strftime(
+                    device_cloud._core.constants.TIME_FORMAT)
+
+        # Publishes have no __dict__ and format their timestamp when read
+        pub = defs.PublishTelemetry("key", 1.0, timestamp=1500000000.5)
+        assert not hasattr(pub, "__dict__")
+        assert pub.timestamp == "2017-07-14T02:40:00.500000Z"
+        pub = defs.PublishTelemetry("key", 1.0,
+                                    timestamp=datetime(2017, 7, 14, 2, 40))
+        assert pub.timestamp == "2017-07-14T02:40:00.000000Z"
+        pub = defs.PublishTelemetry("key", 1.0, timestamp="2017-07-14T00:00:00Z")
+        assert pub.timestamp == "2017-07-14T00:00:00Z"
+
+        # Records round trip, including ones from before epoch timestamps
+        pub = defs.PublishAlarm("alarm", 2, message="message")
+        restored = defs.publish_from_record(pub.to_record())
+        assert restored.type == "PublishAlarm"
+        assert restored.timestamp == pub.timestamp
+        assert (restored.name, restored.state, restored.message) == \
+            ("alarm", 2, "message")
+        restored = defs.publish_from_record({
+            "type":"PublishAttribute", "timestamp":"2017-07-14T00:00:00Z",
+            "name":"attr", "value":"value"})
+        assert restored.timestamp == "2017-07-14T00:00:00Z"
+        assert restored.value == "value"
+
+        # Any real number is seconds since the epoch (eg. long on Python 2),
+        # in new publishes and in old records
+        from fractions import Fraction
+        pub = defs.PublishTelemetry("key", 1.0, timestamp=Fraction(3, 2))
+        assert pub.timestamp == "1970-01-01T00:00:01.500000Z"
+        restored = defs.publish_from_record({
+            "type":"PublishTelemetry", "timestamp":1500000000,
+            "name":"key", "value":1.0})
+        assert restored.timestamp == "2017-07-14T02:40:00.000000Z"
+
+class JSONCodec(unittest.TestCase):
+    def runTest(self):
+        codec = device_cloud._core.codec
+        tr50 = device_cloud._core.tr50
+
+        previous = codec.codec_name()
+        try:
+            for name in codec.available():
+                codec.set_codec(name)
+                command = tr50.create_property_publish("thing", "key", 1.5)
+                request = tr50.generate_request([command], binary=True)
+                assert isinstance(request, bytes)
+                assert codec.loads(request) == {"1":command}
+                assert codec.loads(request.decode()) == {"1":command}
+                assert tr50.generate_request([command]) == request.decode()
+
+                # Values the library cannot handle fall back to the standard
+                # library
+                assert codec.loads(codec.dumpb({"big":2 ** 70})) == \
+                    {"big":2 ** 70}
+        finally:
+            codec.set_codec(previous)
+
+        assert "json" in codec.available()
+        self.assertRaises(ValueError, codec.get_codec, "notajsonlibrary")
+
+
+class LazyLogMessages(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+
+        class Unrenderable(object):
+            def __format__(self, spec):
+                raise AssertionError("description rendered too early")
+
+        # Nothing is formatted until the description is used
+        lazy = defs.OutMessage({"command":"x"}, "Publish {}",
+                               description_args=[Unrenderable()])
+        summary = defs.RequestSummary([lazy])
+        dump = defs.LazyDump({"b":[1, 2], "a":None})
+
+        message = defs.OutMessage({"command":"x"}, "Publish {} ({} items)",
+                                  description_args=["property", 3])
+        assert message.description == "Publish property (3 items)"
+        assert str(message) == "Publish property (3 items)"
+        message.description = "Renamed"
+        assert str(message) == "Renamed"
+
+        other = defs.OutMessage({"command":"y"}, "Alarm")
+        assert str(defs.RequestSummary([other])) == "Alarm"
+        assert str(defs.RequestSummary([message, other])) == \
+            "2 commands: Renamed; Alarm"
+
+        assert "\n" in str(dump)
+        assert str(defs.LazyDump({"a":1}, compact=True)) == '{"a":1}'
+
+
+class QueuedLogOutput(unittest.TestCase):
+    def runTest(self):
+        import logging
+        import threading
+        logqueue = device_cloud._core.logqueue
+
+        class Stream(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, text):
+                self.writes.append(text)
+            def flush(self):
+                pass
+
+        class Blocking(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.unblock = threading.Event()
+                self.records = []
+            def emit(self, record):
+                self.unblock.wait(5)
+                self.records.append(record.getMessage())
+
+        stream = Stream()
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+        blocking = Blocking()
+        handler = logqueue.QueuedLogHandler([stream_handler, blocking],
+                                            max_records=5, batch_records=100,
+                                            flush_interval=0.05)
+        logger = logging.getLogger("test-queued-log")
+        logger.propagate = False
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            # Written together, in order
+            blocking.unblock.set()
+            for i in range(3):
+                logger.info("line %d", i)
+            handler.flush()
+            assert stream.writes == ["line 0\nline 1\nline 2\n"]
+
+            # Records beyond max_records are dropped and reported
+            blocking.unblock.clear()
+            logger.info("hold")
+            sleep(0.2)
+            for i in range(10):
+                logger.info("burst %d", i)
+            blocking.unblock.set()
+            handler.flush()
+            assert handler.stats() == {"queued":0, "dropped":5}
+            assert blocking.records[-1] == \
+                "Log buffer full, dropped 5 log messages"
+            assert "burst 4" in blocking.records
+            assert "burst 5" not in blocking.records
+
+            # Messages are merged with their arguments when logged, and
+            # exceptions are rendered, so later changes do not show
+            values = [1]
+            try:
+                raise ValueError("bad")
+            except ValueError:
+                logger.exception("values %s", values)
+            values.append(2)
+            handler.flush()
+            assert stream.writes[-1].startswith("values [1]\nTraceback")
+            assert "ValueError: bad" in stream.writes[-1]
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        assert not handler.thread.is_alive()
+
+
+class ClientConcurrentReplies(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self, mock_gethostbyname, mock_mqtt, mock_exists, mock_open,
+                mock_context):
+        import threading
+        # Set up mocks
+        mock_exists.return_value = True
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Connect client to Cloud
+        mqtt = self.client.handler.mqtt
+        result = self.client.connect()
+        assert result == device_cloud.STATUS_SUCCESS
+
+        # Three callers waiting at once
+        results = {}
+        calls = {
+            "property":lambda: self.client.telemetry_read_last_sample("temp"),
+            "attribute":lambda: self.client.attribute_read_last_sample("fw"),
+            "publish":lambda: self.client.telemetry_publish("temp", 1.5,
+                                                            cloud_response=True)
+        }
+        threads = []
+        for name, call in calls.items():
+            thread = threading.Thread(target=lambda n=name, c=call:
+                                      results.__setitem__(n, c()))
+            thread.start()
+            threads.append(thread)
+        for _ in range(50):
+            if mqtt.publish.call_count == 3:
+                break
+            sleep(0.1)
+        assert mqtt.publish.call_count == 3
+
+        # Reply in reverse order. Each caller gets its own reply.
+        topics = {}
+        for args in mqtt.publish.call_args_list:
+            command = json.loads(args[0][1])["1"]["command"]
+            topics[command] = args[0][0][len("api/"):]
+        replies = [
+            ("property.batch", {"success":False, "errorCodes":[-90008]}),
+            ("attribute.current", {"success":True,
+                                   "params":{"value":"1.2", "ts":"ts-fw"}}),
+            ("property.current", {"success":True,
+                                  "params":{"value":21.5, "ts":"ts-temp"}})
+        ]
+        for command, reply in replies:
+            message = mock.Mock()
+            message.payload = json.dumps({"1":reply}).encode()
+            message.topic = "reply/" + topics[command]
+            mqtt.messages.put(message)
+        for thread in threads:
+            thread.join(5)
+            assert not thread.is_alive()
+
+        assert results["property"] == (device_cloud.STATUS_SUCCESS, 21.5,
+                                       "ts-temp")
+        assert results["attribute"] == (device_cloud.STATUS_SUCCESS, "1.2",
+                                        "ts-fw")
+        assert results["publish"] == device_cloud.STATUS_FAILURE
+        assert not self.client.handler.reply_waiters
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.config_args["validate_cloud_cert"] = False
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.disconnect()
+
+
+class ClientReadLastSamples(unittest.TestCase):
+    @mock.patch("ssl.SSLContext")
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    @mock.patch("socket.gethostbyname")
+    def runTest(self, mock_gethostbyname, mock_mqtt, mock_exists, mock_open,
+                mock_context):
+        import threading
+        # Set up mocks
+        mock_exists.return_value = True
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+
+        # Connect client to Cloud
+        mqtt = self.client.handler.mqtt
+        result = self.client.connect()
+        assert result == device_cloud.STATUS_SUCCESS
+
+        # All keys are read in a single request
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.client.telemetry_read_last_samples(["a", "b", "a", "c"])))
+        thread.start()
+        for _ in range(50):
+            if mqtt.publish.call_count:
+                break
+            sleep(0.1)
+        assert mqtt.publish.call_count == 1
+        args = mqtt.publish.call_args[0]
+        jload = json.loads(args[1])
+        assert sorted(jload) == ["1", "2", "3"]
+        assert [jload[x]["command"] for x in ("1", "2", "3")] == \
+            ["property.current"] * 3
+        assert [jload[x]["params"]["key"] for x in ("1", "2", "3")] == \
+            ["a", "b", "c"]
+
+        # Partial failure is reported per key
+        message = mock.Mock()
+        message.payload = json.dumps({
+            "1":{"success":True, "params":{"value":1.0, "ts":"ts-a"}},
+            "2":{"success":False, "errorCodes":[-90008]},
+            "3":{"success":True, "params":{"value":3.0, "ts":"ts-c"}}
+        }).encode()
+        message.topic = "reply/" + args[0][len("api/"):]
+        mqtt.messages.put(message)
+        thread.join(5)
+        assert not thread.is_alive()
+
+        status, values = results[0]
+        assert status == device_cloud.STATUS_FAILURE
+        assert values == {"a":(device_cloud.STATUS_SUCCESS, 1.0, "ts-a"),
+                          "b":(device_cloud.STATUS_FAILURE, None, None),
+                          "c":(device_cloud.STATUS_SUCCESS, 3.0, "ts-c")}
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+        self.config_args["validate_cloud_cert"] = False
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.disconnect()
+
+
+class ValueCacheReads(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        defs = device_cloud._core.defs
+        cache_module = device_cloud._core.cache
+
+        # Least recently used keys are evicted, stale values are not returned
+        cache = cache_module.ValueCache(ttl=60, max_keys=2)
+        cache.put("property", "a", 1, "ts-a")
+        cache.put("property", "b", 2, "ts-b")
+        assert cache.get("property", "a") == (1, "ts-a")
+        cache.put("attribute", "b", "x", "ts-x")
+        assert cache.get("property", "b") is None
+        assert cache.get("property", "a") == (1, "ts-a")
+        assert cache.get("attribute", "b") == ("x", "ts-x")
+        cache.ttl = -1
+        assert cache.get("property", "a") is None
+        assert cache.stats() == {"keys":1, "hits":3, "misses":2}
+
+        # Older values do not replace newer ones
+        cache.ttl = 60
+        cache.put("property", "t", 2, "2017-07-14T02:40:00.500000Z")
+        cache.put("property", "t", 1, "2017-07-14T02:40:00Z")
+        assert cache.get("property", "t") == (2, "2017-07-14T02:40:00.500000Z")
+        cache.put("property", "t", 3, "2017-07-14T02:40:01Z")
+        assert cache.get("property", "t") == (3, "2017-07-14T02:40:01Z")
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "value_cache":{"ttl":60, "max_keys":10}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.flush_scheduler.notify = mock.Mock()
+
+        # Published values are served without asking the Cloud
+        self.client.telemetry_publish("temp", 21.5)
+        self.client.attribute_publish("fw", "1.2")
+        block = defs.PublishTelemetryBlock({"x":[1, 2, 3]},
+                                           timestamps=[0, 1, 2])
+        handler.queue_publish(block)
+        handler.handle_publish()
+
+        # Nothing is cached until the Cloud accepts the publishes
+        assert handler.value_cache.stats()["keys"] == 0
+        for out_id in [out_id for out_id, _ in handler.reply_tracker.items()]:
+            topic_num, command_num = out_id.split("-")
+            handler.handle_message(defs.Message(
+                "reply/" + topic_num, {command_num:{"success":True}}))
+
+        status, values = self.client.telemetry_read_last_samples(["temp", "x"])
+        assert status == device_cloud.STATUS_SUCCESS
+        assert values["temp"][:2] == (device_cloud.STATUS_SUCCESS, 21.5)
+        assert values["x"] == (device_cloud.STATUS_SUCCESS, 3.0,
+                               "1970-01-01T00:00:02.000000Z")
+        result = self.client.attribute_read_last_sample("fw")
+        assert result[:2] == (device_cloud.STATUS_SUCCESS, "1.2")
+        assert [x[0][1] for x in handler.mqtt.publish.call_args_list
+                if b"current" in x[0][1]] == []
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+
+
+class EventDrivenWaits(unittest.TestCase):
+    def runTest(self):
+        import threading
+        defs = device_cloud._core.defs
+        constants = device_cloud._core.constants
+
+        # Work queue drain wakes the waiter
+        work_queue = defs.WorkQueue()
+        assert work_queue.wait_empty(0)
+        work_queue.put(defs.Work(constants.WORK_PUBLISH, None))
+        assert not work_queue.wait_empty(0.01)
+        timer = threading.Timer(0.05, work_queue.get)
+        timer.start()
+        assert work_queue.wait_empty(5)
+        timer.join()
+
+        # Transfer status sets and clears its completion event
+        transfer = defs.FileTransfer("file", "/tmp/file", None)
+        assert not transfer.done.is_set()
+        timer = threading.Timer(0.05, setattr,
+                                (transfer, "status", constants.STATUS_SUCCESS))
+        timer.start()
+        assert transfer.done.wait(5)
+        timer.join()
+        transfer.status = None
+        assert not transfer.done.is_set()
+
+        # Waiting for a transfer stops when the Client quits
+        Handler = device_cloud._core.handler.Handler
+        handler = mock.Mock(spec=Handler)
+        handler.to_quit = False
+        handler.config = mock.Mock(loop_time=0.01)
+        timer = threading.Timer(0.05, setattr, (handler, "to_quit", True))
+        timer.start()
+        assert Handler.wait_transfer(handler, transfer) == \
+            constants.STATUS_TIMED_OUT
+        timer.join()
+        transfer.status = constants.STATUS_SUCCESS
+        assert Handler.wait_transfer(handler, transfer, 1) == \
+            constants.STATUS_SUCCESS
+
+
+class ReplyTrackerExpiry(unittest.TestCase):
+    def runTest(self):
+        defs = device_cloud._core.defs
+        tracker_module = device_cloud._core.tracker
+        tr50 = device_cloud._core.tr50
+
+        tracker = tracker_module.ReplyTracker(timeout=10, max_messages=3,
+                                              retransmit=["property.current"],
+                                              max_retransmits=1)
+        def sent(command, out_id, attempts=0):
+            message = defs.OutMessage(command, "Read {}",
+                                      description_args=(out_id,))
+            message.out_id = out_id
+            message.attempts = attempts
+            return tracker.add_message(message)
+
+        read = tr50.create_property_get_current("thing", "temp")
+        publish = tr50.create_property_publish("thing", "temp", 1.0)
+        assert sent(read, "0001-1") == []
+        assert sent(publish, "0001-2") == []
+        assert sent(read, "0002-1", attempts=1) == []
+
+        # Only commands that may be retransmitted keep their payload
+        messages = dict(tracker.items())
+        assert messages["0001-1"].command is read
+        assert messages["0001-2"].command is None
+        assert messages["0001-2"].key == "temp"
+        assert str(messages["0002-1"]) == "Read 0002-1"
+
+        # Replied messages are not expired
+        assert tracker.pop_message("0001", "2").command_type == \
+            "property.publish"
+        self.assertRaises(KeyError, tracker.pop_message, "0001", "2")
+
+        now = messages["0001-1"].deadline
+        assert tracker.expire(now - 1) == ([], [])
+        retransmit, failed = tracker.expire(now + 1)
+        assert [x.out_id for x in retransmit] == ["0001-1"]
+        assert [x.out_id for x in failed] == ["0002-1"]
+        assert len(tracker) == 0
+
+        # Oldest messages are dropped past max_messages
+        for i in range(5):
+            dropped = sent(publish, "0003-{}".format(i))
+        assert [x.out_id for x in dropped] == ["0003-1"]
+        assert len(tracker) == 3
+        assert tracker.stats() == {"tracked":3, "expired":2,
+                                   "retransmitted":1, "dropped":2}
+
+
+class NoReplyPublish(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "no_reply":["telemetry"]}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.flush_scheduler.notify = mock.Mock()
+
+        # Telemetry goes out at QoS 0 without tracking, attributes do not
+        self.client.telemetry_publish("temp", 21.5)
+        self.client.attribute_publish("fw", "1.2")
+        handler.handle_publish()
+        calls = handler.mqtt.publish.call_args_list
+        topics = dict((x[0][0], x[1].get("qos")) for x in calls)
+        assert topics["api/n0001"] == 0
+        assert [x for x in topics if not x.startswith("api/n")] == \
+            ["api/0001"]
+        assert [x[0] for x in handler.reply_tracker.items()] == ["0001-1"]
+
+        # Replies to untracked requests are dropped without decoding
+        reply = mock.Mock(topic="reply/n0001", payload=b"not json")
+        handler.on_message(None, None, reply)
+        assert handler.pools["messages"].queue.empty()
+
+        # Unknown publish types are rejected
+        handler.config.no_reply = ["bogus"]
+        self.assertRaises(KeyError, device_cloud._core.handler.Handler,
+                          handler.config, self.client)
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+
+
+class ReplyDispatch(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+
+        replies = []
+        def on_reply(client, sent_message, reply, user_data):
+            assert isinstance(sent_message, defs.OutMessage)
+            assert sent_message.command == {"command":"thing.find"}
+            replies.append((client, sent_message.out_id, reply["success"],
+                            user_data))
+        notifications = []
+        def on_notify(client, message, user_data):
+            notifications.append((message.topic, user_data))
+
+        assert self.client.reply_register_callback(
+            "thing.find", on_reply, "data") == device_cloud.STATUS_SUCCESS
+        assert self.client.notify_register_callback(
+            "custom", on_notify, 5) == device_cloud.STATUS_SUCCESS
+
+        # Several replies in one message reach their handlers in order
+        for out_id in ("0001-1", "0001-2"):
+            message = defs.OutMessage({"command":"thing.find"}, "Find")
+            message.out_id = out_id
+            handler.reply_tracker.add_message(message)
+        reply = defs.Message("reply/0001", {"1":{"success":True},
+                                            "2":{"success":False}})
+        handler.handle_message(reply)
+        assert replies == [(self.client, "0001-1", True, "data"),
+                           (self.client, "0001-2", False, "data")]
+        assert len(handler.reply_tracker) == 0
+
+        # The error handler gets an OutMessage summing up the command sent
+        errors = []
+        self.client.error_handler = lambda codes, sent, reply: errors.append(
+            (codes, sent, reply))
+        command = {"command":"thing.find", "params":{"key":"k", "x":1}}
+        message = defs.OutMessage(command, "Find")
+        message.out_id = "0002-1"
+        handler.reply_tracker.add_message(message)
+        handler.handle_message(defs.Message(
+            "reply/0002", {"1":{"success":False, "errorCodes":[-90008]}}))
+        codes, sent, _ = errors[0]
+        assert codes == [-90008]
+        assert isinstance(sent, defs.OutMessage)
+        assert sent.command == {"command":"thing.find", "params":{"key":"k"}}
+        assert sent.out_id == "0002-1"
+        message = defs.OutMessage(command, "Find")
+        message.out_id = "0003-1"
+        handler.reply_tracker.add_message(message)
+        handler.reply_failed(handler.reply_tracker.pop_message("0003", "1"),
+                             "no reply")
+        assert errors[1][1].command == {"command":"thing.find",
+                                        "params":{"key":"k"}}
+        assert errors[1][2] == "no reply"
+
+        # With an error handler set, timed out batches still fail rather
+        # than being sent again
+        batch = tr50.create_property_publish("thing", "batch", "Batch",
+                                             batch=True)
+        handler.send([defs.OutMessage(batch, "Batch")])
+        tracked = list(handler.reply_tracker.items())[-1][1]
+        assert tracked.command is None
+        retransmit, failed = handler.reply_tracker.expire(now=float("inf"))
+        assert retransmit == []
+        assert [x.command_type for x in failed] == ["property.batch"]
+        handler.reply_failed(failed[0], "no reply")
+        assert errors[2][1].command == {"command":"property.batch",
+                                        "params":{"key":"batch"}}
+        self.client.error_handler = None
+
+        # Notifications without a handler are not supported
+        assert handler.handle_message(defs.Message("notify/custom", {})) == \
+            device_cloud.STATUS_SUCCESS
+        assert handler.handle_message(defs.Message("notify/other", {})) == \
+            device_cloud.STATUS_NOT_SUPPORTED
+        assert notifications == [("notify/custom", 5)]
+
+        # Core handlers are kept when application callbacks are removed
+        assert self.client.reply_deregister_callback(
+            "thing.find", on_reply) == device_cloud.STATUS_SUCCESS
+        assert self.client.reply_deregister_callback(
+            "thing.find", on_reply) == device_cloud.STATUS_NOT_FOUND
+        assert "thing.find" not in handler.reply_handlers
+        assert handler.reply_handlers[tr50.TR50Command.file_get] == \
+            [handler.reply_file_get]
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+
+
+class ReceivedMessageDecoding(unittest.TestCase):
+    def runTest(self):
+        codec = device_cloud._core.codec
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        handler_module = device_cloud._core.handler
+
+        # Payloads are only decoded when used
+        message = defs.Message("reply/0001", payload=b"not json")
+        self.assertRaises(ValueError, getattr, message, "json")
+        message = defs.Message("reply/0001", payload=b'{"1":{"success":true}}')
+        assert list(message.items()) == [("1", {"success":True})]
+        assert defs.Message("notify/x", {"a":1}).json == {"a":1}
+
+        # Large payloads are streamed when ijson is installed
+        with mock.patch.object(codec, "ijson") as mock_ijson:
+            mock_ijson.kvitems.return_value = iter([("1", {"success":True})])
+            assert list(codec.iter_items(b'{"1":{}}', 4)) == \
+                [("1", {"success":True})]
+            assert list(codec.iter_items(b'{"1":{}}', 1024)) == [("1", {})]
+            assert mock_ijson.kvitems.call_count == 1
+        with mock.patch.object(codec, "ijson", None):
+            assert list(codec.iter_items(b'{"1":{}}', 4)) == [("1", {})]
+
+        # The network thread queues the raw payload, workers decode it
+        handler = mock.Mock(queue=defs.WorkQueue())
+        handler.queue_work = handler.queue.put
+        raw = mock.Mock(topic="reply/0002", payload=b"{broken")
+        handler_module.Handler.on_message(handler, None, None, raw)
+        work = handler.queue.get_nowait()
+        assert work.data.payload == b"{broken"
+        handler.logger.isEnabledFor.return_value = False
+        assert handler_module.Handler.handle_message(handler, work.data) == \
+            constants.STATUS_PARSE_ERROR
+
+
+class StreamedMailboxReply(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        codec = device_cloud._core.codec
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client, logging at DEBUG
+        self.client = device_cloud.Client("testing-client")
+        self.client.initialize()
+        handler = self.client.handler
+        assert handler.logger.isEnabledFor(logging.DEBUG)
+
+        check = defs.OutMessage(tr50.create_mailbox_check(False),
+                                "Mailbox Check")
+        check.out_id = "0001-1"
+        handler.reply_tracker.add_message(check)
+
+        # ijson events for {"1":{"success":true,"params":{"messages":[...]}}}
+        events = [("", "start_map", None), ("", "map_key", "1"),
+                  ("1", "start_map", None), ("1", "map_key", "success"),
+                  ("1.success", "boolean", True),
+                  ("1", "map_key", "params"),
+                  ("1.params", "start_map", None),
+                  ("1.params", "map_key", "messages"),
+                  ("1.params.messages", "start_array", None),
+                  ("1.params.messages.item", "start_map", None),
+                  ("1.params.messages.item", "map_key", "id"),
+                  ("1.params.messages.item.id", "string", "m1"),
+                  ("1.params.messages.item", "end_map", None),
+                  ("1.params.messages", "end_array", None),
+                  ("1.params", "end_map", None),
+                  ("1", "end_map", None), ("", "end_map", None)]
+        mails = [{"id":"m{}".format(i), "command":"method.exec",
+                  "params":{"method":"action", "params":{}}}
+                 for i in range(3)]
+
+        # The payload is never decoded in full, not even for the debug log,
+        # and the mailbox entries are decoded one at a time
+        payload = b"x" * (device_cloud._core.constants.STREAM_DECODE_BYTES + 1)
+        message = defs.Message("reply/0001", payload=payload)
+        with mock.patch.object(codec, "ijson") as mock_ijson:
+            mock_ijson.parse.return_value = iter(events)
+            mock_ijson.items.side_effect = lambda *args, **kwargs: iter(mails)
+            assert handler.handle_message(message) == \
+                device_cloud.STATUS_SUCCESS
+        assert message._json is None
+        mock_ijson.kvitems.assert_not_called()
+        assert mock_ijson.items.call_args[0][1] == "1.params.messages.item"
+        queue = handler.pools["actions"].queue
+        assert [queue.get_nowait().data.request_id for _ in range(3)] == \
+            ["m0", "m1", "m2"]
+        assert len(handler.reply_tracker) == 0
+
+        # Other commands in a large reply are streamed whole
+        with mock.patch.object(codec, "ijson") as mock_ijson:
+            mock_ijson.kvitems.return_value = iter([("1", {"success":True})])
+            assert list(defs.Message("reply/0002", payload=payload).items()) \
+                == [("1", {"success":True})]
+            mock_ijson.kvitems.assert_called_once()
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+
+class SeparateWorkPools(unittest.TestCase):
+    def runTest(self):
+        import threading
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        workpool = device_cloud._core.workpool
+
+        # A pool whose only worker is stuck does not hold up another pool
+        unblock = threading.Event()
+        started = threading.Event()
+        handled = threading.Event()
+        logger = mock.Mock()
+        def block(work):
+            started.set()
+            unblock.wait(5)
+        slow = workpool.WorkPool("actions", block, 1, logger, loop_time=0.1)
+        fast = workpool.WorkPool("messages", lambda work: handled.set(), 1,
+                                 logger, loop_time=0.1)
+        slow.start()
+        fast.start()
+        try:
+            for _ in range(3):
+                slow.put(defs.Work(constants.WORK_ACTION, None))
+            assert started.wait(5)
+            fast.put(defs.Work(constants.WORK_MESSAGE, None))
+            assert handled.wait(5)
+            assert fast.wait_empty(5)
+            stats = slow.stats()
+            assert stats["threads"] == 1
+            assert stats["busy"] == 1
+            assert stats["queued"] == 2
+            assert stats["max_queued"] >= 2
+        finally:
+            unblock.set()
+            assert slow.wait_empty(5)
+            slow.stop()
+            fast.stop()
+        assert slow.stats()["handled"] == 3
+        assert fast.stats()["handled"] == 1
+
+        # Exceptions are logged without killing the worker
+        def fail(work):
+            raise ValueError(work.data)
+        pool = workpool.WorkPool("publish", fail, 1, logger, loop_time=0.1)
+        pool.start()
+        pool.put(defs.Work(constants.WORK_PUBLISH, "boom"))
+        pool.put(defs.Work(constants.WORK_PUBLISH, "boom"))
+        assert pool.wait_empty(5)
+        pool.stop()
+        assert logger.exception.call_count == 2
+        assert not pool.workers
+
+
+class PriorityWork(unittest.TestCase):
+    def runTest(self):
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        queue = device_cloud._core.workpool.queue
+
+        # Higher priorities go first, in order within a priority
+        work_queue = defs.PriorityWorkQueue(maxsize=5, aging=0)
+        for work_type, data in ((constants.WORK_UPLOAD, "upload"),
+                                (constants.WORK_PUBLISH, "publish"),
+                                (constants.WORK_MESSAGE, "reply 1"),
+                                (constants.WORK_MESSAGE, "reply 2")):
+            work_queue.put_nowait(defs.Work(work_type, data))
+        work_queue.put_nowait(defs.Work(constants.WORK_MESSAGE, "notify",
+                                        priority=constants.PRIORITY_CONTROL))
+        self.assertRaises(queue.Full, work_queue.put_nowait,
+                          defs.Work(constants.WORK_ACTION, "action"))
+        assert [work_queue.get_nowait().data for _ in range(5)] == \
+            ["notify", "reply 1", "reply 2", "publish", "upload"]
+        assert work_queue.wait_empty(0)
+        stats = work_queue.stats()
+        assert stats["reply"]["taken"] == 2
+        assert stats["transfer"]["queued"] == 0
+        assert stats["control"]["wait_max"] >= 0.0
+
+        # Work that has waited long enough is not starved
+        work_queue = defs.PriorityWorkQueue(aging=10)
+        with mock.patch.object(device_cloud._core.defs,
+                               "monotonic") as mock_time:
+            mock_time.return_value = 100
+            work_queue.put(defs.Work(constants.WORK_DOWNLOAD, "download"))
+            work_queue.put(defs.Work(constants.WORK_MESSAGE, "reply"))
+            assert work_queue.get().data == "reply"
+            mock_time.return_value = 125
+            work_queue.put(defs.Work(constants.WORK_MESSAGE, "reply"))
+            assert work_queue.get().data == "download"
+            assert work_queue.stats()["transfer"]["wait_max"] == 25
+
+
+class ElasticWorkPool(unittest.TestCase):
+    def runTest(self):
+        import threading
+        import time
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        workpool = device_cloud._core.workpool
+
+        unblock = threading.Event()
+        started = threading.Semaphore(0)
+        def block(work):
+            started.release()
+            unblock.wait(5)
+        logger = mock.Mock()
+        pool = workpool.WorkPool("actions", block, 0, logger, loop_time=0.1,
+                                 max_threads=3, grow_wait=0, idle_time=0.2)
+        pool.start()
+        try:
+            # Workers are added while every worker is busy, up to max_threads
+            assert pool.stats()["threads"] == 0
+            for count in range(1, 4):
+                pool.put(defs.Work(constants.WORK_ACTION, None))
+                assert started.acquire(timeout=5)
+                assert pool.stats()["threads"] == count
+            pool.put(defs.Work(constants.WORK_ACTION, None))
+            stats = pool.stats()
+            assert stats["threads"] == 3
+            assert stats["grown"] == 3
+            assert stats["queued"] == 1
+
+            # Idle workers beyond the minimum exit
+            unblock.set()
+            end_time = time.time() + 5
+            while pool.stats()["threads"] and time.time() < end_time:
+                time.sleep(0.05)
+            stats = pool.stats()
+            assert stats["threads"] == 0
+            assert stats["shrunk"] == 3
+            assert stats["handled"] == 4
+            assert logger.info.call_count == 6
+        finally:
+            unblock.set()
+            pool.stop()
+
+        # Work queued within grow_wait of a put is checked again while every
+        # worker stays busy, and idle_time 0 ends extra workers straight away
+        unblock.clear()
+        started = threading.Semaphore(0)
+        pool = workpool.WorkPool("actions", block, 1, logger, loop_time=0.1,
+                                 max_threads=2, grow_wait=0.2, idle_time=0)
+        assert pool.idle_time == 0
+        pool.start()
+        try:
+            pool.put(defs.Work(constants.WORK_ACTION, None))
+            assert started.acquire(timeout=5)
+            pool.put(defs.Work(constants.WORK_ACTION, None))
+            assert pool.stats()["threads"] == 1
+            assert started.acquire(timeout=5)
+            assert pool.stats()["threads"] == 2
+            unblock.set()
+            end_time = time.time() + 5
+            while pool.stats()["threads"] > 1 and time.time() < end_time:
+                time.sleep(0.05)
+            assert pool.stats()["threads"] == 1
+        finally:
+            unblock.set()
+            pool.stop()
+        assert pool.monitor is None
+
+
+class ActionLimits(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        import threading
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0,
+                  "action_limits":{"default":{"max_concurrent":1},
+                                   "hang":{"timeout":0.1},
+                                   "busy":{"when_busy":"reject"}}}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        handler = self.client.handler
+        handler.send = mock.Mock(return_value=constants.STATUS_SUCCESS)
+        def acks():
+            return [(x[0][0].command["params"]["id"],
+                     x[0][0].command["params"]["errorCode"])
+                    for x in handler.send.call_args_list]
+
+        # A callback that runs too long is cancelled and acked as timed out
+        finished = threading.Event()
+        def hang(client, params, user_data, request, cancel_token):
+            assert cancel_token is request.cancel_token
+            cancel_token.wait(5)
+            finished.set()
+            return constants.STATUS_SUCCESS
+        handler.action_register_callback("hang", hang)
+        request = defs.ActionRequest("1", "hang", {})
+        handler.handle_action(request)
+        assert request.cancel_token.cancelled
+        assert finished.wait(5)
+        assert acks() == [("1", tr50.translate_error_code(
+            constants.STATUS_TIMED_OUT))]
+
+        # Requests over max_concurrent wait for the running one
+        handler.action_register_callback("busy", lambda client: 0)
+        handler.action_register_callback("queue", lambda client: 0)
+        handler.action_running["queue"] = 1
+        handler.handle_action(defs.ActionRequest("2", "queue", {}))
+        assert len(acks()) == 1
+        handler.action_done("queue")
+        work = handler.pools["actions"].queue.get_nowait()
+        assert work.data.request_id == "2"
+        assert handler.action_running["queue"] == 0
+        handler.handle_action(work.data)
+        assert acks()[-1] == ("2", 0)
+        assert handler.action_running["queue"] == 0
+
+        # A re-queued request that loses its slot keeps its place
+        handler.action_running["queue"] = 1
+        handler.handle_action(defs.ActionRequest("4", "queue", {}))
+        handler.handle_action(defs.ActionRequest("5", "queue", {}))
+        handler.action_done("queue")
+        work = handler.pools["actions"].queue.get_nowait()
+        assert work.data.request_id == "4"
+        handler.action_running["queue"] = 1
+        handler.handle_action(work.data)
+        assert [x.request_id for x in handler.action_pending["queue"]] == \
+            ["4", "5"]
+
+        # A request that cannot be re-queued is acked so the Cloud retries it
+        with mock.patch.object(handler, "queue_work",
+                               return_value=constants.STATUS_FULL):
+            handler.action_done("queue")
+        assert acks()[-1] == ("4", tr50.translate_error_code(
+            constants.STATUS_TRY_AGAIN))
+
+        # or are rejected
+        handler.action_running["busy"] = 1
+        handler.handle_action(defs.ActionRequest("3", "busy", {}))
+        assert acks()[-1] == ("3", tr50.translate_error_code(
+            constants.STATUS_TRY_AGAIN))
+        assert handler.action_running["busy"] == 1
+
+        # Requests still waiting at disconnect are acked too
+        handler.disconnect()
+        assert acks()[-1] == ("5", tr50.translate_error_code(
+            constants.STATUS_TRY_AGAIN))
+        assert not handler.action_pending
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads have stopped
+        self.client.handler.to_quit = True
+
+
+def process_action(client, params, user_data, request):
+    # Runs in a pool process for ProcessActions
+    return (0, "{} {}".format(os.getpid(), user_data),
+            {"total":sum(params["values"]), "client":client is None,
+             "id":request.request_id})
+
+def crashing_action(client, params):
+    # Kills its pool process for ProcessActions
+    os._exit(1)
+
+def hanging_action(client, params):
+    # Never returns, for ProcessActions
+    import time
+    time.sleep(60)
+    return 0
+
+
+class ProcessActions(unittest.TestCase):
+    @mock.patch(builtin + ".open")
+    @mock.patch("os.path.exists")
+    @mock.patch("paho.mqtt.client.Client")
+    def runTest(self, mock_mqtt, mock_exists, mock_open):
+        constants = device_cloud._core.constants
+        defs = device_cloud._core.defs
+        tr50 = device_cloud._core.tr50
+
+        # Set up mocks
+        mock_exists.side_effect = [True, True, True]
+        read_strings = [json.dumps(self.config_args), helpers.uuid]
+        mock_read = mock_open.return_value.__enter__.return_value.read
+        mock_read.side_effect = read_strings
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+
+        # Initialize client
+        kwargs = {"loop_time":1, "thread_count":0, "action_processes":1}
+        self.client = device_cloud.Client("testing-client", kwargs)
+        self.client.initialize()
+        # Starting pool processes needs the real file system
+        mock_exists.side_effect = os.path.lexists
+        mock_open.side_effect = io.open
+        handler = self.client.handler
+        handler.send = mock.Mock(return_value=constants.STATUS_SUCCESS)
+        def last_ack():
+            return handler.send.call_args[0][0].command["params"]
+
+        # Callbacks that cannot be pickled are refused
+        assert self.client.action_register_callback(
+            "lambda", lambda client: 0, executor="process") == \
+            device_cloud.STATUS_BAD_PARAMETER
+        assert self.client.action_register_callback(
+            "bogus", process_action, executor="fiber") == \
+            device_cloud.STATUS_BAD_PARAMETER
+
+        # Results come back through the normal acknowledgement
+        assert self.client.action_register_callback(
+            "sum", process_action, "data", executor="process") == \
+            device_cloud.STATUS_SUCCESS
+        handler.handle_action(defs.ActionRequest("1", "sum",
+                                                 {"values":[1, 2, 3]}))
+        params = last_ack()
+        assert params["id"] == "1"
+        assert params["errorCode"] == 0
+        pid, user_data = params["errorMessage"].split()
+        assert int(pid) != os.getpid()
+        assert user_data == "data"
+        assert params["params"] == {"total":6, "client":True, "id":"1"}
+
+        # A process that dies does not take the Client with it
+        self.client.action_register_callback("crash", crashing_action,
+                                             executor="process")
+        handler.handle_action(defs.ActionRequest("2", "crash", {}))
+        assert last_ack()["errorCode"] == tr50.translate_error_code(
+            constants.STATUS_EXECUTION_ERROR)
+        handler.handle_action(defs.ActionRequest("3", "sum", {"values":[4]}))
+        assert last_ack()["params"]["total"] == 4
+
+        # A process that times out is killed, freeing its place in the pool
+        self.client.config.action_limits = {"hang":{"timeout":0.5}}
+        self.client.action_register_callback("hang", hanging_action,
+                                             executor="process")
+        handler.handle_action(defs.ActionRequest("4", "hang", {}))
+        assert last_ack()["errorCode"] == tr50.translate_error_code(
+            constants.STATUS_TIMED_OUT)
+        handler.handle_action(defs.ActionRequest("5", "sum", {"values":[5]}))
+        assert last_ack()["params"]["total"] == 5
+
+    def setUp(self):
+        # Configuration to be 'read' from config file
+        self.config_args = helpers.config_file_default()
+
+    def tearDown(self):
+        # Ensure threads and processes have stopped
+        self.client.handler.action_processes.shutdown()
+        self.client.handler.to_quit = True
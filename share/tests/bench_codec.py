@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of the JSON codecs installed on this system.
+
+Encodes typical TR50 requests (a property batch, and a mix of attribute, alarm
+and location batches) as bytes ready for MQTT, and decodes typical replies.
+Prints requests/second for each codec:
+
+    ./bench_codec.py --items 500 --rounds 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import codec
+from device_cloud._core import defs
+from device_cloud._core import tr50
+from device_cloud._core.batch import BatchBuilder
+
+
+def build_requests(items):
+    """
+    Return a list of lists of TR50 commands, one list per request
+    """
+
+    requests = []
+    def send(messages):
+        requests.append([x.command for x in messages])
+        return 0
+
+    builder = BatchBuilder("device-app", send, max_bytes=10 ** 9,
+                           max_items=items)
+    for i in range(items):
+        builder.add(defs.PublishTelemetry("temperature", 20.0 + i / 100.0))
+    builder.finish()
+
+    builder = BatchBuilder("device-app", send, max_bytes=10 ** 9,
+                           max_items=items)
+    for i in range(items // 3):
+        builder.add(defs.PublishAttribute("firmware", "1.2.{}".format(i)))
+        builder.add(defs.PublishAlarm("overheat", i % 3, message="Too hot"))
+        builder.add(defs.PublishLocation(45.4215 + i, -75.6972, heading=90))
+    builder.finish()
+    return requests
+
+def build_replies(items):
+    """
+    Return typical replies as bytes: a batch acknowledgement and a
+    property.current reply
+    """
+
+    batch = dict((str(i + 1), {"success":True}) for i in range(4))
+    current = {"1":{"success":True,
+                    "params":{"value":21.5, "ts":"2017-07-14T02:40:00.000Z"}}}
+    mailbox = {"1":{"success":True,
+                    "params":{"messages":[
+                        {"command":"method.exec", "id":str(i),
+                         "params":{"method":"action", "params":{"x":i}}}
+                        for i in range(items // 50 or 1)]}}}
+    return [codec.STDLIB.dumpb(x) for x in (batch, current, mailbox)]
+
+
+def bench(name, requests, replies, rounds):
+    codec.set_codec(name)
+    start = time.time()
+    size = 0
+    for _ in range(rounds):
+        for commands in requests:
+            size = len(tr50.generate_request(commands, binary=True))
+    encode = rounds * len(requests) / (time.time() - start)
+
+    start = time.time()
+    for _ in range(rounds):
+        for reply in replies:
+            codec.loads(reply)
+    decode = rounds * len(replies) / (time.time() - start)
+    return encode, decode, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON codec benchmark")
+    parser.add_argument("--items", type=int, default=500,
+                        help="Items per batch command (default 500)")
+    parser.add_argument("--rounds", type=int, default=200,
+                        help="Times each payload is encoded/decoded "
+                        "(default 200)")
+    args = parser.parse_args()
+
+    requests = build_requests(args.items)
+    replies = build_replies(args.items)
+    print("{:<12} {:>14} {:>14} {:>14}".format("codec", "encode req/s",
+                                               "decode msg/s", "bytes"))
+    for name in codec.available():
+        encode, decode, size = bench(name, requests, replies, args.rounds)
+        print("{:<12} {:>14.0f} {:>14.0f} {:>14}".format(name, encode, decode,
+                                                         size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of the publish queue with and without the on-disk journal.
+
+Queues and then drains a number of telemetry samples for each journal sync
+policy and prints samples/second. Run on the target device with the journal
+directory on the storage that will be used in production (eg. flash):
+
+    ./bench_journal.py --count 50000 --dir /var/lib/device_cloud
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import defs
+from device_cloud._core.journal import Journal
+from device_cloud._core.pubqueue import PublishQueue
+
+
+def run(count, journal):
+    """
+    Queue then drain count samples, returning (put/s, get/s)
+    """
+
+    pub_queue = PublishQueue(journal)
+    samples = [defs.PublishTelemetry("property", float(i))
+               for i in range(count)]
+
+    start = time.time()
+    for pub in samples:
+        pub_queue.put(pub)
+    pub_queue.flush()
+    put_time = time.time() - start
+
+    start = time.time()
+    while not pub_queue.empty():
+        pub = pub_queue.get()
+        # Answered straight away
+        if pub.journal_id is not None:
+            pub_queue.release(pub.journal_id)
+    pub_queue.flush()
+    get_time = time.time() - start
+
+    if journal is not None:
+        journal.close()
+    return count / put_time, count / get_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish journal benchmark")
+    parser.add_argument("--count", type=int, default=20000,
+                        help="Number of samples to queue (default 20000)")
+    parser.add_argument("--dir", help="Directory for the journal file "
+                        "(default: a temporary directory)")
+    args = parser.parse_args()
+
+    journal_dir = args.dir or tempfile.mkdtemp()
+    print("{:<24} {:>14} {:>14}".format("mode", "put/s", "get/s"))
+    try:
+        results = [("memory", run(args.count, None))]
+        for sync in ("off", "batch", "always"):
+            count = args.count
+            if sync == "always":
+                # One commit per sample, keep the run short
+                count = min(count, 1000)
+            path = os.path.join(journal_dir, "bench-{}.db".format(sync))
+            if os.path.exists(path):
+                os.remove(path)
+            results.append(("journal sync={}".format(sync),
+                            run(count, Journal(path, sync=sync))))
+            os.remove(path)
+        for name, (puts, gets) in results:
+            print("{:<24} {:>14.0f} {:>14.0f}".format(name, puts, gets))
+    finally:
+        if not args.dir:
+            shutil.rmtree(journal_dir)
+
+
+if __name__ == "__main__":
+    main()
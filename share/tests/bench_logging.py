@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of publish throughput at each log level.
+
+Queues telemetry and runs the publish path (batching, serialisation, request
+tracking and logging) against a fake MQTT client, with log output written to
+/dev/null. Prints samples/second for each log level, with and without
+log_compact:
+
+    ./bench_logging.py --count 20000 --items 50
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+
+
+class FakeMQTT(object):
+    """
+    Accepts publishes without sending them anywhere
+    """
+
+    def __init__(self):
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        return 0, self.mid
+
+
+def make_handler(level, compact, items):
+    config = defs.Config()
+    config.update({"key":"bench-device", "cloud":{"token":"token",
+                                                  "host":"localhost",
+                                                  "port":1883},
+                   "proxy":{}, "quiet":True, "api_rate":0, "control_rate":0,
+                   "max_batch_items":items, "log_compact":compact})
+    handler = Handler(config, None)
+    for log_handler in list(handler.logger.handlers):
+        handler.logger.removeHandler(log_handler)
+    log_handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.logger.addHandler(log_handler)
+    handler.logger.setLevel(level)
+    handler.mqtt = FakeMQTT()
+    return handler
+
+def run(level, compact, count, items):
+    handler = make_handler(level, compact, items)
+    for i in range(count):
+        handler.queue_publish(defs.PublishTelemetry("property", float(i)))
+    start = time.time()
+    handler.handle_publish()
+    elapsed = time.time() - start
+    handler.reply_tracker.clear()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logging overhead benchmark")
+    parser.add_argument("--count", type=int, default=20000,
+                        help="Number of samples to publish (default 20000)")
+    parser.add_argument("--items", type=int, default=50,
+                        help="Items per batch command (default 50)")
+    args = parser.parse_args()
+
+    print("{:<10} {:>16} {:>16}".format("level", "samples/s",
+                                        "compact samples/s"))
+    for level in ("DEBUG", "INFO", "WARNING"):
+        results = [run(getattr(logging, level), compact, args.count, args.items)
+                   for compact in (False, True)]
+        print("{:<10} {:>16.0f} {:>16.0f}".format(level, *results))
+
+
+if __name__ == "__main__":
+    main()
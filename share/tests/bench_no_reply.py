@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of telemetry sent with and without reply tracking.
+
+Publishes telemetry through the publish path against a fake MQTT client, then
+delivers a success reply for every request and handles it the way the worker
+threads do. Prints requests and samples per second with reply tracking and
+with the no_reply fast path:
+
+    ./bench_no_reply.py --batches 2000 --items 10 --max-bytes 1024
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import codec
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+
+
+class FakeMQTT(object):
+    """
+    Records published topics instead of sending them
+    """
+
+    def __init__(self):
+        self.mid = 0
+        self.topics = []
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        self.topics.append((topic, payload))
+        return 0, self.mid
+
+
+class FakeMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_handler(no_reply, items, max_bytes):
+    config = defs.Config()
+    config.update({"key":"bench-device", "cloud":{"token":"token",
+                                                  "host":"localhost",
+                                                  "port":1883},
+                   "proxy":{}, "quiet":True, "api_rate":0,
+                   "max_batch_items":items, "max_payload_bytes":max_bytes,
+                   "qos_level":1,
+                   "no_reply":["telemetry"] if no_reply else []})
+    handler = Handler(config, None)
+    handler.logger.setLevel(logging.WARNING)
+    handler.mqtt = FakeMQTT()
+    return handler
+
+def run(no_reply, batches, items, max_bytes):
+    handler = make_handler(no_reply, items, max_bytes)
+    for i in range(batches * items):
+        handler.publish_queue.put(defs.PublishTelemetry("property", float(i)))
+
+    start = time.time()
+    handler.handle_publish()
+    for topic, payload in handler.mqtt.topics:
+        reply = codec.dumpb(dict((str(x + 1), {"success":True})
+                                 for x in range(len(codec.loads(payload)))))
+        handler.on_message(None, None,
+                           FakeMessage("reply/" + topic[len("api/"):], reply))
+        while not handler.pools["messages"].queue.empty():
+            work = handler.pools["messages"].queue.get()
+            if work.type == constants.WORK_MESSAGE:
+                handler.handle_message(work.data)
+    elapsed = time.time() - start
+    return len(handler.mqtt.topics) / elapsed, batches * items / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reply tracking benchmark")
+    parser.add_argument("--batches", type=int, default=2000,
+                        help="Number of batches of samples (default 2000)")
+    parser.add_argument("--items", type=int, default=10,
+                        help="Samples per batch command (default 10)")
+    parser.add_argument("--max-bytes", type=int, default=1024,
+                        help="Largest request in bytes (default 1024)")
+    args = parser.parse_args()
+
+    print("{:<10} {:>14} {:>14}".format("path", "requests/s", "samples/s"))
+    for name, no_reply in (("tracked", False), ("no_reply", True)):
+        requests, samples = run(no_reply, args.batches, args.items,
+                                args.max_bytes)
+        print("{:<10} {:>14.0f} {:>14.0f}".format(name, requests, samples))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Load benchmark of fixed and elastic action pools.
+
+Connects a handler to the mock MQTT client from the test helpers, then queues
+bursts of actions that each take --action-ms to run, with idle gaps between
+bursts. Prints the time to run every burst, the mean and longest wait for a
+worker, the most threads used and the threads left running once the load has
+gone:
+
+    ./bench_pool.py --bursts 3 --actions 100 --action-ms 20
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+import mock
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+from device_cloud.test import test_helpers as helpers
+
+
+class SlowAction(defs.Action):
+    """
+    Action that takes action_ms to run
+    """
+
+    def __init__(self, name, action_ms, client):
+        super(SlowAction, self).__init__(name, None, client)
+        self.action_ms = action_ms
+
+    def execute(self, request):
+        time.sleep(self.action_ms / 1000.0)
+        return constants.STATUS_SUCCESS
+
+
+def make_handler(actions_pool, action_ms):
+    config = defs.Config()
+    config.update({"key":"bench-device", "cloud":{"token":"token",
+                                                  "host":"localhost",
+                                                  "port":1883},
+                   "proxy":{}, "quiet":True, "loop_time":0.1,
+                   "qos_level":1, "api_rate":0, "control_rate":0,
+                   "work_pools":{"actions":actions_pool}})
+    with mock.patch("paho.mqtt.client.Client") as mock_mqtt:
+        mock_mqtt.return_value = helpers.init_mock_mqtt()
+        handler = Handler(config, None)
+    handler.logger.setLevel(logging.WARNING)
+
+    handler.callbacks.add_action(SlowAction("work", action_ms, handler))
+    return handler
+
+def run(actions_pool, bursts, actions, action_ms, gap):
+    handler = make_handler(actions_pool, action_ms)
+    handler.connect(timeout=5)
+    pool = handler.pools["actions"]
+    peak = 0
+    elapsed = 0.0
+    try:
+        for burst in range(bursts):
+            start = time.time()
+            for i in range(actions):
+                handler.queue_work(defs.Work(
+                    constants.WORK_ACTION,
+                    defs.ActionRequest("{}-{}".format(burst, i), "work", {})))
+            while pool.stats()["handled"] < (burst + 1) * actions:
+                peak = max(peak, pool.stats()["threads"])
+                time.sleep(0.005)
+            elapsed += time.time() - start
+            time.sleep(gap)
+        stats = pool.stats()
+    finally:
+        # The mock MQTT client never replies to the acknowledgements
+        handler.reply_tracker.clear()
+        handler.disconnect()
+    wait = stats["priorities"]["control"]
+    return (elapsed, wait["wait_mean"] * 1000, wait["wait_max"] * 1000,
+            peak, stats["threads"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work pool load benchmark")
+    parser.add_argument("--bursts", type=int, default=3,
+                        help="Bursts of actions (default 3)")
+    parser.add_argument("--actions", type=int, default=100,
+                        help="Actions in each burst (default 100)")
+    parser.add_argument("--action-ms", type=float, default=20,
+                        help="Milliseconds each action runs (default 20)")
+    parser.add_argument("--gap", type=float, default=1.5,
+                        help="Idle seconds after each burst (default 1.5)")
+    args = parser.parse_args()
+
+    pools = (("fixed 3", 3),
+             ("fixed 16", 16),
+             ("elastic 1-16", {"min":1, "max":16, "grow_wait":0.05,
+                               "idle_time":1}))
+    print("{:<14} {:>10} {:>14} {:>13} {:>12} {:>12}".format(
+        "pool", "total s", "wait mean ms", "wait max ms", "peak threads",
+        "idle threads"))
+    for name, actions_pool in pools:
+        result = run(actions_pool, args.bursts, args.actions, args.action_ms,
+                     args.gap)
+        print("{:<14} {:>10.2f} {:>14.1f} {:>13.1f} {:>12d} {:>12d}".format(
+            name, *result))
+
+
+if __name__ == "__main__":
+    main()
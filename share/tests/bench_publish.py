@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of the publish record representation.
+
+Compares the previous representation (a __dict__ per publish with the
+timestamp formatted when it is created) with the current one (__slots__, epoch
+float, timestamp formatted when it is sent). Prints objects created per second,
+bytes per queued sample and property batch items serialised per second:
+
+    ./bench_publish.py --count 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core import tr50
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+
+class LegacyPublishTelemetry(object):
+    """
+    Publish record as it was before __slots__ and deferred timestamps
+    """
+
+    def __init__(self, name, value, timestamp=None, corr_id=None,
+                 aggregate=None):
+        self.timestamp = datetime.utcnow().strftime(constants.TIME_FORMAT)
+        self.type = self.__class__.__name__
+        self.name = name
+        self.value = value
+        self.corr_id = corr_id
+        self.aggregate = aggregate
+
+
+def create(pub_class, count):
+    return [pub_class("property", float(i)) for i in range(count)]
+
+def bench_create(pub_class, count):
+    start = time.time()
+    create(pub_class, count)
+    return count / (time.time() - start)
+
+def bench_memory(pub_class, count):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    pubs = create(pub_class, count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del pubs
+    return float(size) / count
+
+def bench_serialise(pub_class, count):
+    pubs = create(pub_class, count)
+    start = time.time()
+    for pub in pubs:
+        tr50.create_property_batch_item(pub.name, pub.value, pub.timestamp,
+                                        corr_id=pub.corr_id)
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish record benchmark")
+    parser.add_argument("--count", type=int, default=100000,
+                        help="Number of samples (default 100000)")
+    args = parser.parse_args()
+
+    print("{:<10} {:>14} {:>14} {:>16}".format("record", "create/s",
+                                               "bytes/sample", "serialise/s"))
+    for name, pub_class in (("legacy", LegacyPublishTelemetry),
+                            ("current", defs.PublishTelemetry)):
+        created = bench_create(pub_class, args.count)
+        memory = bench_memory(pub_class, args.count)
+        serialised = bench_serialise(pub_class, args.count)
+        print("{:<10} {:>14.0f} {:>14} {:>16.0f}".format(
+            name, created, "n/a" if memory is None else "{:.0f}".format(memory),
+            serialised))
+
+
+if __name__ == "__main__":
+    main()
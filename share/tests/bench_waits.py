@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+'''
+    Copyright (c) 2016-2017 Wind River Systems, Inc.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at:
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software  distributed
+    under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+    OR CONDITIONS OF ANY KIND, either express or implied.
+'''
+
+"""
+Benchmark of how quickly blocking calls return once what they wait for has
+happened.
+
+Compares polling every 100ms (how connect, disconnect and blocking file
+transfers used to wait) with the condition and event based waits, for a
+connection state change, the work queue draining, the last reply arriving and
+a file transfer finishing. Prints the mean and worst latency in milliseconds:
+
+    ./bench_waits.py --rounds 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", ".."))
+
+from device_cloud._core import constants
+from device_cloud._core import defs
+from device_cloud._core.handler import Handler
+
+# Polling interval used before
+POLL = 0.1
+
+
+def make_handler():
+    config = defs.Config()
+    config.update({"key":"bench-device", "cloud":{"token":"token",
+                                                  "host":"localhost",
+                                                  "port":1883},
+                   "proxy":{}, "quiet":True})
+    return Handler(config, None)
+
+
+def poll(predicate):
+    while not predicate():
+        time.sleep(POLL)
+
+
+def measure(wait, trigger, rounds):
+    """
+    Run wait in a thread, call trigger after a random delay and return the
+    latencies from trigger to wait returning
+    """
+
+    latencies = []
+    for _ in range(rounds):
+        done = []
+        thread = threading.Thread(target=lambda: (wait(),
+                                                  done.append(time.time())))
+        thread.start()
+        time.sleep(random.uniform(0.01, 0.05))
+        start = time.time()
+        trigger()
+        thread.join()
+        latencies.append((done[0] - start) * 1000)
+    return latencies
+
+
+def bench_state(handler, rounds, legacy):
+    def reset():
+        handler.state = constants.STATE_CONNECTING
+    def trigger():
+        handler.state = constants.STATE_CONNECTED
+    def wait():
+        if legacy:
+            poll(lambda: handler.state != constants.STATE_CONNECTING)
+        else:
+            handler.wait_for(handler.state_changed,
+                             lambda: handler.state !=
+                             constants.STATE_CONNECTING)
+    latencies = []
+    for _ in range(rounds):
+        reset()
+        latencies.extend(measure(wait, trigger, 1))
+    return latencies
+
+def bench_queue(handler, rounds, legacy):
+    def trigger():
+        handler.pools["publish"].queue.get()
+    def wait():
+        if legacy:
+            poll(handler.pools["publish"].queue.empty)
+        else:
+            handler.pools["publish"].queue.wait_empty()
+    latencies = []
+    for _ in range(rounds):
+        handler.pools["publish"].queue.put(defs.Work(constants.WORK_PUBLISH, None))
+        latencies.extend(measure(wait, trigger, 1))
+    return latencies
+
+def bench_replies(handler, rounds, legacy):
+    def trigger():
+        with handler.lock:
+            handler.reply_tracker.pop_message("0001", "1")
+            if len(handler.reply_tracker) == 0:
+                handler.replies_done.notify_all()
+    def wait():
+        if legacy:
+            poll(lambda: len(handler.reply_tracker) == 0)
+        else:
+            handler.wait_for(handler.replies_done,
+                             lambda: len(handler.reply_tracker) == 0)
+    latencies = []
+    for _ in range(rounds):
+        handler.reply_tracker.add_message(defs.OutMessage({}, "reply",
+                                                          out_id="0001-1"))
+        latencies.extend(measure(wait, trigger, 1))
+    return latencies
+
+def bench_transfer(handler, rounds, legacy):
+    latencies = []
+    for _ in range(rounds):
+        transfer = defs.FileTransfer("file", "/tmp/file", None)
+        def trigger():
+            transfer.status = constants.STATUS_SUCCESS
+        def wait():
+            if legacy:
+                poll(lambda: transfer.status is not None)
+            else:
+                transfer.done.wait()
+        latencies.extend(measure(wait, trigger, 1))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blocking call latency "
+                                     "benchmark")
+    parser.add_argument("--rounds", type=int, default=20,
+                        help="Waits measured for each case (default 20)")
+    args = parser.parse_args()
+
+    handler = make_handler()
+    print("{:<10} {:>16} {:>16} {:>16} {:>16}".format(
+        "wait", "poll mean ms", "poll max ms", "event mean ms",
+        "event max ms"))
+    for name, bench in (("connect", bench_state), ("work", bench_queue),
+                        ("replies", bench_replies),
+                        ("transfer", bench_transfer)):
+        results = []
+        for legacy in (True, False):
+            latencies = bench(handler, args.rounds, legacy)
+            results.extend([sum(latencies) / len(latencies), max(latencies)])
+        print("{:<10} {:>16.2f} {:>16.2f} {:>16.2f} {:>16.2f}".format(
+            name, *results))
+
+
+if __name__ == "__main__":
+    main()